@@ -0,0 +1,233 @@
+"""
+画像前処理（image_bytes_to_base64）のマイクロベンチマーク
+実際に送られてくる入力を想定した合成画像ごとに、処理時間・ピークRSS・出力サイズを計測する
+各ケースは別プロセスで実行し、ピークRSSが他のケースの影響を受けないようにする
+
+使い方:
+    python -m bench.bench_preprocess                          # bench/results/preprocess-<commit>.json に保存
+    python -m bench.bench_preprocess --repeat 10 --output result.json
+    python -m bench.bench_preprocess --compare bench/results/preprocess-abc1234.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from PIL import Image, ImageDraw, ImageFilter
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def _photo_like(width: int, height: int) -> Image.Image:
+    """グラデーション＋ノイズで実写に近い圧縮率の画像を作る"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    return Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))).filter(ImageFilter.SMOOTH)
+
+
+def make_jpeg_12mp() -> bytes:
+    """スマホ撮影の写真（12MP JPEG）"""
+    buffered = io.BytesIO()
+    _photo_like(4032, 3024).save(buffered, format="JPEG", quality=92)
+    return buffered.getvalue()
+
+
+def make_png_alpha() -> bytes:
+    """透過付きの大きなPNG（CGパースの書き出し）"""
+    image = _photo_like(3000, 2000).convert("RGBA")
+    alpha = Image.linear_gradient("L").resize(image.size)
+    image.putalpha(alpha)
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def make_palette() -> bytes:
+    """パレット画像（減色されたPNG）"""
+    image = _photo_like(2000, 1500).quantize(colors=256)
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def make_small_jpeg() -> bytes:
+    """既に1024px以下の画像（リサイズ不要）"""
+    buffered = io.BytesIO()
+    _photo_like(960, 720).save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+def make_floor_plan() -> bytes:
+    """平面図の線画（A4・300dpi相当の白地に黒線）"""
+    width, height = 3508, 2480
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for x in range(200, width - 200, 300):
+        draw.line([(x, 200), (x, height - 200)], fill=0, width=6)
+    for y in range(200, height - 200, 260):
+        draw.line([(200, y), (width - 200, y)], fill=0, width=6)
+    for i in range(40):
+        x, y = 250 + (i * 83) % (width - 600), 250 + (i * 137) % (height - 600)
+        draw.rectangle([x, y, x + 180, y + 120], outline=0, width=3)
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+CASES = {
+    "jpeg_12mp": make_jpeg_12mp,
+    "png_alpha_large": make_png_alpha,
+    "palette_png": make_palette,
+    "small_jpeg": make_small_jpeg,
+    "floor_plan_line_art": make_floor_plan,
+}
+
+
+def _current_rss_kb() -> int:
+    """現在のRSS（KB）。/proc が無い環境ではピーク値で代用"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RssSampler:
+    """別スレッドでRSSをサンプリングし、計測区間中のピークを記録する"""
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak_kb = _current_rss_kb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.peak_kb = max(self.peak_kb, _current_rss_kb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, _current_rss_kb())
+
+
+def _run_case(input_path: str, repeat: int, queue):
+    """子プロセス: 入力を読み込んで前処理を繰り返し実行"""
+    from services.kie_api import image_bytes_to_base64
+
+    with open(input_path, "rb") as f:
+        image_bytes = f.read()
+
+    baseline_kb = _current_rss_kb()
+    timings = []
+    output_size = 0
+    try:
+        with RssSampler() as sampler:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                output = image_bytes_to_base64(image_bytes)
+                timings.append(time.perf_counter() - start)
+                output_size = len(output)
+                del output
+    except Exception as e:
+        queue.put({"error": str(e)})
+        return
+
+    queue.put({
+        "time_min": round(min(timings), 4),
+        "time_median": round(statistics.median(timings), 4),
+        "peak_rss_mb": round(sampler.peak_kb / 1024, 1),
+        "peak_rss_delta_mb": round((sampler.peak_kb - baseline_kb) / 1024, 1),
+        "output_bytes": output_size,
+    })
+
+
+def run(repeat: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, factory in CASES.items():
+            image_bytes = factory()
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                info = {"size": list(image.size), "mode": image.mode, "format": image.format}
+            input_path = os.path.join(workdir, name)
+            with open(input_path, "wb") as f:
+                f.write(image_bytes)
+
+            queue = context.Queue()
+            process = context.Process(target=_run_case, args=(input_path, repeat, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+
+            results[name] = {"input_bytes": len(image_bytes), **info, **result}
+            print(f"  {name}: {result}", flush=True)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current: dict, baseline_path: str):
+    """前回結果との比較を表示"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline.get('commit')} ({baseline_path}):", flush=True)
+    for name, result in current["cases"].items():
+        before = baseline["cases"].get(name)
+        if not before or "error" in before or "error" in result:
+            continue
+        for key in ("time_median", "peak_rss_delta_mb", "output_bytes"):
+            old, new = before[key], result[key]
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"  {name:22s} {key:18s} {old:>12} -> {new:>12} ({change})", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image_bytes_to_base64 over real-world input profiles")
+    parser.add_argument("--repeat", type=int, default=5, help="ケースごとの繰り返し回数")
+    parser.add_argument("--output", default="", help="結果JSONの出力先（省略時は bench/results/preprocess-<commit>.json）")
+    parser.add_argument("--compare", default="", help="比較する過去の結果JSON")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    print(f"Benchmarking image preprocessing at {commit}...", flush=True)
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "repeat": args.repeat,
+        "cases": run(args.repeat),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"preprocess-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written: {output}", flush=True)
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""
+エンドツーエンド負荷試験ドライバ
+ローカルのモック（bench/mock_upstreams.py）に向けてアプリを起動し、
+署名付きの /webhook イベント（画像 → タイプ選択 → プロンプト）を指定レートで送信する
+
+使い方:
+    python -m bench.loadtest --jobs 20 --rate 0.5
+    python -m bench.loadtest --jobs 50 --rate 2 --profile bench/profile.json --output bench/results/load.json
+    python -m bench.loadtest --app-url http://localhost:8000 --mock-url http://localhost:9100 --secret xxx  # 起動済みのものを使う
+
+レポート:
+    完了/失敗/タイムアウト件数、エンドツーエンドのレイテンシ（OK送信 → 最後の画像）と
+    最初の画像までのレイテンシのパーセンタイル、jobs/sec、アプリのピークメモリ、
+    ステージ別の所要時間（アプリの /debug/jobs から取得）
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Optional
+
+import httpx
+
+BENCH_SECRET = "bench-channel-secret"
+BENCH_DEBUG_TOKEN = "bench-debug-token"
+EXPECTED_IMAGES = 4
+
+
+def percentile(values: list, p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 3)
+
+
+def latency_summary(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p90": percentile(values, 0.90),
+        "p99": percentile(values, 0.99),
+        "max": round(max(values), 3) if values else None,
+    }
+
+
+def sign(body: bytes, secret: str) -> str:
+    """LINEと同じ方式の署名（HMAC-SHA256 → Base64）"""
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def read_memory_kb(pid: int) -> dict:
+    """/proc からRSSとピークRSS（VmHWM）を取得（Linuxのみ）"""
+    result = {}
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    result[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return result
+
+
+class ServerProcess:
+    """uvicornをサブプロセスで起動"""
+
+    def __init__(self, app: str, port: int, env: dict, log_path: str):
+        self.app = app
+        self.port = port
+        self.env = env
+        self.log_path = log_path
+        self.process = None
+
+    def start(self):
+        self.log_file = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", self.app, "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            env={**os.environ, **self.env},
+            stdout=self.log_file,
+            stderr=subprocess.STDOUT,
+        )
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.process:
+            self.log_file.close()
+
+
+async def wait_ready(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            try:
+                res = await client.get(url)
+                if res.status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.3)
+    raise RuntimeError(f"Server not ready: {url}")
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.app_url = args.app_url
+        self.mock_url = args.mock_url
+        self.secret = args.secret
+        self.client = httpx.AsyncClient(timeout=30.0, limits=httpx.Limits(max_connections=200))
+        # user_id -> {"images": [時刻...], "busy": [時刻...], "finished": [ジョブの開始時刻...], "since": 現在の生成の開始時刻}
+        self.deliveries = {}
+        self.waiters = {}
+        self.reply_tokens = {}  # replyToken -> user_id（混雑中の返信の振り分け用）
+        self.collector_since = time.time()
+        self.seen_events = set()
+        self.peak_rss_kb = 0
+        self.app_pid = None
+        self.webhook_errors = 0
+
+    async def post_events(self, events: list):
+        body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode("utf-8")
+        res = await self.client.post(
+            f"{self.app_url}/webhook",
+            content=body,
+            headers={"Content-Type": "application/json", "X-Line-Signature": sign(body, self.secret)},
+        )
+        if res.status_code != 200:
+            self.webhook_errors += 1
+
+    def message_event(self, user_id: str, message: dict) -> dict:
+        reply_token = uuid.uuid4().hex
+        self.reply_tokens[reply_token] = user_id
+        return {
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": uuid.uuid4().hex,
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": reply_token,
+            "message": message,
+        }
+
+    async def run_job(self, index: int) -> dict:
+        """1ジョブ: 画像 → 「外観」 → 「OK」（--prompt）を送り、結果が届くまで待つ"""
+        user_id = f"Ubench{index:05d}{uuid.uuid4().hex[:8]}"
+        parse_type = random.choice(["外観", "内観", "平面図"])
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[user_id] = waiter
+        self.deliveries[user_id] = {"images": [], "busy": [], "finished": [], "since": time.time(),
+                                    "expected": EXPECTED_IMAGES * self.args.image_set}
+
+        if self.args.image_set > 1:
+            # 複数画像をまとめて送信（LINEの imageSet）
+            set_id = uuid.uuid4().hex
+            await self.post_events([
+                self.message_event(user_id, {
+                    "type": "image", "id": f"{index}{uuid.uuid4().hex[:6]}", "contentProvider": {"type": "line"},
+                    "imageSet": {"id": set_id, "index": i + 1, "total": self.args.image_set}
+                })
+                for i in range(self.args.image_set)
+            ])
+        else:
+            await self.post_events([self.message_event(user_id, {"type": "image", "id": f"{index}{uuid.uuid4().hex[:6]}", "contentProvider": {"type": "line"}})])
+        await asyncio.sleep(self.args.think_time)
+        await self.post_events([self.message_event(user_id, {"type": "text", "id": uuid.uuid4().hex[:10], "text": parse_type})])
+        await asyncio.sleep(self.args.think_time)
+
+        started = time.time()
+        self.deliveries[user_id]["since"] = started
+        await self.post_events([self.message_event(user_id, {"type": "text", "id": uuid.uuid4().hex[:10], "text": self.args.prompt})])
+        if random.random() < self.args.double_tap:
+            # 「OK」の連打（同じ生成が二重に要求される）
+            await asyncio.sleep(0.2)
+            await self.post_events([self.message_event(user_id, {"type": "text", "id": uuid.uuid4().hex[:10], "text": self.args.prompt})])
+
+        try:
+            await asyncio.wait_for(waiter, timeout=self.args.job_timeout)
+            status = "completed"
+        except asyncio.TimeoutError:
+            status = "timeout"
+
+        delivered = self.deliveries[user_id]
+        images = [t for t in delivered["images"] if t >= started]
+        if not images and any(t >= started for t in delivered["busy"]):
+            # 受付制御で断られた
+            status = "rejected"
+        result = {
+            "status": status if images or status == "rejected" else ("failed" if status == "completed" else status),
+            "images": len(images),
+            "started": started,
+        }
+        if images:
+            result["first_image"] = min(images) - started
+            result["last_image"] = max(images) - started
+
+        # 同じ写真のまま別の指示で再生成（画像セッションの再利用）
+        result["refine_first_image"] = []
+        for _ in range(self.args.refine if status == "completed" else 0):
+            await asyncio.sleep(self.args.think_time)
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters[user_id] = waiter
+            refine_started = time.time()
+            delivered["since"] = refine_started
+            await self.post_events([self.message_event(user_id, {"type": "text", "id": uuid.uuid4().hex[:10], "text": "モダンな雰囲気で"})])
+            try:
+                await asyncio.wait_for(waiter, timeout=self.args.job_timeout)
+            except asyncio.TimeoutError:
+                break
+            refined = [t for t in delivered["images"] if t >= refine_started]
+            if refined:
+                result["refine_first_image"].append(min(refined) - refine_started)
+        return result
+
+    async def collect(self):
+        """モックに届いたLINE送信を集計してジョブに振り分け"""
+        while True:
+            try:
+                res = await self.client.get(f"{self.mock_url}/_stats", params={"since": self.collector_since})
+                events = res.json()["line_events"]
+                for event in events:
+                    self.collector_since = max(self.collector_since, event["time"])
+                    if event["kind"] == "reply" and event["to"] in self.reply_tokens:
+                        # 混雑中の返信（再試行ボタン付き）
+                        delivered = self.deliveries.get(self.reply_tokens[event["to"]])
+                        if delivered is not None and event["time"] not in delivered["busy"] and any(
+                                "再試行" in str(message.get("quickReply", "")) for message in event["messages"]):
+                            delivered["busy"].append(event["time"])
+                        continue
+                    if event["kind"] != "push" or event["to"] not in self.deliveries:
+                        continue
+                    # 巻き戻しによる同じイベントの重複を除く
+                    if (event["time"], event["to"]) in self.seen_events:
+                        continue
+                    self.seen_events.add((event["time"], event["to"]))
+                    delivered = self.deliveries[event["to"]]
+                    for message in event["messages"]:
+                        if message.get("type") == "image":
+                            delivered["images"].append(event["time"])
+                # 同じ時刻のイベントの取りこぼしを避けるため少し巻き戻す
+                self.collector_since -= 0.001
+                # LINE送信の後に取得するので、終了したジョブの画像は既に集計済み
+                await self.collect_finished_jobs()
+                for user_id, delivered in self.deliveries.items():
+                    waiter = self.waiters.get(user_id)
+                    if waiter and not waiter.done():
+                        # 全画像到着、アプリのジョブの終了（一部・全て失敗した場合）、または混雑中の返信で終了
+                        since = delivered["since"]
+                        images = [t for t in delivered["images"] if t >= since]
+                        finished = [t for t in delivered["finished"] if t >= since]
+                        busy = [t for t in delivered["busy"] if t >= since]
+                        if len(images) >= delivered["expected"] or finished or busy:
+                            waiter.set_result(True)
+            except Exception as e:
+                print(f"Collector error: {e}", flush=True)
+
+            if self.app_pid:
+                memory = read_memory_kb(self.app_pid)
+                self.peak_rss_kb = max(self.peak_rss_kb, memory.get("VmHWM", 0), memory.get("VmRSS", 0))
+            await asyncio.sleep(0.5)
+
+    async def collect_finished_jobs(self):
+        """
+        アプリの /debug/jobs から終了したジョブを集計（画像が揃わないまま終わったジョブの完了の合図）
+        新しいジョブに置き換えられたもの（cancelled）は除く。DEBUG_TOKENが無ければ全画像の到着だけで判定する
+        """
+        if not self.args.debug_token:
+            return
+        waiting = {user_id for user_id, waiter in self.waiters.items() if not waiter.done()}
+        if not waiting:
+            return
+        res = await self.client.get(
+            f"{self.app_url}/debug/jobs", params={"limit": 200}, headers={"X-Debug-Token": self.args.debug_token}
+        )
+        for job in res.json().get("jobs", []):
+            if job.get("user_id") not in waiting or job["status"] == "running" or job.get("outcome") == "cancelled":
+                continue
+            delivered = self.deliveries[job["user_id"]]
+            if job["started_at"] not in delivered["finished"]:
+                delivered["finished"].append(job["started_at"])
+
+    async def run(self) -> dict:
+        await self.client.post(f"{self.mock_url}/_reset")
+        collector = asyncio.create_task(self.collect())
+
+        jobs = []
+        wall_start = time.time()
+        for index in range(self.args.jobs):
+            jobs.append(asyncio.create_task(self.run_job(index)))
+            # ポアソン到着（平均 rate 件/秒）
+            await asyncio.sleep(random.expovariate(self.args.rate))
+        results = await asyncio.gather(*jobs)
+        wall_time = time.time() - wall_start
+
+        collector.cancel()
+        stages = await self.stage_breakdown()
+        mock_stats = (await self.client.get(f"{self.mock_url}/_stats", params={"since": time.time()})).json()
+        await self.client.aclose()
+
+        completed = [r for r in results if r["status"] == "completed"]
+        return {
+            "config": {
+                "jobs": self.args.jobs,
+                "rate": self.args.rate,
+                "think_time": self.args.think_time,
+                "profile": self.args.profile,
+                "double_tap": self.args.double_tap,
+                "refine": self.args.refine,
+                "image_set": self.args.image_set,
+            },
+            "completed": len(completed),
+            "failed": sum(1 for r in results if r["status"] == "failed"),
+            "timeouts": sum(1 for r in results if r["status"] == "timeout"),
+            "rejected": sum(1 for r in results if r["status"] == "rejected"),
+            "webhook_errors": self.webhook_errors,
+            "images_delivered": sum(r["images"] for r in results),
+            "latency_first_image": latency_summary([r["first_image"] for r in results if "first_image" in r]),
+            "latency_end_to_end": latency_summary([r["last_image"] for r in completed]),
+            "latency_refine_first_image": latency_summary([t for r in results for t in r["refine_first_image"]]),
+            "wall_time": round(wall_time, 2),
+            "jobs_per_sec": round(len(completed) / wall_time, 4) if wall_time else 0,
+            "peak_rss_mb": round(self.peak_rss_kb / 1024, 1) if self.peak_rss_kb else None,
+            "stages": stages,
+            "mock_counters": mock_stats["counters"],
+        }
+
+    async def stage_breakdown(self) -> dict:
+        """アプリのジョブトレースからステージ別の所要時間を集計"""
+        if not self.args.debug_token:
+            return {}
+        headers = {"X-Debug-Token": self.args.debug_token}
+        durations = {}
+        try:
+            res = await self.client.get(f"{self.app_url}/debug/jobs", params={"limit": self.args.jobs}, headers=headers)
+            for job in res.json().get("jobs", []):
+                detail = (await self.client.get(f"{self.app_url}/debug/jobs/{job['job_id']}", headers=headers)).json()
+                for span in detail.get("timeline", [])[1:]:
+                    durations.setdefault(span["name"], []).append(span["duration_ms"] / 1000)
+        except Exception as e:
+            print(f"Stage breakdown error: {e}", flush=True)
+        return {name: latency_summary(values) for name, values in sorted(durations.items())}
+
+
+def print_report(report: dict):
+    print("\n=== Load test report ===", flush=True)
+    print(f"jobs: {report['config']['jobs']} @ {report['config']['rate']}/s", flush=True)
+    print(f"completed: {report['completed']}  failed: {report['failed']}  timeouts: {report['timeouts']}  "
+          f"rejected: {report['rejected']}  webhook errors: {report['webhook_errors']}", flush=True)
+    for key in ("latency_first_image", "latency_end_to_end", "latency_refine_first_image"):
+        summary = report[key]
+        if not summary["count"]:
+            continue
+        print(f"{key}: p50={summary['p50']}s p90={summary['p90']}s p99={summary['p99']}s max={summary['max']}s", flush=True)
+    print(f"throughput: {report['jobs_per_sec']} jobs/sec over {report['wall_time']}s", flush=True)
+    print(f"peak RSS: {report['peak_rss_mb']} MB", flush=True)
+    counters = report.get("mock_counters", {})
+    print("upstream calls: " + " ".join(f"{name}={counters[name]}" for name in sorted(counters)), flush=True)
+    if report.get("stages"):
+        print("stages (seconds):", flush=True)
+        for name, summary in report["stages"].items():
+            print(f"  {name:24s} n={summary['count']:<4} p50={summary['p50']} p90={summary['p90']} max={summary['max']}", flush=True)
+
+
+def app_env(mock_url: str, workdir: str) -> dict:
+    """モックに向けてアプリを起動するための環境変数"""
+    return {
+        "LINE_CHANNEL_SECRET": BENCH_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-access-token",
+        "KIEAI_API_KEY": "bench-kie-key",
+        "LINE_API_BASE": mock_url,
+        "LINE_DATA_API_BASE": mock_url,
+        "KIEAI_API_BASE": mock_url,
+        "KIEAI_UPLOAD_BASE": mock_url,
+        "WEBHOOK_SITE_BASE": mock_url,
+        "DATABASE_BACKEND": "sqlite",
+        "GOOGLE_SHEETS_ID": "",
+        "DATA_DIR": workdir,
+        "PUBLIC_BASE_URL": "",
+        "DEBUG_TOKEN": BENCH_DEBUG_TOKEN,
+        "TRACE_EXPORT_PATH": os.path.join(workdir, "traces.jsonl"),
+    }
+
+
+async def main_async(args) -> dict:
+    servers = []
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        if not args.mock_url:
+            args.mock_url = f"http://127.0.0.1:{args.mock_port}"
+            env = {"BENCH_PROFILE": args.profile} if args.profile else {}
+            mock = ServerProcess("bench.mock_upstreams:app", args.mock_port, env, os.path.join(workdir, "mock.log"))
+            mock.start()
+            servers.append(mock)
+            await wait_ready(f"{args.mock_url}/_stats")
+
+        app_process = None
+        if not args.app_url:
+            args.app_url = f"http://127.0.0.1:{args.app_port}"
+            args.secret = BENCH_SECRET
+            args.debug_token = BENCH_DEBUG_TOKEN
+            app_process = ServerProcess("main:app", args.app_port, app_env(args.mock_url, workdir), os.path.join(workdir, "app.log"))
+            app_process.start()
+            servers.append(app_process)
+            await wait_ready(f"{args.app_url}/health")
+
+        load_test = LoadTest(args)
+        if app_process:
+            load_test.app_pid = app_process.process.pid
+        report = await load_test.run()
+        report["logs"] = workdir
+        return report
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against local mock upstreams")
+    parser.add_argument("--jobs", type=int, default=20, help="実行するジョブ数")
+    parser.add_argument("--rate", type=float, default=0.5, help="ジョブの到着レート（件/秒）")
+    parser.add_argument("--think-time", type=float, default=1.0, help="画像→タイプ→プロンプト間の待ち時間（秒）")
+    parser.add_argument("--job-timeout", type=float, default=300.0, help="1ジョブの最大待ち時間（秒）")
+    parser.add_argument("--prompt", default="OK", help="プロンプトとして送るテキスト（「クイック」でプレビュー1枚のみ）")
+    parser.add_argument("--image-set", type=int, default=1, help="1ジョブでまとめて送る写真の枚数（2以上で imageSet の一括生成）")
+    parser.add_argument("--refine", type=int, default=0, help="完了後に同じ写真で追加の指示を送る回数")
+    parser.add_argument("--double-tap", type=float, default=0.0, help="プロンプトを二重送信するジョブの割合（0〜1）")
+    parser.add_argument("--profile", default="", help="モックのレイテンシ・失敗率設定（JSON）")
+    parser.add_argument("--app-url", default="", help="起動済みアプリのURL（省略時はサブプロセスで起動）")
+    parser.add_argument("--mock-url", default="", help="起動済みモックのURL（省略時はサブプロセスで起動）")
+    parser.add_argument("--secret", default=BENCH_SECRET, help="起動済みアプリのLINEチャネルシークレット")
+    parser.add_argument("--debug-token", default="", help="起動済みアプリのDEBUG_TOKEN（ステージ別集計に使用）")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--output", default="", help="レポートJSONの出力先")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Report written: {args.output}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+負荷試験用のローカル外部APIモック
+LINE Messaging API / LINEコンテンツAPI / KIE.AI（アップロード・createTask）/ webhook.site
+を1つのFastAPIアプリで再現し、エンドポイントごとのレイテンシと失敗率を設定できる
+
+起動:
+    BENCH_PROFILE=bench/profile.json uvicorn bench.mock_upstreams:app --port 9100
+
+プロファイル（JSON）の形式:
+    {
+        "line_content": {"latency": [0.05, 0.2], "fail_rate": 0.0},
+        "models": {"nano-banana-pro": {"latency": {"median": 20, "sigma": 0.4}, "fail_rate": 0.05}}
+    }
+    latency は [最小, 最大]（一様分布）または {"median", "sigma"}（対数正規分布）
+    latency・fail_rate の代わりに "samples": [[秒, 失敗], ...] を指定すると記録した値を順に使う（bench/replay.py）
+    BENCH_SEED を設定すると乱数を固定する
+"""
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import time
+import uuid
+from typing import Optional
+
+from fastapi import FastAPI, Request, Response
+from PIL import Image
+
+DEFAULT_PROFILE = {
+    "line_content": {"latency": [0.05, 0.2], "fail_rate": 0.0},
+    "line_reply": {"latency": [0.03, 0.1], "fail_rate": 0.0},
+    "line_push": {"latency": [0.05, 0.2], "fail_rate": 0.0},
+    "upload": {"latency": [0.5, 1.5], "fail_rate": 0.0},
+    "create_task": {"latency": [0.3, 1.0], "fail_rate": 0.0},
+    "webhook_token": {"latency": [0.1, 0.3], "fail_rate": 0.0},
+    "webhook_poll": {"latency": [0.05, 0.2], "fail_rate": 0.0},
+    "default_model": {"latency": {"median": 30, "sigma": 0.35}, "fail_rate": 0.05},
+    "models": {
+        "nano-banana-pro": {"latency": {"median": 25, "sigma": 0.3}, "fail_rate": 0.03},
+        "gpt-image/1.5-image-to-image": {"latency": {"median": 60, "sigma": 0.4}, "fail_rate": 0.05},
+        "seedream/4.5-edit": {"latency": {"median": 20, "sigma": 0.3}, "fail_rate": 0.03},
+        "flux-2/flex-image-to-image": {"latency": {"median": 35, "sigma": 0.35}, "fail_rate": 0.08},
+    },
+    # LINEから返す元画像（送信されるパース画像の想定サイズ）
+    "source_image": {"width": 2400, "height": 1600, "quality": 90},
+}
+
+
+def load_profile() -> dict:
+    """BENCH_PROFILE（JSONファイル）でデフォルトを上書き"""
+    profile = json.loads(json.dumps(DEFAULT_PROFILE))
+    path = os.getenv("BENCH_PROFILE")
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            override = json.load(f)
+        for key, value in override.items():
+            if key == "models":
+                profile["models"].update(value)
+            else:
+                profile[key] = value
+    return profile
+
+
+def sample_latency(spec) -> float:
+    """レイテンシ設定から1件サンプリング"""
+    if isinstance(spec, dict):
+        return random.lognormvariate(math.log(spec["median"]), spec.get("sigma", 0.3))
+    low, high = spec
+    return random.uniform(low, high)
+
+
+def sample(spec: dict) -> tuple[float, bool]:
+    """(レイテンシ, 失敗するか) を1件サンプリング（samples があれば先頭から順に繰り返す）"""
+    if spec.get("samples"):
+        index = spec.get("_next", 0)
+        spec["_next"] = index + 1
+        seconds, failed = spec["samples"][index % len(spec["samples"])]
+        return seconds, bool(failed)
+    return sample_latency(spec["latency"]), random.random() < spec.get("fail_rate", 0.0)
+
+
+def make_source_image(width: int, height: int, quality: int) -> bytes:
+    """ノイズ入りのJPEG（圧縮率が実写に近くなるように）"""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def make_result_image() -> bytes:
+    buffered = io.BytesIO()
+    Image.new("RGB", (1376, 768), (200, 200, 200)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+app = FastAPI(title="Bench mock upstreams")
+if os.getenv("BENCH_SEED"):
+    random.seed(int(os.getenv("BENCH_SEED")))
+profile = load_profile()
+source_image = make_source_image(**profile["source_image"])
+result_image = make_result_image()
+
+# webhook.site 相当の受信ボックス {uuid: [content, ...]}
+webhook_inbox = {}
+# LINE送信の記録 [{"time", "kind", "to", "messages"}]
+line_events = []
+counters = {}
+
+
+def count(name: str):
+    counters[name] = counters.get(name, 0) + 1
+
+
+async def simulate(name: str) -> Optional[Response]:
+    """設定されたレイテンシで待ち、失敗率に応じてエラーを返す"""
+    seconds, failed = sample(profile[name])
+    await asyncio.sleep(seconds)
+    count(name)
+    if failed:
+        count(f"{name}_failed")
+        return Response(status_code=500, content=b'{"message":"mock failure"}', media_type="application/json")
+    return None
+
+
+def base_url(request: Request) -> str:
+    return str(request.base_url).rstrip("/")
+
+
+# --- LINE Messaging API ---
+
+@app.get("/v2/bot/message/{message_id}/content")
+async def line_content(message_id: str):
+    error = await simulate("line_content")
+    # メッセージごとに異なるバイト列にする（JPEGの終端以降は画像として無視される）
+    return error or Response(content=source_image + message_id.encode(), media_type="image/jpeg")
+
+
+@app.post("/v2/bot/message/reply")
+async def line_reply(request: Request):
+    error = await simulate("line_reply")
+    if error:
+        return error
+    body = await request.json()
+    line_events.append({"time": time.time(), "kind": "reply", "to": body.get("replyToken"), "messages": body.get("messages", [])})
+    return {"sentMessages": [{"id": uuid.uuid4().hex} for _ in body.get("messages", [])]}
+
+
+@app.post("/v2/bot/message/push")
+async def line_push(request: Request):
+    error = await simulate("line_push")
+    if error:
+        return error
+    body = await request.json()
+    line_events.append({"time": time.time(), "kind": "push", "to": body.get("to"), "messages": body.get("messages", [])})
+    return {"sentMessages": [{"id": uuid.uuid4().hex} for _ in body.get("messages", [])]}
+
+
+# --- KIE.AI ---
+
+@app.post("/api/file-base64-upload")
+async def kie_upload(request: Request):
+    await request.body()
+    error = await simulate("upload")
+    if error:
+        return error
+    return {"success": True, "data": {"downloadUrl": f"{base_url(request)}/files/upload/{uuid.uuid4().hex}.jpg"}}
+
+
+@app.post("/api/v1/jobs/createTask")
+async def kie_create_task(request: Request):
+    payload = await request.json()
+    error = await simulate("create_task")
+    if error:
+        return error
+
+    task_id = uuid.uuid4().hex
+    model = payload.get("model", "")
+    callback_uuid = payload.get("callBackUrl", "").rstrip("/").rsplit("/", 1)[-1]
+    result_url = f"{base_url(request)}/files/result/{task_id}.png"
+    asyncio.create_task(complete_task(model, callback_uuid, task_id, result_url))
+    return {"code": 200, "msg": "success", "data": {"taskId": task_id}}
+
+
+async def complete_task(model: str, callback_uuid: str, task_id: str, result_url: str):
+    """モデルごとの生成時間の後、webhook.site の受信ボックスに結果を届ける"""
+    seconds, failed = sample(profile["models"].get(model, profile["default_model"]))
+    await asyncio.sleep(seconds)
+    count(f"model:{model}:{'fail' if failed else 'success'}")
+    data = {"taskId": task_id, "state": "fail" if failed else "success"}
+    if not failed:
+        data["resultUrls"] = [result_url]
+    webhook_inbox.setdefault(callback_uuid, []).append(json.dumps({"code": 200, "data": data}))
+
+
+# --- webhook.site ---
+
+@app.post("/token")
+async def webhook_token():
+    error = await simulate("webhook_token")
+    if error:
+        return error
+    token = uuid.uuid4().hex
+    webhook_inbox[token] = []
+    return {"uuid": token}
+
+
+@app.get("/token/{token}/requests")
+async def webhook_requests(token: str):
+    error = await simulate("webhook_poll")
+    if error:
+        return error
+    return {"data": [{"content": content} for content in webhook_inbox.get(token, [])]}
+
+
+# --- ファイル ---
+
+@app.get("/files/{kind}/{name}")
+async def files(kind: str, name: str):
+    return Response(content=result_image, media_type="image/png")
+
+
+# --- 負荷試験ドライバ用 ---
+
+@app.get("/_stats")
+async def stats(since: float = 0.0):
+    return {
+        "counters": counters,
+        "line_events": [event for event in line_events if event["time"] >= since],
+    }
+
+
+@app.post("/_reset")
+async def reset():
+    webhook_inbox.clear()
+    line_events.clear()
+    counters.clear()
+    return {"status": "ok"}
+
+
+# webhook.site 受信（実サービスと同じ形式でPOSTされた場合）
+@app.post("/{token}")
+async def webhook_receive(token: str, request: Request):
+    body = await request.body()
+    webhook_inbox.setdefault(token, []).append(body.decode("utf-8"))
+    return {"status": "ok"}
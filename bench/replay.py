@@ -0,0 +1,290 @@
+"""
+記録した本番の負荷（services/workload_recorder.py）のリプレイ
+記録どおりのタイミングでWebhookイベントをアプリの /webhook に送り、モックの外部APIには記録した
+レイテンシ・モデルごとの生成時間（成功・失敗を含む）を記録順に返させる。
+リプレイ中のアプリ自身の記録と元の記録を並べて、ジョブの所要時間・最初の画像までの時間を比較する
+
+使い方:
+    python -m bench.replay /data/workload/202609*.jsonl.gz
+    python -m bench.replay recording.jsonl.gz --max-gap 60 --output bench/results/replay.json
+
+    --max-gap: 記録中の長い無音区間（夜間など）をこの秒数に詰める（バースト内の間隔はそのまま）
+    --speed: 全体の再生速度（1で記録と同じ。上げると同時実行数が変わるので比較には1を推奨）
+
+注意:
+    - 外部APIのレイテンシはアプリ側から見た値（接続待ちを含む）をそのまま再生する
+    - DBはSQLiteで動かす（Sheetsのレイテンシ db.* は記録側の参考値として表示のみ）
+    - 指示の内容は記録していないため、自由入力の指示は同じ文字数のダミーで送る
+"""
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import os
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from bench.loadtest import BENCH_DEBUG_TOKEN, BENCH_SECRET, LoadTest, ServerProcess, app_env, latency_summary, wait_ready
+
+# 記録の区間名 → モックのプロファイルのキー
+PROFILE_KEYS = {
+    "line.reply": "line_reply",
+    "line.push": "line_push",
+    "line.download": "line_content",
+    "kie.upload": "upload",
+    "kie.create_task": "create_task",
+    "webhook.token": "webhook_token",
+}
+CUSTOM_FILLER = "モダンな雰囲気で木目を活かした明るい仕上がりに"
+
+
+def read_records(patterns: list) -> tuple[dict, list]:
+    """記録ファイルを読み込む（globと .gz に対応）。戻り値は (語彙, 時刻順のレコード)"""
+    vocabulary = {}
+    records = []
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    if not paths:
+        raise SystemExit(f"No recording matched: {' '.join(patterns)}")
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record[0] == "meta":
+                    vocabulary.update(record[2].get("vocab", {}))
+                else:
+                    records.append(record)
+    records.sort(key=lambda record: record[1])
+    print(f"Loaded {len(records)} records from {len(paths)} file(s)", flush=True)
+    return vocabulary, records
+
+
+def build_profile(records: list) -> dict:
+    """記録したレイテンシ・生成時間からモックのプロファイル（samples）を作る"""
+    profile = {"models": {}}
+    for record in records:
+        if record[0] == "up" and record[2] in PROFILE_KEYS:
+            _, _, name, seconds, ok = record
+            profile.setdefault(PROFILE_KEYS[name], {"samples": []})["samples"].append([seconds, not ok])
+        elif record[0] == "model":
+            _, _, model, seconds, result = record
+            profile["models"].setdefault(model, {"samples": []})["samples"].append([seconds, result == "fail"])
+    return profile
+
+
+def schedule(records: list, max_gap: float, speed: float) -> list:
+    """
+    イベントを送信スケジュールにする（同じ時刻のイベントは1つのWebhookにまとめる）
+
+    Returns:
+        [(開始からの秒, [イベントのレコード, ...]), ...]
+    """
+    batches = []
+    offset = 0.0
+    previous = None
+    for record in records:
+        if record[0] != "ev":
+            continue
+        if previous is not None and record[1] == previous:
+            batches[-1][1].append(record)
+            continue
+        if previous is not None:
+            offset += min(record[1] - previous, max_gap) / speed
+        previous = record[1]
+        batches.append((offset, [record]))
+    return batches
+
+
+def to_line_events(load_test: LoadTest, records: list, vocabulary: dict) -> list:
+    """記録のイベントからLINEのWebhookイベントを組み立てる（ユーザーは記録のハッシュごとに別人）"""
+    events = []
+    image_sets = {}
+    for _, _, user, kind, arg in records:
+        user_id = f"Ureplay{user}"
+        if kind == "image":
+            message = {"type": "image", "id": uuid.uuid4().hex[:12], "contentProvider": {"type": "line"}}
+            if arg:
+                index, total = arg
+                message["imageSet"] = {"id": image_sets.setdefault(user, uuid.uuid4().hex), "index": index, "total": total}
+            events.append(load_test.message_event(user_id, message))
+        elif kind == "text":
+            if arg in vocabulary:
+                text = vocabulary[arg]
+            else:
+                length = int(arg.split(":", 1)[1]) if arg.startswith("custom:") else len(CUSTOM_FILLER)
+                text = (CUSTOM_FILLER * (length // len(CUSTOM_FILLER) + 1))[:max(1, length)]
+            events.append(load_test.message_event(user_id, {"type": "text", "id": uuid.uuid4().hex[:10], "text": text}))
+        elif kind == "follow":
+            event = load_test.message_event(user_id, {})
+            event["type"] = "follow"
+            del event["message"]
+            events.append(event)
+    return events
+
+
+def summarize(records: list) -> dict:
+    """ジョブの所要時間・最初の画像まで・モデルの生成時間・外部APIのレイテンシ"""
+    jobs = {}
+    models = {}
+    upstream = {}
+    for record in records:
+        if record[0] == "job":
+            _, _, _, name, mode, seconds, first_image, outcome = record
+            job = jobs.setdefault(f"{name}:{mode}", {"duration": [], "first_image": [], "outcomes": Counter()})
+            job["duration"].append(seconds)
+            if first_image is not None:
+                job["first_image"].append(first_image)
+            job["outcomes"][outcome] += 1
+        elif record[0] == "model":
+            models.setdefault(record[2], []).append(record[3])
+        elif record[0] == "up":
+            upstream.setdefault(record[2], []).append(record[3])
+    return {
+        "jobs": {
+            key: {
+                "count": len(job["duration"]),
+                "duration": latency_summary(job["duration"]),
+                "first_image": latency_summary(job["first_image"]),
+                "outcomes": dict(job["outcomes"]),
+            }
+            for key, job in sorted(jobs.items())
+        },
+        "models": {model: latency_summary(values) for model, values in sorted(models.items())},
+        "upstream": {name: latency_summary(values) for name, values in sorted(upstream.items())},
+    }
+
+
+async def wait_idle(app_url: str, timeout: float):
+    """実行中のジョブがなくなるまで待つ"""
+    deadline = time.monotonic() + timeout
+    idle_polls = 0
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        while time.monotonic() < deadline:
+            ready = (await client.get(f"{app_url}/ready")).json()
+            jobs = (await client.get(f"{app_url}/debug/jobs", params={"limit": 50},
+                                     headers={"X-Debug-Token": BENCH_DEBUG_TOKEN})).json()["jobs"]
+            running = ready["in_flight"] + sum(1 for job in jobs if job["status"] == "running")
+            idle_polls = idle_polls + 1 if running == 0 else 0
+            if idle_polls >= 3:
+                return
+            await asyncio.sleep(1.0)
+    print(f"Drain timed out after {timeout:.0f}s; comparing the jobs finished so far", flush=True)
+
+
+async def main_async(args) -> dict:
+    vocabulary, records = read_records(args.recordings)
+    batches = schedule(records, args.max_gap, args.speed)
+    if not batches:
+        raise SystemExit("Recording has no webhook events")
+
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    profile_path = os.path.join(workdir, "profile.json")
+    with open(profile_path, "w", encoding="utf-8") as f:
+        json.dump(build_profile(records), f)
+    replay_record_path = os.path.join(workdir, "replayed.jsonl")
+
+    args.mock_url = f"http://127.0.0.1:{args.mock_port}"
+    args.app_url = f"http://127.0.0.1:{args.app_port}"
+    args.secret = BENCH_SECRET
+    mock = ServerProcess("bench.mock_upstreams:app", args.mock_port,
+                         {"BENCH_PROFILE": profile_path, "BENCH_SEED": str(args.seed)}, os.path.join(workdir, "mock.log"))
+    app_process = ServerProcess("main:app", args.app_port, {
+        **app_env(args.mock_url, workdir),
+        "WORKLOAD_RECORD_PATH": replay_record_path,
+    }, os.path.join(workdir, "app.log"))
+    servers = [mock, app_process]
+    try:
+        mock.start()
+        await wait_ready(f"{args.mock_url}/_stats")
+        app_process.start()
+        await wait_ready(f"{args.app_url}/health")
+
+        load_test = LoadTest(args)
+        print(f"Replaying {sum(len(events) for _, events in batches)} events over {batches[-1][0]:.0f}s", flush=True)
+        started = time.monotonic()
+        max_lag = 0.0
+        posts = []
+        for offset, events in batches:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            max_lag = max(max_lag, -delay)
+            posts.append(asyncio.create_task(load_test.post_events(to_line_events(load_test, events, vocabulary))))
+        await asyncio.gather(*posts)
+        await wait_idle(args.app_url, args.drain_timeout)
+        wall_time = time.monotonic() - started
+        await load_test.client.aclose()
+    finally:
+        # 終了時にアプリが記録をフラッシュする
+        for server in reversed(servers):
+            server.stop()
+
+    _, replayed = read_records([replay_record_path]) if os.path.exists(replay_record_path) else ({}, [])
+    return {
+        "config": {"recordings": args.recordings, "max_gap": args.max_gap, "speed": args.speed, "seed": args.seed},
+        "events": sum(len(events) for _, events in batches),
+        "webhook_errors": load_test.webhook_errors,
+        "max_schedule_lag": round(max_lag, 3),
+        "wall_time": round(wall_time, 2),
+        "recorded": summarize(records),
+        "replayed": summarize(replayed),
+        "logs": workdir,
+    }
+
+
+def print_report(report: dict):
+    print("\n=== Replay report ===", flush=True)
+    print(f"events: {report['events']}  webhook errors: {report['webhook_errors']}  "
+          f"max schedule lag: {report['max_schedule_lag']}s  wall time: {report['wall_time']}s", flush=True)
+    recorded, replayed = report["recorded"], report["replayed"]
+
+    def row(label: str, before: dict, after: dict):
+        if not before.get("count") and not after.get("count"):
+            return
+        print(f"  {label:32s} recorded n={before.get('count', 0):<5} p50={before.get('p50')} p90={before.get('p90')}"
+              f"  | replayed n={after.get('count', 0):<5} p50={after.get('p50')} p90={after.get('p90')}", flush=True)
+
+    print("jobs (seconds):", flush=True)
+    for key in sorted(set(recorded["jobs"]) | set(replayed["jobs"])):
+        before, after = recorded["jobs"].get(key, {}), replayed["jobs"].get(key, {})
+        row(f"{key} duration", before.get("duration", {}), after.get("duration", {}))
+        row(f"{key} first image", before.get("first_image", {}), after.get("first_image", {}))
+        print(f"  {'':32s} outcomes {before.get('outcomes', {})} | {after.get('outcomes', {})}", flush=True)
+    print("models (seconds):", flush=True)
+    for model in sorted(set(recorded["models"]) | set(replayed["models"])):
+        row(model, recorded["models"].get(model, {}), replayed["models"].get(model, {}))
+    print("upstream (seconds):", flush=True)
+    for name in sorted(set(recorded["upstream"]) | set(replayed["upstream"])):
+        row(name, recorded["upstream"].get(name, {}), replayed["upstream"].get(name, {}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded workload against local mock upstreams")
+    parser.add_argument("recordings", nargs="+", help="記録ファイル（glob可、.gz対応）")
+    parser.add_argument("--max-gap", type=float, default=300.0, help="イベント間の無音区間をこの秒数に詰める")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度（1で記録と同じ）")
+    parser.add_argument("--seed", type=int, default=1, help="モックの乱数シード")
+    parser.add_argument("--drain-timeout", type=float, default=600.0, help="最後のイベント後、ジョブの完了を待つ最大秒数")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--output", default="", help="レポートJSONの出力先")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Report written: {args.output}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
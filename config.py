@@ -14,12 +14,109 @@ class Settings(BaseSettings):
     # KIE.AI
     KIEAI_API_KEY: str = ""
 
+    # 外部APIのベースURL（負荷試験ではローカルのモックに向ける）
+    LINE_API_BASE: str = "https://api.line.me"
+    LINE_DATA_API_BASE: str = "https://api-data.line.me"
+    KIEAI_API_BASE: str = "https://api.kie.ai"
+    KIEAI_UPLOAD_BASE: str = "https://kieai.redpandaai.co"
+    WEBHOOK_SITE_BASE: str = "https://webhook.site"
+
     # Database (Google Sheets or SQLite)
     # DATABASE_URL: str = "sqlite:///./users.db" # No longer used
+    # "sheets": Google Sheetsに直接読み書き
+    # "sqlite": ローカルSQLite（WAL）に読み書きし、Sheetsへは非同期でレプリケーション
+    DATABASE_BACKEND: str = "sheets"
+    SQLITE_PATH: str = ""  # 空なら DATA_DIR/users.db
+    SQLITE_REPLICATION_INTERVAL: float = 2.0
 
     # Google Sheets
     GOOGLE_SHEETS_ID: str = ""
     GOOGLE_SERVICE_ACCOUNT_KEY: str = "./config/service-account.json"
+    # Sheets I/O用スレッドプール（イベントループをブロックしないため）
+    SHEETS_MAX_WORKERS: int = 4
+    SHEETS_CALL_TIMEOUT: float = 15.0
+    # Usage/Galleryの書き込みバッファ（append_rowsでまとめて書き込み）
+    SHEETS_BATCH_SIZE: int = 50
+    SHEETS_FLUSH_INTERVAL: float = 10.0
+    # Sheets APIクォータ（1分あたり・サービスアカウント単位）と再試行
+    SHEETS_READ_QUOTA_PER_MIN: int = 60
+    SHEETS_WRITE_QUOTA_PER_MIN: int = 60
+    SHEETS_MAX_RETRIES: int = 5
+    SHEETS_BASE_BACKOFF: float = 1.0
+    SHEETS_MAX_BACKOFF: float = 32.0
+
+    # 月別使用回数の集計を MonthlySummary シートにも書き出す
+    MONTHLY_SUMMARY_SHEET: bool = False
+
+    # Usersシートの user_id -> 行番号 インデックス
+    USER_INDEX_TTL: float = 600.0          # 定期再読み込み間隔（秒）
+    USER_INDEX_MISS_REFRESH: float = 30.0  # 未登録ユーザー時の再読み込み間隔（秒）
+
+    # ローカルデータ保存先（永続ディスクがあれば /data）
+    DATA_DIR: str = "/data" if os.path.isdir("/data") else "./data"
+
+    # 生成結果画像のミラー（LINEプレビュー用サムネイル）
+    # 公開URL（https://...）が設定されている場合のみ有効
+    PUBLIC_BASE_URL: str = ""
+    RESULT_CACHE_DIR: str = ""  # 空なら DATA_DIR/results
+    RESULT_PREVIEW_SIZE: int = 480
+    RESULT_CACHE_MAX_AGE_DAYS: int = 30
+
+    # ジョブのステージ別トレース
+    TRACE_BUFFER_SIZE: int = 200     # メモリ上に保持する直近ジョブ数
+    TRACE_EXPORT_PATH: str = ""      # 設定するとOTLP互換JSON Linesを追記
+
+    # 負荷の記録（bench/replay.py でリプレイ）。strftime形式で日付ごとのファイルに分けられる（.gz で圧縮）
+    # 例: /data/workload/%Y%m%d.jsonl.gz（空なら記録しない）
+    WORKLOAD_RECORD_PATH: str = ""
+    WORKLOAD_RECORD_FLUSH_INTERVAL: float = 5.0
+
+    # イベントループの遅延監視（しきい値を超えてブロックされたらスタックを記録）
+    LOOP_MONITOR_ENABLED: bool = True
+    LOOP_MONITOR_INTERVAL: float = 0.5
+    LOOP_BLOCK_THRESHOLD: float = 0.25
+
+    # /debug/* エンドポイントのトークン（空なら無効）
+    DEBUG_TOKEN: str = ""
+    # /metrics のBearerトークン（空なら認証なし）
+    METRICS_TOKEN: str = ""
+
+    # 外部API用の共有HTTPクライアントの接続プール
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0  # アイドル接続を保持する秒数
+
+    # 起動時に外部APIのホストへ事前に接続し（DNS解決・TLS）、アイドル中も定期的に接続を保つ
+    WARMUP_ENABLED: bool = True
+    WARMUP_REFRESH_INTERVAL: float = 12.0  # この秒数使われていないホストに軽いリクエストを送る（LINE SDKのkeep-aliveは15秒）
+
+    # クイックプレビュー（最速のモデル1枚だけ先に生成）
+    QUICK_DEFAULT_MODEL: str = "nano-banana-pro"  # 実績が溜まるまで使うモデル
+
+    # 生成後の画像セッション（アップロード済みの写真で続けて指示・「他のパターン」を受け付ける秒数）
+    IMAGE_SESSION_TTL: int = 1800
+
+    # 複数画像（imageSet）の一括生成
+    BATCH_PREPARE_CONCURRENCY: int = 3     # 写真の取得・アップロードの同時実行数
+    BATCH_GENERATION_CONCURRENCY: int = 8  # 1バッチ内の生成の同時実行数
+
+    # ジョブ全体の期限（秒）。超えたら実行中の生成・ポーリングを中止し、届いた分だけ知らせる
+    JOB_DEADLINE: int = 240
+    BATCH_JOB_DEADLINE: int = 600
+
+    # 画像の取得〜前処理〜アップロードに同時に使えるメモリ（MB）。超える分は順番待ち
+    IMAGE_MEMORY_BUDGET_MB: int = 128
+
+    # 受付制御。実行中のジョブがこれ以上なら「混雑中」と返して受け付けない（一括生成は写真の枚数で数える）
+    MAX_INFLIGHT_JOBS: int = 30
+    ADMISSION_DEFAULT_JOB_SECONDS: int = 90  # 待ち時間の目安に使うジョブ所要時間の初期値
+    # 外部API（KIE.AI / webhook.site）のサーキットブレーカー。連続失敗で受付を止め、クールダウン後に再開
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_COOLDOWN: int = 60
+
+    # モデルの適応ルーティング（parse_type ごとの生成時間・成功率から選択）
+    ROUTER_EXPLORATION: float = 0.1      # 実績の少ない・除外中のモデルを試す確率
+    ROUTER_MIN_SUCCESS_RATE: float = 0.5  # これ未満のモデルは他のモデルで置き換える
 
     # 社内用のため利用制限は設定しない（無制限）
     # FREE_MONTHLY_LIMIT: int = 3
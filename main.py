@@ -5,12 +5,18 @@ LINE Bot for AI Architectural Rendering
 import os
 import sys
 import httpx
+import aiohttp
 import hmac
 import hashlib
 import base64
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+import asyncio
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Optional
+from urllib.parse import urlsplit
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Depends
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from linebot.v3.messaging import (
     Configuration,
     AsyncApiClient,
@@ -23,11 +29,28 @@ from linebot.v3.messaging import (
     QuickReplyItem,
     MessageAction,
 )
+from linebot.v3.messaging.exceptions import ApiException
 from linebot.v3.exceptions import InvalidSignatureError
 
 from config import settings
-from services.kie_api import generate_parse_multi
+from services.admission import Reservation, admission
+from services.kie_api import MODELS, HEADER_PROBE_BYTES, estimate_preprocess_bytes, prepare_source, generate_from_url, generate_one
+from services.batch_scheduler import FairScheduler
+from services.job_context import job_registry, JobCancelled, remaining_timeout
+from services.byte_budget import image_budget
+from services.model_router import model_router
 from services.user_db import UserDB
+from services.sqlite_user_db import SQLiteUserDB
+from services.async_user_db import AsyncUserDB
+from services.image_assets import image_assets
+from services.image_cache import result_cache
+from services.tracing import tracer
+from services.workload_recorder import workload_recorder
+from services.http_client import get_http_client, close_http_client, pool_stats, last_used
+from services import metrics
+from services.loop_monitor import loop_monitor
+from services.warmup import upstream_warmer
+from services.profiler import profiler, heap_tracker
 # 社内用のためStripe決済機能は不要
 # from services.stripe_service import stripe_service
 
@@ -37,7 +60,37 @@ def log(message: str):
     sys.stdout.flush()
 
 
-app = FastAPI(title="AI Parse LINE Bot")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動・終了処理"""
+    if settings.LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    workload_recorder.start()
+    removed = await asyncio.to_thread(result_cache.prune)
+    if removed:
+        log(f"Pruned {removed} cached result images")
+    if settings.WARMUP_ENABLED:
+        # 外部APIへの接続を済ませてから受け付ける（遅いホストがあっても起動は止めない）
+        try:
+            await asyncio.wait_for(upstream_warmer.warm_up(), timeout=15.0)
+        except asyncio.TimeoutError:
+            log("Upstream warm-up timed out; continuing startup")
+        upstream_warmer.start()
+    yield
+    await upstream_warmer.stop()
+    # 終了時: 新しいジョブの受付を止める（/ready も503になる）
+    admission.shutting_down = True
+    # Sheets書き込みバッファをフラッシュ
+    log("Shutting down: flushing pending database writes...")
+    await asyncio.to_thread(user_db.shutdown)
+    await close_http_client()
+    await close_line_api_client()
+    await loop_monitor.stop()
+    await asyncio.to_thread(model_router.save)
+    await asyncio.to_thread(workload_recorder.close)
+
+
+app = FastAPI(title="AI Parse LINE Bot", lifespan=lifespan)
 
 # 起動時ログ
 log("=" * 50)
@@ -49,14 +102,104 @@ if os.path.exists('/data'):
 log("=" * 50)
 
 # LINE Bot設定
-configuration = Configuration(access_token=settings.LINE_CHANNEL_ACCESS_TOKEN)
+configuration = Configuration(host=settings.LINE_API_BASE, access_token=settings.LINE_CHANNEL_ACCESS_TOKEN)
+# 共有セッションの同時接続数（SDKの既定値はCPU数×5で、全ジョブで共有するには少ない）
+configuration.connection_pool_maxsize = settings.HTTP_MAX_CONNECTIONS
+
+
+class LineApiClient(AsyncApiClient):
+    """LINE APIクライアント（エラー数をメトリクスに記録）。line_api_client() で1つを共有する"""
+
+    async def close(self):
+        """async with の終わりでは閉じない（共有のため、終了時に close_line_api_client で閉じる）"""
+
+    async def request(self, method, url, *args, **kwargs):
+        last_used[urlsplit(url).hostname] = time.monotonic()
+        try:
+            return await super().request(method, url, *args, **kwargs)
+        except ApiException as e:
+            metrics.line_api_errors.inc(url.split("?")[0].rsplit("/", 1)[-1], str(e.status))
+            raise
+        except Exception:
+            metrics.line_api_errors.inc(url.split("?")[0].rsplit("/", 1)[-1], "network")
+            raise
+
+
+_line_api_client: Optional[LineApiClient] = None
+
+
+def line_api_client() -> LineApiClient:
+    """
+    共有のLINE APIクライアント（初回に作成）
+    SDKの初期化はaiohttpセッションとSSLコンテキストを作る（数十ms）ため、呼び出しごとには作らず
+    接続・DNSキャッシュを使い回す
+    """
+    global _line_api_client
+    if _line_api_client is None or _line_api_client.rest_client.pool_manager.closed:
+        _line_api_client = LineApiClient(configuration)
+    return _line_api_client
+
+
+async def close_line_api_client():
+    global _line_api_client
+    if _line_api_client is not None:
+        await AsyncApiClient.close(_line_api_client)
+        _line_api_client = None
 
-# ユーザーDB
-user_db = UserDB()
+
+async def line_probe(url: str):
+    """LINE SDKの共有セッションで接続を確立（ウォームアップ用）"""
+    response = await line_api_client().rest_client.pool_manager.head(url, timeout=aiohttp.ClientTimeout(total=10))
+    response.release()
+
+
+# ユーザーDB（Sheets I/O は専用スレッドプールで実行）
+if settings.DATABASE_BACKEND == "sqlite":
+    # ローカルSQLiteを正とし、Sheetsへは変更ログから非同期レプリケーション
+    user_db = AsyncUserDB(SQLiteUserDB())
+else:
+    user_db = AsyncUserDB(UserDB())
+
+
+async def sheets_probe(url: str):
+    """Sheets APIへの接続を確立（Sheetsに直接読み書きする構成のみ）"""
+    if not await user_db.ping():
+        raise RuntimeError("Sheets ping failed")
+
+
+# 起動時に事前接続し、アイドル中も接続を保つ外部APIホスト
+upstream_warmer.add("kie", settings.KIEAI_API_BASE)
+upstream_warmer.add("kie_upload", settings.KIEAI_UPLOAD_BASE)
+upstream_warmer.add("webhook", settings.WEBHOOK_SITE_BASE)
+upstream_warmer.add("line_data", settings.LINE_DATA_API_BASE)
+upstream_warmer.add("line", settings.LINE_API_BASE, line_probe)
+if settings.DATABASE_BACKEND != "sqlite":
+    upstream_warmer.add("sheets", "https://sheets.googleapis.com", sheets_probe)
 
 # ユーザーの状態管理（メモリ上、本番はRedis推奨）
 user_states = {}
 
+# スクレイプ時に取得する状態値
+metrics.registry.gauge("parse_pending_sessions", "Users waiting for type selection or prompt input", callback=lambda: len(user_states))
+metrics.registry.gauge("parse_db_queue_depth", "UserDB calls waiting for a worker thread", callback=user_db.queue_depth)
+metrics.registry.gauge("parse_sheets_pending_writes", "Rows not yet written to Google Sheets", callback=user_db.pending_writes)
+metrics.registry.gauge(
+    "parse_http_pool_connections", "Shared upstream HTTP pool connections by state", ["state"],
+    callback=lambda: {(state,): value for state, value in pool_stats().items()}
+)
+
+# タイプ選択のテキスト → parse_type
+PARSE_TYPES = {"外観": "exterior", "内観": "interior", "平面図": "floor_plan"}
+
+# 負荷の記録にそのまま残す定型テキスト（それ以外の指示は文字数だけ記録）
+workload_recorder.set_vocabulary({
+    **{text: f"type:{parse_type}" for text, parse_type in PARSE_TYPES.items()},
+    "OK": "ok",
+    "クイック": "quick",
+    "他のパターン": "more",
+})
+
+
 # Exterior Base Prompt
 EXTERIOR_BASE_PROMPT = """Transform this architectural render into a photorealistic exterior image.
 DO NOT change the building shape, composition, angle, depth, camera position, or perspective lines.
@@ -116,6 +259,16 @@ FLOOR_PLAN_BASE_PROMPT = """Convert this entire floor plan into a photorealistic
 """
 
 
+def build_prompt(parse_type: str, custom_prompt: str) -> str:
+    """parse_type のベースプロンプトにカスタム指示を埋め込む"""
+    if parse_type == "interior":
+        return INTERIOR_BASE_PROMPT.format(custom_prompt=custom_prompt)
+    elif parse_type == "exterior":
+        return EXTERIOR_BASE_PROMPT.format(custom_prompt=custom_prompt)
+    else: # floor_plan
+        return FLOOR_PLAN_BASE_PROMPT.format(custom_prompt=custom_prompt)
+
+
 @app.get("/api/info")
 async def root():
     return {
@@ -123,7 +276,9 @@ async def root():
         "message": "AI Parse LINE Bot is running",
         "version": "2.1", # Version up
         "data_dir_exists": os.path.exists('/data'),
-        "db_path": user_db.db_path if hasattr(user_db, 'db_path') else "Google Sheets"
+        "db_path": user_db.db_path,
+        "sheets": user_db.metrics(),
+        "event_loop": loop_monitor.summary()
     }
 
 # ... (health check and stripe webhook remain same)
@@ -147,39 +302,69 @@ async def handle_text_async(event_data: dict):
 
         # タイプ選択待ち
         if state.get("status") == "waiting_type":
-            if text == "外観":
-                user_states[user_id]["parse_type"] = "exterior"
+            if text in PARSE_TYPES:
+                user_states[user_id]["parse_type"] = PARSE_TYPES[text]
                 user_states[user_id]["status"] = "waiting_prompt"
-                await send_prompt_input_message(user_id, reply_token, "exterior")
-            elif text == "内観":
-                user_states[user_id]["parse_type"] = "interior"
-                user_states[user_id]["status"] = "waiting_prompt"
-                await send_prompt_input_message(user_id, reply_token, "interior")
-            elif text == "平面図":
-                user_states[user_id]["parse_type"] = "floor_plan"
-                user_states[user_id]["status"] = "waiting_prompt"
-                await send_prompt_input_message(user_id, reply_token, "floor_plan")
+                await send_prompt_input_message(user_id, reply_token, PARSE_TYPES[text])
             else:
                 await send_type_selection(user_id, reply_token)
             return
 
         # プロンプト入力待ち
         if state.get("status") == "waiting_prompt":
-            # カスタムプロンプトを取得（OKの場合は空）
-            custom_prompt = "" if text.upper() == "OK" else f"\n・{text}"
-            parse_type = state.get("parse_type", "exterior")
-
-            # 生成開始
-            await process_generation(
-                user_id,
-                state["image_message_id"],
-                parse_type,
-                custom_prompt,
-                reply_token
-            )
-            del user_states[user_id]
+            await start_generation(user_id, state, text, reply_token)
             return
 
+        # 生成後の画像セッション: アップロード済みの写真で続けて生成できる
+        if state.get("status") == "session":
+            if time.time() >= state["expires_at"]:
+                # 期限切れ: 写真から送り直してもらう
+                del user_states[user_id]
+            elif text == "他のパターン":
+                # クイックプレビューの残りのモデルで生成（ボタンの文言を指示として生成し直すことはしない）
+                key = job_key(state, text)
+                remaining = None
+                reservation = None
+                # 実行中の「他のパターン」の連打は合流するだけなので実行枠は増えない
+                if job_registry.joinable(user_id, key) is None:
+                    if not state.get("models"):
+                        await send_type_selection(user_id, reply_token, note="他のパターンはすべて生成済みです。\n同じ写真で別のタイプや指示を試せます。")
+                        return
+                    reservation = await admit_or_reply_busy(user_id, reply_token, text)
+                    if reservation is None:
+                        return
+                    remaining = state.pop("models")
+
+                async def run_more():
+                    with admission.admitted(reservation):
+                        await process_generation(
+                            user_id,
+                            state["image_message_id"],
+                            state["parse_type"],
+                            state["custom_prompt"],
+                            reply_token,
+                            models=model_router.plan(state["parse_type"], remaining, len(remaining)),
+                            image_url=state["image_url"],
+                            mode="more"
+                        )
+
+                try:
+                    await job_registry.run(user_id, key, run_more)
+                finally:
+                    release_unused(reservation)
+                state["expires_at"] = time.time() + settings.IMAGE_SESSION_TTL
+                return
+            elif text in PARSE_TYPES:
+                # 同じ写真でタイプを変更
+                state["parse_type"] = PARSE_TYPES[text]
+                state["status"] = "waiting_prompt"
+                await send_prompt_input_message(user_id, reply_token, state["parse_type"])
+                return
+            else:
+                # 新しい指示で再生成
+                await start_generation(user_id, state, text, reply_token)
+                return
+
         # その他
         await send_prompt_image_message(user_id, reply_token)
     except Exception as e:
@@ -188,19 +373,163 @@ async def handle_text_async(event_data: dict):
         traceback.print_exc()
 
 
+async def admit_or_reply_busy(user_id: str, reply_token: str, text: str, weight: int = 1) -> Optional[Reservation]:
+    """
+    受付制御: 受け付けたら実行枠を返す。混雑中・外部APIの障害中なら待ち時間の目安と再試行ボタンを返信して None
+    （状態は変えないので、再試行ボタンで同じ指示をそのまま送り直せる）
+    """
+    reservation, rejection = admission.reserve(weight)
+    if reservation is not None:
+        return reservation
+
+    log(f"Admission rejected for user {user_id}: {rejection.reason} (wait ~{rejection.wait_minutes} min)")
+    if rejection.reason == "upstream":
+        text_body = "⚠️ 画像生成サービスが一時的に不安定です。"
+    else:
+        text_body = "⏳ ただいま混み合っています。"
+    try:
+        async with line_api_client() as api_client:
+            api = AsyncMessagingApi(api_client)
+            await api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[
+                        TextMessage(
+                            text=f"{text_body}\n推定待ち時間: 約{rejection.wait_minutes}分\n\n"
+                                 "少し時間をおいて「再試行」を押してください。",
+                            quick_reply=QuickReply(items=[
+                                QuickReplyItem(action=MessageAction(label="再試行", text=text[:300]))
+                            ])
+                        )
+                    ]
+                )
+            )
+    except Exception as e:
+        log(f"Failed to send busy message: {e}")
+    return None
+
+
+def release_unused(reservation: Optional[Reservation]):
+    """ジョブを始めずに終わった場合（実行中のジョブに合流した・開始前に取り消された）に実行枠を返す"""
+    if reservation is not None:
+        reservation.release()
+
+
+def job_key(state: dict, text: str) -> tuple:
+    """同じ生成の再要求（連打）かを判定するキー: (写真, タイプ, 指示)"""
+    image_message_ids = state.get("image_message_ids")
+    images = tuple(image_message_ids[i] for i in sorted(image_message_ids)) if image_message_ids else (state["image_message_id"],)
+    return images, state.get("parse_type", "exterior"), text
+
+
+async def start_generation(user_id: str, state: dict, text: str, reply_token: str):
+    """
+    プロンプトを受けて生成を開始し、終了後は画像セッションとして状態を残す
+    （セッション中はアップロード済みの元画像URLを使い、LINEからの取得・前処理・アップロードを省略する）
+    """
+    parse_type = state.get("parse_type", "exterior")
+    key = job_key(state, text)
+
+    # 複数画像（imageSet）はまとめて生成（セッションは残さない）
+    image_message_ids = [state["image_message_ids"][i] for i in sorted(state.get("image_message_ids", {}))]
+    # 同じ指示の連打は実行中のジョブに合流するだけなので実行枠は増えない
+    reservation = None
+    if job_registry.joinable(user_id, key) is None:
+        reservation = await admit_or_reply_busy(user_id, reply_token, text, max(1, len(image_message_ids)))
+        if reservation is None:
+            return
+    if len(image_message_ids) > 1:
+        quick = text == "クイック"
+        custom_prompt = "" if quick or text.upper() == "OK" else f"\n・{text}"
+
+        async def run_batch():
+            with admission.admitted(reservation):
+                await process_batch_generation(user_id, image_message_ids, parse_type, custom_prompt, reply_token, quick)
+
+        try:
+            _, joined = await job_registry.run(user_id, key, run_batch)
+        finally:
+            release_unused(reservation)
+        if not joined and user_states.get(user_id) is state and job_registry.current(user_id) is None:
+            del user_states[user_id]
+        return
+
+    def keep_source(image_url: str):
+        # アップロード完了時点で記録（生成中に次の指示が来ても再アップロードしない）
+        if user_states.get(user_id) is state:
+            state["image_url"] = image_url
+            state["uploaded_at"] = time.time()
+
+    if text == "クイック":
+        # クイックプレビュー: 最速のモデル1つだけで生成し、残りは後から選べるようにする
+        model = model_router.fastest(parse_type, MODELS)
+        custom_prompt = ""
+        models = [model]
+        remaining = [m for m in MODELS if m != model]
+        mode = "quick"
+    else:
+        # カスタムプロンプトを取得（OKの場合は空）
+        custom_prompt = "" if text.upper() == "OK" else f"\n・{text}"
+        models = None
+        remaining = []
+        mode = "full"
+
+    async def run_single():
+        with admission.admitted(reservation):
+            return await process_generation(
+                user_id,
+                state["image_message_id"],
+                parse_type,
+                custom_prompt,
+                reply_token,
+                models=models,
+                image_url=state.get("image_url"),
+                mode=mode,
+                on_source=keep_source
+            )
+
+    try:
+        image_url, joined = await job_registry.run(user_id, key, run_single)
+    finally:
+        release_unused(reservation)
+
+    # 合流した場合のセッションは最初の要求の側で残す
+    # 生成中に新しい写真が送られた・新しいジョブに置き換えられた場合はそちらを優先
+    if joined or user_states.get(user_id) is not state or job_registry.current(user_id) is not None:
+        return
+    if not image_url:
+        del user_states[user_id]
+        return
+    user_states[user_id] = {
+        "status": "session",
+        "image_message_id": state["image_message_id"],
+        "parse_type": parse_type,
+        "custom_prompt": custom_prompt,
+        "image_url": image_url,
+        "uploaded_at": state.get("uploaded_at", time.time()),
+        "models": remaining,
+        "expires_at": time.time() + settings.IMAGE_SESSION_TTL
+    }
+
+
 # ... (send_welcome_message remains same)
 
-async def send_type_selection(user_id: str, reply_token: str):
-    """タイプ選択メッセージ送信"""
-    async with AsyncApiClient(configuration) as api_client:
+async def send_type_selection(user_id: str, reply_token: str, image_count: int = 1, note: str = ""):
+    """タイプ選択メッセージ送信（image_count: まとめて送られた写真の枚数、note: 先頭に添える案内）"""
+    async with line_api_client() as api_client:
         api = AsyncMessagingApi(api_client)
 
+        text = "生成するタイプを選んでください。"
+        if image_count > 1:
+            text = f"{image_count}枚の写真を受け付けました。\n全ての写真をまとめて生成します。\n\n" + text
+        if note:
+            text = f"{note}\n\n" + text
         await api.reply_message(
             ReplyMessageRequest(
                 reply_token=reply_token,
                 messages=[
                     TextMessage(
-                        text="生成するタイプを選んでください。",
+                        text=text,
                         quick_reply=QuickReply(
                             items=[
                                 QuickReplyItem(
@@ -231,7 +560,7 @@ async def send_type_selection(user_id: str, reply_token: str):
 
 async def send_prompt_input_message(user_id: str, reply_token: str, parse_type: str):
     """カスタムプロンプト入力メッセージ送信"""
-    async with AsyncApiClient(configuration) as api_client:
+    async with line_api_client() as api_client:
         api = AsyncMessagingApi(api_client)
 
         if parse_type == "exterior":
@@ -243,6 +572,7 @@ async def send_prompt_input_message(user_id: str, reply_token: str, parse_type:
                            "そのまま生成する場合は「OK」と送信してください。")
             quick_reply_items = [
                 QuickReplyItem(action=MessageAction(label="そのまま生成", text="OK")),
+                QuickReplyItem(action=MessageAction(label="クイック生成", text="クイック")),
                 QuickReplyItem(action=MessageAction(label="モダン", text="モダンな雰囲気で")),
                 QuickReplyItem(action=MessageAction(label="和風", text="和風テイストで")),
             ]
@@ -255,6 +585,7 @@ async def send_prompt_input_message(user_id: str, reply_token: str, parse_type:
                            "そのまま生成する場合は「OK」と送信してください。")
             quick_reply_items = [
                 QuickReplyItem(action=MessageAction(label="そのまま生成", text="OK")),
+                QuickReplyItem(action=MessageAction(label="クイック生成", text="クイック")),
                 QuickReplyItem(action=MessageAction(label="モダン", text="モダンな雰囲気で")),
                 QuickReplyItem(action=MessageAction(label="北欧風", text="北欧風インテリアで")),
             ]
@@ -267,6 +598,7 @@ async def send_prompt_input_message(user_id: str, reply_token: str, parse_type:
                            "そのまま生成する場合は「OK」と送信してください。")
             quick_reply_items = [
                 QuickReplyItem(action=MessageAction(label="そのまま生成", text="OK")),
+                QuickReplyItem(action=MessageAction(label="クイック生成", text="クイック")),
                 QuickReplyItem(action=MessageAction(label="ナチュラル", text="木目でナチュラルな雰囲気に")),
                 QuickReplyItem(action=MessageAction(label="シック", text="モノトーンでシックな雰囲気に")),
             ]
@@ -285,78 +617,358 @@ async def send_prompt_input_message(user_id: str, reply_token: str, parse_type:
 
 # ... (send_prompt_image_message, send_limit_reached_message remain same)
 
-async def process_generation(user_id: str, image_message_id: str, parse_type: str, custom_prompt: str, reply_token: str):
-    """画像生成処理"""
-    async with AsyncApiClient(configuration) as api_client:
+async def process_generation(user_id: str, image_message_id: str, parse_type: str, custom_prompt: str, reply_token: str,
+                             models: Optional[list] = None, image_url: Optional[str] = None, mode: str = "full",
+                             on_source=None) -> Optional[str]:
+    """
+    画像生成処理
+
+    Args:
+        models: 使用するモデル（省略時は model_router が parse_type の実績から選ぶ）
+        image_url: アップロード済みの元画像URL（あればLINEからの取得とアップロードを省略）
+        mode: full / quick（最速モデル1枚のプレビュー） / more（プレビュー後の残りのモデル）
+        on_source: 元画像のアップロード完了時に呼ばれる関数 on_source(image_url)
+
+    Returns:
+        アップロード済みの元画像URL（失敗時はNone）
+    """
+    models = models or model_router.plan(parse_type, MODELS, len(MODELS))
+    async with line_api_client() as api_client:
         api = AsyncMessagingApi(api_client)
 
-        # 処理開始メッセージ
-        await api.reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[
-                    TextMessage(text="✨ 4枚の画像を生成中です...\n⏱️ 1〜3分程度かかります\n📸 完成した画像から順次お届けします！")
-                ]
-            )
-        )
+        with tracer.job("generation", user_id=user_id, parse_type=parse_type, mode=mode) as job, metrics.jobs_in_flight.track():
+            log(f"Generation job {job.job_id} started for user: {user_id} (mode={mode}, models={models})")
+            outcome = "failed"
 
-        try:
-            # LINE から画像を取得
-            image_content = await get_line_image(image_message_id)
-
-            # プロンプト生成
-            if parse_type == "interior":
-                prompt = INTERIOR_BASE_PROMPT.format(custom_prompt=custom_prompt)
-                type_name = "内観"
-            elif parse_type == "exterior":
-                prompt = EXTERIOR_BASE_PROMPT.format(custom_prompt=custom_prompt)
-                type_name = "外観"
-            else: # floor_plan
-                prompt = FLOOR_PLAN_BASE_PROMPT.format(custom_prompt=custom_prompt)
-                type_name = "平面図"
-            
-            # コールバック関数: 1枚生成されるたびに送信＆ギャラリーに保存
-            async def send_image_callback(index, url):
-                if url:
-                    # LINE に送信
-                    await api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[
-                                ImageMessage(
-                                    original_content_url=url,
-                                    preview_image_url=url
+            # 処理開始メッセージ
+            if mode == "quick":
+                start_text = "⚡ プレビューを1枚生成中です...\n⏱️ 20秒〜1分程度かかります"
+            elif mode == "more":
+                start_text = f"✨ 残り{len(models)}枚の画像を生成中です...\n📸 完成した画像から順次お届けします！"
+            else:
+                start_text = f"✨ {len(models)}枚の画像を生成中です...\n⏱️ 1〜3分程度かかります\n📸 完成した画像から順次お届けします！"
+            if mode != "more":
+                start_text += f"\n\n💡 {settings.IMAGE_SESSION_TTL // 60}分以内なら、続けて指示を送ると同じ写真で再生成します"
+            delivered = []
+            try:
+                # ジョブ全体の期限（同じユーザーの実行中のジョブはここで取り消される）
+                async with job_registry.scope(user_id, settings.JOB_DEADLINE):
+                    with tracer.span("line.reply"):
+                        await api.reply_message(
+                            ReplyMessageRequest(
+                                reply_token=reply_token,
+                                messages=[TextMessage(text=start_text)]
+                            )
+                        )
+
+                    try:
+                        if not image_url:
+                            # LINE から画像を取得し、前処理してKIE.AIにアップロード（元画像はアップロード後に解放）
+                            image_url = await fetch_source(image_message_id)
+                            if not image_url:
+                                raise RuntimeError("Image upload failed")
+                            if on_source:
+                                on_source(image_url)
+                        else:
+                            job.root.set_attribute("reused_source", True)
+
+                        # プロンプト生成
+                        prompt = build_prompt(parse_type, custom_prompt)
+
+                        # コールバック関数: 1枚生成されるたびに送信＆ギャラリーに保存
+                        async def send_image_callback(index, url):
+                            if url:
+                                # 結果画像をミラーして軽量プレビューを生成（無効・失敗時は元URLのまま）
+                                with tracer.span("result.mirror", index=index):
+                                    original_url, preview_url = await result_cache.mirror(url) or (url, url)
+
+                                # LINE に送信
+                                with tracer.span("line.push", index=index):
+                                    await api.push_message(
+                                        PushMessageRequest(
+                                            to=user_id,
+                                            messages=[
+                                                ImageMessage(
+                                                    original_content_url=original_url,
+                                                    preview_image_url=preview_url
+                                                )
+                                            ]
+                                        )
+                                    )
+                                delivered.append(original_url)
+                                # ギャラリーに保存（ミラーは RESULT_CACHE_MAX_AGE_DAYS で消えるキャッシュなので、KIE.AIの結果URLを記録）
+                                await user_db.save_to_gallery(
+                                    user_id=user_id,
+                                    parse_type=parse_type,
+                                    custom_prompt=custom_prompt,
+                                    image_url=url,
+                                    original_image_id=image_message_id
                                 )
-                            ]
+
+                        # 生成実行
+                        urls = await generate_from_url(image_url, prompt, models, parse_type, send_image_callback)
+
+                        succeeded = sum(1 for url in urls if url)
+                        job.root.set_attribute("succeeded", succeeded)
+                        if succeeded == 0:
+                            # 全モデル失敗（ユーザーへの通知はこれまで通り行わず、トレースとメトリクスにだけ残す）
+                            job.root.fail("All generations failed")
+                        else:
+                            # 使用回数をカウント（統計目的のみ）
+                            await user_db.increment_usage(user_id)
+                            outcome = "completed" if succeeded == len(urls) else "partial"
+
+                        # 社内用のため残り回数に応じたメッセージ送信は行わない（無制限のため）
+                        # 完了メッセージは既に送信されているため、追加の通知は不要
+                        if mode == "quick" and succeeded:
+                            # 残りのモデルで追加生成するか選んでもらう
+                            await api.push_message(
+                                PushMessageRequest(
+                                    to=user_id,
+                                    messages=[
+                                        TextMessage(
+                                            text=f"プレビューをお届けしました。\n別のモデルで{len(MODELS) - len(models)}パターン追加生成できます。",
+                                            quick_reply=QuickReply(items=[
+                                                QuickReplyItem(action=MessageAction(label="他のパターンも生成", text="他のパターン")),
+                                            ])
+                                        )
+                                    ]
+                                )
+                            )
+
+                    except Exception as e:
+                        log(f"Process generation error: {e}")
+                        job.root.fail(str(e))
+                        image_url = None
+                        await api.push_message(
+                            PushMessageRequest(
+                                to=user_id,
+                                messages=[TextMessage(text="申し訳ありません。画像生成中にエラーが発生しました。")]
+                            )
                         )
-                    )
-                    # ギャラリーに保存
-                    user_db.save_to_gallery(
-                        user_id=user_id,
-                        parse_type=parse_type,
-                        custom_prompt=custom_prompt,
-                        image_url=url,
-                        original_image_id=image_message_id
-                    )
 
-            # 生成実行
-            # services/kie_api.py の generate_parse_multi を呼び出す
-            await generate_parse_multi(image_content, prompt, count=4, callback=send_image_callback)
+            except JobCancelled as e:
+                # 期限切れ・新しいジョブへの置き換え: 実行中の生成・ポーリングは取り消し済み
+                log(f"Generation job {job.job_id} {e.reason}: {len(delivered)}/{len(models)} delivered")
+                job.root.fail(e.reason)
+                job.root.set_attribute("succeeded", len(delivered))
+                outcome = "partial" if delivered else "cancelled"
+                if e.reason == "deadline":
+                    text = (f"{len(models)}枚中{len(delivered)}枚の画像をお届けしました。\n（時間内に生成できなかった分は中止しました）"
+                            if delivered else "申し訳ありません。時間内に画像を生成できませんでした。")
+                    await api.push_message(PushMessageRequest(to=user_id, messages=[TextMessage(text=text)]))
+
+            job.root.set_attribute("outcome", outcome)
+            metrics.jobs_total.inc(outcome)
+            log(f"Generation job {job.job_id} finished: {job.stage_totals()}")
+            return image_url
+
+
+async def process_batch_generation(user_id: str, image_message_ids: list, parse_type: str, custom_prompt: str,
+                                   reply_token: str, quick: bool = False):
+    """
+    複数画像（imageSet）の一括生成
+    写真の取得・アップロードは同時実行数を制限して並行し、アップロードできた写真から順に
+    生成を FairScheduler に投入する。結果は写真ごとにまとめて送信する
+
+    Args:
+        image_message_ids: 写真のメッセージID（送信順）
+        quick: 写真ごとに最速のモデル1枚だけ生成する
+    """
+    models = model_router.plan(parse_type, MODELS, 1 if quick else len(MODELS))
+    total = len(image_message_ids)
+    async with line_api_client() as api_client:
+        api = AsyncMessagingApi(api_client)
 
-            # 使用回数をカウント（統計目的のみ）
-            user_db.increment_usage(user_id)
+        with tracer.job("batch_generation", user_id=user_id, parse_type=parse_type, sources=total, mode="quick" if quick else "full") as job, metrics.jobs_in_flight.track():
+            log(f"Batch job {job.job_id} started for user: {user_id} ({total} images x {len(models)} models)")
+            outcome = "failed"
+
+            delivered = []
+            expected = total * len(models)
+            try:
+                # ジョブ全体の期限（同じユーザーの実行中のジョブはここで取り消される）
+                async with job_registry.scope(user_id, settings.BATCH_JOB_DEADLINE):
+                    with tracer.span("line.reply"):
+                        await api.reply_message(
+                            ReplyMessageRequest(
+                                reply_token=reply_token,
+                                messages=[TextMessage(text=f"✨ {total}枚の写真から{expected}枚の画像を生成中です...\n📸 写真ごとにまとめてお届けします！")]
+                            )
+                        )
 
-            # 社内用のため残り回数に応じたメッセージ送信は行わない（無制限のため）
-            # 完了メッセージは既に送信されているため、追加の通知は不要
+                    prompt = build_prompt(parse_type, custom_prompt)
+                    prepare_limit = asyncio.Semaphore(settings.BATCH_PREPARE_CONCURRENCY)
+                    scheduler = FairScheduler(settings.BATCH_GENERATION_CONCURRENCY)
+
+                    async def deliver(number: int, message_id: str, urls: list):
+                        """1枚の写真の結果をまとめて送信（1リクエスト最大5メッセージ）"""
+                        messages = [TextMessage(text=f"📷 {number}枚目の写真（全{total}枚）")]
+                        for index, url in enumerate(urls):
+                            with tracer.span("result.mirror", source=number, index=index):
+                                original_url, preview_url = await result_cache.mirror(url) or (url, url)
+                            messages.append(ImageMessage(original_content_url=original_url, preview_image_url=preview_url))
+                            await user_db.save_to_gallery(
+                                user_id=user_id,
+                                parse_type=parse_type,
+                                custom_prompt=custom_prompt,
+                                image_url=url,
+                                original_image_id=message_id
+                            )
+                        with tracer.span("line.push", source=number):
+                            for i in range(0, len(messages), 5):
+                                await api.push_message(PushMessageRequest(to=user_id, messages=messages[i:i + 5]))
+                        delivered.extend(urls)
+
+                    async def run_source(number: int, message_id: str) -> int:
+                        """1枚の写真: 取得 → アップロード → 全モデルで生成 → まとめて送信"""
+                        try:
+                            async with prepare_limit:
+                                image_url = await fetch_source(message_id)
+                            if not image_url:
+                                return 0
+                            futures = [
+                                scheduler.submit(number, lambda model=model, slot=models[:i].count(model): generate_one(image_url, prompt, model, parse_type, slot))
+                                for i, model in enumerate(models)
+                            ]
+                            results = await asyncio.gather(*futures, return_exceptions=True)
+                            urls = [url for url in results if isinstance(url, str)]
+                            if urls:
+                                await deliver(number, message_id, urls)
+                            return len(urls)
+                        except Exception as e:
+                            log(f"Batch source {number} error: {e}")
+                            return 0
+
+                    # 全ての写真を並行処理（ジョブが取り消されたら残りの写真の処理もまとめて取り消される）
+                    async with asyncio.TaskGroup() as group:
+                        sources = [group.create_task(run_source(i + 1, message_id)) for i, message_id in enumerate(image_message_ids)]
+                    succeeded = sum(task.result() for task in sources)
+                    job.root.set_attribute("succeeded", succeeded)
+
+                    if succeeded == 0:
+                        # 1枚の場合と同じく、全て失敗した場合の通知はしない
+                        job.root.fail("All generations failed")
+                    else:
+                        await user_db.increment_usage(user_id)
+                        outcome = "completed" if succeeded == expected else "partial"
+                        await api.push_message(PushMessageRequest(
+                            to=user_id, messages=[TextMessage(text=f"✅ {total}枚の写真から{succeeded}枚の画像を生成しました。")]
+                        ))
+
+            except JobCancelled as e:
+                # 期限切れ・新しいジョブへの置き換え: 送信済みの写真の分だけ知らせる
+                log(f"Batch job {job.job_id} {e.reason}: {len(delivered)}/{expected} delivered")
+                job.root.fail(e.reason)
+                job.root.set_attribute("succeeded", len(delivered))
+                outcome = "partial" if delivered else "cancelled"
+                if e.reason == "deadline":
+                    text = (f"{expected}枚中{len(delivered)}枚の画像をお届けしました。\n（時間内に生成できなかった分は中止しました）"
+                            if delivered else "申し訳ありません。時間内に画像を生成できませんでした。")
+                    await api.push_message(PushMessageRequest(to=user_id, messages=[TextMessage(text=text)]))
+
+            job.root.set_attribute("outcome", outcome)
+            metrics.jobs_total.inc(outcome)
+            log(f"Batch job {job.job_id} finished: {job.stage_totals()}")
+
+
+def require_debug_token(request: Request):
+    """/debug/* 用のトークン検証（DEBUG_TOKEN未設定なら無効）"""
+    token = request.headers.get("X-Debug-Token") or request.query_params.get("token", "")
+    if not settings.DEBUG_TOKEN or not hmac.compare_digest(token, settings.DEBUG_TOKEN):
+        raise HTTPException(status_code=404, detail="Not found")
+
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """Prometheus形式のメトリクス"""
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/jobs", dependencies=[Depends(require_debug_token)])
+async def debug_jobs(limit: int = 50):
+    """直近のジョブ一覧"""
+    return {"jobs": tracer.recent(limit)}
+
+
+@app.get("/debug/models", dependencies=[Depends(require_debug_token)])
+async def debug_models():
+    """(model, parse_type) ごとの生成時間・成功率と現在の選択順"""
+    return {
+        "stats": model_router.summary(),
+        "ranking": {parse_type: model_router.ranking(parse_type, MODELS) for parse_type in ("exterior", "interior", "floor_plan")}
+    }
 
-        except Exception as e:
-            log(f"Process generation error: {e}")
-            await api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text="申し訳ありません。画像生成中にエラーが発生しました。")]
-                )
-            )
+
+@app.get("/debug/upstreams", dependencies=[Depends(require_debug_token)])
+async def debug_upstreams():
+    """外部APIホストの起動時ウォームアップの所要時間・アイドル時間と接続プールの状態"""
+    return {"hosts": upstream_warmer.summary(), "pool": pool_stats()}
+
+
+@app.get("/debug/loop", dependencies=[Depends(require_debug_token)])
+async def debug_loop():
+    """イベントループの遅延とブロッキング検出の記録"""
+    return {"summary": loop_monitor.summary(), "stalls": loop_monitor.recent_stalls()}
+
+
+@app.get("/debug/profile", dependencies=[Depends(require_debug_token)])
+async def debug_profile(seconds: float = 10.0, interval: float = 0.005, idle: bool = False, kind: str = "cpu", format: str = "collapsed"):
+    """
+    サンプリングプロファイル（seconds秒間）
+    kind=cpu: スレッドのスタック / kind=async: タスクのawait先
+    format=collapsed: speedscope / flamegraph.pl 用のダウンロード、format=json: 上位の関数
+    """
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="Profile already running")
+    if kind not in ("cpu", "async"):
+        raise HTTPException(status_code=400, detail="kind must be cpu or async")
+    report = await profiler.profile(seconds, interval, include_idle=idle)
+    if format == "json":
+        return report.to_dict()
+    filename = f"profile-{kind}-{int(report.started_at)}.collapsed.txt"
+    return PlainTextResponse(
+        report.collapsed(kind),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.post("/debug/heap/start", dependencies=[Depends(require_debug_token)])
+async def debug_heap_start(frames: int = 10):
+    """tracemallocを開始し、比較の基準となるスナップショットを取る"""
+    return await asyncio.to_thread(heap_tracker.start, max(1, min(frames, 50)))
+
+
+@app.post("/debug/heap/stop", dependencies=[Depends(require_debug_token)])
+async def debug_heap_stop():
+    return heap_tracker.stop()
+
+
+@app.get("/debug/heap", dependencies=[Depends(require_debug_token)])
+async def debug_heap(limit: int = 25, group_by: str = "lineno", min_block_kb: int = 256):
+    """スナップショットを取り、前回との差分と大きなブロックの確保元をダウンロード"""
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by must be lineno, filename or traceback")
+    report = await asyncio.to_thread(heap_tracker.report, limit, group_by, min_block_kb * 1024)
+    if report is None:
+        raise HTTPException(status_code=409, detail="tracemalloc is not running (POST /debug/heap/start first)")
+    return PlainTextResponse(
+        report,
+        headers={"Content-Disposition": f'attachment; filename="heap-{int(time.time())}.txt"'}
+    )
+
+
+@app.get("/debug/jobs/{job_id}", dependencies=[Depends(require_debug_token)])
+async def debug_job(job_id: str):
+    """ジョブのステージ別タイムライン"""
+    trace = tracer.get(job_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return trace.to_dict()
 
 
 @app.get("/health")
@@ -369,6 +981,45 @@ async def health():
     }
 
 
+@app.get("/ready")
+async def ready():
+    """レディネス（ロードバランサー向け）: 混雑中・外部APIの障害中・終了処理中は503"""
+    ok, reason = admission.ready()
+    return JSONResponse(
+        status_code=200 if ok else 503,
+        content={"ready": ok, "reason": reason, **admission.summary()}
+    )
+
+
+@app.get("/images/{image_path:path}")
+async def homepage_image(image_path: str, request: Request, w: int = 0):
+    """ホームページ画像（Acceptヘッダーと ?w= に応じてAVIF/WebP・縮小版を配信）"""
+    path = image_assets.select(f"images/{image_path}", request.headers.get("accept", ""), w or None)
+    if not path:
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(
+        path,
+        media_type=image_assets.media_type(path),
+        headers={
+            "Cache-Control": "public, max-age=86400",
+            "Vary": "Accept",
+        }
+    )
+
+
+@app.get("/results/{filename}")
+async def result_image(filename: str):
+    """ミラーした生成結果画像・プレビュー"""
+    path = result_cache.path_for(filename)
+    if not path:
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(
+        path,
+        media_type=image_assets.media_type(path),
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+
 # 社内用のためStripe Webhookエンドポイントは不要（削除）
 # @app.post("/stripe-webhook")
 # async def stripe_webhook(request: Request):
@@ -421,6 +1072,7 @@ async def handle_events_async(body: str, signature: str):
     try:
         events_data = json.loads(body)
         log(f"Events data parsed: {len(events_data.get('events', []))} events")
+        workload_recorder.record_events(events_data.get("events", []))
 
         for event_data in events_data.get("events", []):
             event_type = event_data.get("type")
@@ -447,7 +1099,7 @@ async def handle_follow_async(event_data: dict):
     reply_token = event_data["replyToken"]
 
     # ユーザー登録
-    user_db.create_user(user_id)
+    await user_db.create_user(user_id)
 
     # ウェルカムメッセージ
     await send_welcome_message(user_id, reply_token)
@@ -468,16 +1120,29 @@ async def handle_image_async(event_data: dict):
         #     await send_limit_reached_message(user_id, reply_token)
         #     return
 
+        # 複数画像をまとめて送った場合（imageSet）は1つのバッチにまとめる
+        image_set = event_data["message"].get("imageSet")
+        if image_set:
+            state = user_states.get(user_id)
+            if state and state.get("image_set_id") == image_set["id"]:
+                # 受付済みのセットの続き: 画像を追加するだけ（タイプ選択は最初の1枚で返信済み）
+                state["image_message_ids"][image_set.get("index", len(state["image_message_ids"]) + 1)] = message_id
+                log(f"Image set {image_set['id']}: {len(state['image_message_ids'])}/{image_set.get('total')}")
+                return
+
         # 画像を保存して状態を更新
         user_states[user_id] = {
             "image_message_id": message_id,
             "status": "waiting_type"  # 内観/外観選択待ち
         }
+        if image_set:
+            user_states[user_id]["image_set_id"] = image_set["id"]
+            user_states[user_id]["image_message_ids"] = {image_set.get("index", 1): message_id}
 
         log(f"User state updated: {user_states[user_id]}")
 
         # 内観/外観選択を促す
-        await send_type_selection(user_id, reply_token)
+        await send_type_selection(user_id, reply_token, image_set.get("total", 1) if image_set else 1)
     except Exception as e:
         log(f"Error in handle_image_async: {e}")
         import traceback
@@ -486,7 +1151,7 @@ async def handle_image_async(event_data: dict):
 
 async def send_welcome_message(user_id: str, reply_token: str):
     """ウェルカムメッセージ送信"""
-    async with AsyncApiClient(configuration) as api_client:
+    async with line_api_client() as api_client:
         api = AsyncMessagingApi(api_client)
 
         await api.reply_message(
@@ -515,7 +1180,7 @@ async def send_welcome_message(user_id: str, reply_token: str):
 
 async def send_prompt_image_message(user_id: str, reply_token: str):
     """画像送信を促すメッセージ"""
-    async with AsyncApiClient(configuration) as api_client:
+    async with line_api_client() as api_client:
         api = AsyncMessagingApi(api_client)
 
         await api.reply_message(
@@ -539,15 +1204,58 @@ async def send_prompt_image_message(user_id: str, reply_token: str):
 
 
 
-async def get_line_image(message_id: str) -> bytes:
-    """LINEから画像を取得"""
-    url = f"https://api-data.line.me/v2/bot/message/{message_id}/content"
+async def fetch_source(message_id: str) -> Optional[str]:
+    """
+    LINEから画像を取得し、前処理してKIE.AIにアップロード
+    画像のヘッダーから取得〜アップロードに使うメモリを見積もって image_budget を予約し、
+    元画像のバイト列はこの関数の中だけで保持する（アップロード後に解放）
+
+    Returns:
+        アップロード済み画像URL、失敗時はNone
+    """
+    url = f"{settings.LINE_DATA_API_BASE}/v2/bot/message/{message_id}/content"
     headers = {"Authorization": f"Bearer {settings.LINE_CHANNEL_ACCESS_TOKEN}"}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        response.raise_for_status()
-        return response.content
+    async with AsyncExitStack() as stack:
+        try:
+            response = await stack.enter_async_context(
+                get_http_client().stream("GET", url, headers=headers, timeout=remaining_timeout(30.0))
+            )
+            response.raise_for_status()
+            chunks = response.aiter_bytes()
+            # 先頭（画像ヘッダー）だけ読んで必要なメモリを見積もる
+            head = b""
+            async for chunk in chunks:
+                head += chunk
+                if len(head) >= HEADER_PROBE_BYTES:
+                    break
+            size = max(int(response.headers.get("Content-Length") or 0), len(head))
+            cost = estimate_preprocess_bytes(head, size)
+
+            # 予約は前処理・アップロードが終わるまで保持する
+            await stack.enter_async_context(image_budget.reserve(cost))
+            with tracer.span("line.download") as span:
+                # Content-Length 分を確保して残りを書き込む（チャンクの連結によるコピーを避ける）
+                buffer = bytearray(size)
+                buffer[:len(head)] = head
+                filled = len(head)
+                del head
+                async for chunk in chunks:
+                    if filled + len(chunk) > len(buffer):
+                        buffer.extend(b"\0" * (filled + len(chunk) - len(buffer)))
+                    buffer[filled:filled + len(chunk)] = chunk
+                    filled += len(chunk)
+                del buffer[filled:]
+                span.set_attribute("bytes", filled)
+            # 読み終えた接続はプールに返してから前処理・アップロードに進む
+            await response.aclose()
+        except httpx.HTTPStatusError as e:
+            metrics.line_api_errors.inc("content", str(e.response.status_code))
+            raise
+        except httpx.HTTPError:
+            metrics.line_api_errors.inc("content", "network")
+            raise
+        return await prepare_source(buffer)
 
 
 # 社内用のためプレミアム関連の通知は不要
@@ -0,0 +1,54 @@
+"""
+Usage/Gallery の月別パーティションをアーカイブするスクリプト
+古い月のパーティション（Usage_YYYY-MM / Gallery_YYYY-MM）を
+UsageArchive / GalleryArchive の集計行に圧縮し、元のシートを削除する
+
+使い方:
+    python scripts/archive_sheets.py                   # 直近3ヶ月より古い月をアーカイブ
+    python scripts/archive_sheets.py --keep-months 6
+    python scripts/archive_sheets.py --migrate-legacy  # 旧Usage/Galleryシートを月別に移行してから実行
+    python scripts/archive_sheets.py --keep-partitions # 集計のみ（シートは残す）
+    python scripts/archive_sheets.py --dry-run
+"""
+import argparse
+import os
+import sys
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from services.user_db import UserDB
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive monthly Usage/Gallery partitions")
+    parser.add_argument("--keep-months", type=int, default=3, help="アーカイブせずに残す直近の月数")
+    parser.add_argument("--migrate-legacy", action="store_true", help="旧Usage/Galleryシートを月別パーティションに移行")
+    parser.add_argument("--keep-partitions", action="store_true", help="集計後もパーティションを削除しない")
+    parser.add_argument("--dry-run", action="store_true", help="対象の月を表示するだけ")
+    args = parser.parse_args()
+
+    db = UserDB()
+    try:
+        if args.migrate_legacy and not args.dry_run:
+            moved = db.migrate_legacy_sheets()
+            for base, months in moved.items():
+                print(f"Migrated {base}: {months}", flush=True)
+
+        months = db.archivable_months(args.keep_months)
+        print(f"Months to archive: {months or 'none'}", flush=True)
+        if args.dry_run:
+            return
+
+        for month in months:
+            result = db.archive_month(month, keep_partitions=args.keep_partitions)
+            print(f"Archived {month}: {result}", flush=True)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
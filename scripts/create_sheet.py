@@ -35,9 +35,7 @@ try:
     users_ws = sh.add_worksheet(title="Users", rows=1000, cols=4)
     users_ws.append_row(["user_id", "created_at", "is_premium", "premium_expires_at"])
     
-    # Usage
-    usage_ws = sh.add_worksheet(title="Usage", rows=1000, cols=3)
-    usage_ws.append_row(["user_id", "used_at", "month"])
+    # Usage/Gallery は月別パーティション（Usage_YYYY-MM など）を UserDB が初回書き込み時に作成
     
     # デフォルトのSheet1を削除
     try:
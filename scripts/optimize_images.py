@@ -0,0 +1,133 @@
+"""
+ホームページ画像の最適化パイプライン
+homepage/images 配下の画像から AVIF / WebP / 元形式 のレスポンシブ幅バリアントを生成し、
+srcset 用のマニフェスト（homepage/images/optimized/manifest.json）を出力する
+
+使い方:
+    python scripts/optimize_images.py           # 変更のあった画像のみ生成
+    python scripts/optimize_images.py --force   # 全て再生成
+"""
+import json
+import os
+import sys
+
+from PIL import Image, ImageOps, features
+
+# プロジェクトルートを追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from services.image_assets import OPTIMIZED_DIR, MANIFEST_NAME, RESPONSIVE_WIDTHS
+
+HOMEPAGE_DIR = os.path.join(os.path.dirname(__file__), '..', 'homepage')
+IMAGES_DIR = os.path.join(HOMEPAGE_DIR, 'images')
+OUTPUT_DIR = os.path.join(IMAGES_DIR, OPTIMIZED_DIR)
+
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# フォーマットごとの保存設定
+SAVE_OPTIONS = {
+    "avif": {"format": "AVIF", "quality": 55},
+    "webp": {"format": "WEBP", "quality": 78, "method": 6},
+    "jpg": {"format": "JPEG", "quality": 82, "optimize": True, "progressive": True},
+    "png": {"format": "PNG", "optimize": True},
+}
+
+
+def find_sources() -> list:
+    """最適化対象の画像を列挙（生成済みディレクトリは除外）"""
+    sources = []
+    for root, dirs, files in os.walk(IMAGES_DIR):
+        dirs[:] = [d for d in dirs if d != OPTIMIZED_DIR]
+        for name in sorted(files):
+            if name.lower().endswith(SOURCE_EXTENSIONS):
+                sources.append(os.path.join(root, name))
+    return sorted(sources)
+
+
+def has_alpha(image: Image.Image) -> bool:
+    """実際に透過ピクセルを含むか"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        alpha = image.convert("RGBA").getchannel("A")
+        return alpha.getextrema()[0] < 255
+    return False
+
+
+def target_widths(original_width: int) -> list:
+    """元画像より大きい幅は生成しない（拡大しない）"""
+    widths = [w for w in RESPONSIVE_WIDTHS if w < original_width]
+    widths.append(original_width)
+    return widths
+
+
+def optimize(source: str, force: bool = False) -> tuple:
+    """1枚の画像からバリアントを生成して (相対パス, マニフェストエントリ) を返す"""
+    rel_path = os.path.relpath(source, HOMEPAGE_DIR).replace(os.sep, "/")
+    stem = os.path.splitext(os.path.relpath(source, IMAGES_DIR))[0].replace(os.sep, "_")
+    source_mtime = os.path.getmtime(source)
+
+    with Image.open(source) as opened:
+        image = ImageOps.exif_transpose(opened)
+        alpha = has_alpha(image)
+        image = image.convert("RGBA" if alpha else "RGB")
+
+    # 透過がある場合のフォールバックはPNG、それ以外はJPEG
+    fallback_ext = "png" if alpha else "jpg"
+    formats = [("fallback", fallback_ext)]
+    if features.check("webp"):
+        formats.insert(0, ("webp", "webp"))
+    if features.check("avif"):
+        formats.insert(0, ("avif", "avif"))
+
+    entry = {
+        "width": image.width,
+        "height": image.height,
+        "variants": {},
+        "srcset": {},
+    }
+
+    for width in target_widths(image.width):
+        height = round(image.height * width / image.width)
+        resized = None
+        for key, ext in formats:
+            filename = f"{stem}-{width}.{ext}"
+            out_path = os.path.join(OUTPUT_DIR, filename)
+            if force or not os.path.exists(out_path) or os.path.getmtime(out_path) < source_mtime:
+                if resized is None:
+                    resized = image if width == image.width else image.resize((width, height), Image.Resampling.LANCZOS)
+                resized.save(out_path, **SAVE_OPTIONS[ext])
+            src = f"images/{OPTIMIZED_DIR}/{filename}"
+            entry["variants"].setdefault(key, []).append({
+                "width": width,
+                "src": src,
+                "bytes": os.path.getsize(out_path),
+            })
+
+    for key, variants in entry["variants"].items():
+        entry["srcset"][key] = ", ".join(f"{v['src']} {v['width']}w" for v in variants)
+
+    original_bytes = os.path.getsize(source)
+    best = min(v["bytes"] for variants in entry["variants"].values() for v in variants if v["width"] == image.width)
+    print(f"  {rel_path}: {original_bytes // 1024}KB -> {best // 1024}KB ({len(entry['variants'])} formats)", flush=True)
+    return rel_path, entry
+
+
+def main():
+    force = "--force" in sys.argv
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    print(f"Optimizing images in {os.path.normpath(IMAGES_DIR)}...", flush=True)
+    manifest = {}
+    for source in find_sources():
+        try:
+            rel_path, entry = optimize(source, force=force)
+            manifest[rel_path] = entry
+        except Exception as e:
+            print(f"  Error optimizing {source}: {e}", flush=True)
+
+    manifest_path = os.path.join(OUTPUT_DIR, MANIFEST_NAME)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"Manifest written: {os.path.normpath(manifest_path)} ({len(manifest)} images)", flush=True)
+
+
+if __name__ == "__main__":
+    main()
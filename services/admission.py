@@ -0,0 +1,223 @@
+"""
+生成ジョブの受付制御（アドミッションコントロール）とサーキットブレーカー
+- 実行中のジョブ数が MAX_INFLIGHT_JOBS に達していれば受け付けず、待ち時間の目安を返す
+- 外部API（KIE.AI / webhook.site）の連続失敗でブレーカーを開き、クールダウン中は受け付けない
+- /ready はこの状態をロードバランサー向けに返す
+"""
+import math
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from config import settings
+from services.metrics import registry
+
+admission_rejected = registry.counter("parse_admission_rejected_total", "Generation requests rejected by admission control", ["reason"])
+
+
+class CircuitBreaker:
+    """連続失敗で開き、クールダウン後に1件だけ試す（half_open）"""
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, cooldown: Optional[float] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or settings.BREAKER_FAILURE_THRESHOLD
+        self.cooldown = cooldown or settings.BREAKER_COOLDOWN
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None  # half_open で試行中のジョブを受け付けた時刻
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def would_allow(self) -> bool:
+        """
+        新しいジョブを受け付けてよいか（状態は変えない。half_open では試行中でなければ True）
+        試行したジョブが外部APIまで届かずに終わった場合に備え、クールダウンの時間が過ぎたら次の1件を通す
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        return self.probe_started_at is None or time.monotonic() - self.probe_started_at >= self.cooldown
+
+    def allow(self) -> bool:
+        """would_allow() と同じ判定で、half_open なら試行の1件として枠を取る"""
+        if not self.would_allow():
+            return False
+        if self.state == self.HALF_OPEN:
+            self.probe_started_at = time.monotonic()
+            print(f"[Breaker] {self.name} half open: admitting one probe", flush=True)
+        return True
+
+    def release_probe(self, started_at: float):
+        """試行の枠を取ったジョブを始めなかった場合に枠を返す（次の1件を試行として通せるようにする）"""
+        if self.probe_started_at == started_at:
+            self.probe_started_at = None
+
+    def retry_after(self) -> float:
+        """受け付けを再開するまでの秒数の目安（試行中は試行の期限まで）"""
+        state = self.state
+        if state == self.OPEN:
+            return self.cooldown - (time.monotonic() - self.opened_at)
+        if state == self.HALF_OPEN and self.probe_started_at is not None:
+            return max(0.0, self.cooldown - (time.monotonic() - self.probe_started_at))
+        return 0.0
+
+    def record_success(self):
+        if self.opened_at is not None:
+            print(f"[Breaker] {self.name} closed", flush=True)
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.opened_at is None and self.failures >= self.failure_threshold):
+            # half_open の試行が失敗した場合も開き直す
+            print(f"[Breaker] {self.name} opened after {self.failures} consecutive failures", flush=True)
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+
+
+class Rejection:
+    def __init__(self, reason: str, wait_seconds: float):
+        self.reason = reason  # overloaded / upstream / shutting_down
+        self.wait_seconds = wait_seconds
+
+    @property
+    def wait_minutes(self) -> int:
+        return max(1, math.ceil(self.wait_seconds / 60))
+
+
+class Reservation:
+    """受け付けたジョブの実行枠（admitted() で使い始め、終了時、または始めずに終わった時に release() で返す）"""
+
+    def __init__(self, controller: "AdmissionController", weight: int, probes: list):
+        self.controller = controller
+        self.weight = weight
+        self.probes = probes  # [(試行の枠を取ったブレーカー, 取った時刻)]
+        self.started = False
+        self.released = False
+
+    def release(self):
+        """実行枠を返す（何度呼んでもよい）。ジョブを始めなかった場合は試行の枠も返す"""
+        if self.released:
+            return
+        self.released = True
+        self.controller.in_flight -= self.weight
+        if not self.started:
+            for breaker, started_at in self.probes:
+                breaker.release_probe(started_at)
+
+
+class AdmissionController:
+    def __init__(self, max_inflight: Optional[int] = None):
+        self.max_inflight = max_inflight or settings.MAX_INFLIGHT_JOBS
+        self.in_flight = 0
+        # ジョブの所要時間の指数移動平均（待ち時間の目安に使う）
+        self.avg_job_seconds = float(settings.ADMISSION_DEFAULT_JOB_SECONDS)
+        self.shutting_down = False
+        self.breakers = {
+            "kie": CircuitBreaker("kie"),
+            "webhook": CircuitBreaker("webhook"),
+        }
+
+    def estimate_wait(self, weight: int = 1) -> float:
+        """今受け付けた場合に実行枠が空くまでの目安（秒）"""
+        excess = self.in_flight + weight - self.max_inflight
+        if excess <= 0:
+            return 0.0
+        return self.avg_job_seconds * math.ceil(excess / self.max_inflight)
+
+    def check(self, weight: int = 1) -> Optional[Rejection]:
+        """
+        新しいジョブを受け付けられるか（状態は変えない。受け付けない場合は理由と待ち時間の目安）
+
+        Args:
+            weight: ジョブの重み（一括生成は写真の枚数）
+        """
+        if self.shutting_down:
+            return Rejection("shutting_down", 60)
+        open_breakers = [b for b in self.breakers.values() if b.state == CircuitBreaker.OPEN]
+        if open_breakers:
+            return Rejection("upstream", max(b.retry_after() for b in open_breakers))
+        if self.in_flight + weight > self.max_inflight:
+            return Rejection("overloaded", self.estimate_wait(weight))
+        # half_open のブレーカーは試行の1件だけ通す（後のブレーカーで断る場合に前のブレーカーの試行の枠を使わないよう、先に全て確かめる）
+        blocked = next((b for b in self.breakers.values() if not b.would_allow()), None)
+        if blocked is not None:
+            return Rejection("upstream", blocked.retry_after())
+        return None
+
+    def reserve(self, weight: int = 1) -> tuple[Optional[Reservation], Optional[Rejection]]:
+        """
+        受け付けられれば実行枠と half_open のブレーカーの試行の枠を取る
+        （判定と確保の間に await を挟まないので、同時に届いた要求で MAX_INFLIGHT_JOBS を超えない）
+
+        Returns:
+            (実行枠, None) または (None, 受け付けない理由)
+        """
+        rejection = self.check(weight)
+        if rejection is not None:
+            admission_rejected.inc(rejection.reason)
+            return None, rejection
+        probes = []
+        for breaker in self.breakers.values():
+            if breaker.state == CircuitBreaker.HALF_OPEN and breaker.allow():
+                probes.append((breaker, breaker.probe_started_at))
+        self.in_flight += weight
+        return Reservation(self, weight, probes), None
+
+    @contextmanager
+    def admitted(self, reservation: Reservation):
+        """reserve() で取った実行枠をジョブの実行中使用し、終了時に返す"""
+        reservation.started = True
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            reservation.release()
+            elapsed = (time.monotonic() - started) / reservation.weight
+            self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+
+    def ready(self) -> tuple[bool, str]:
+        """ロードバランサー向けの受付可否"""
+        if self.shutting_down:
+            return False, "shutting_down"
+        if self.in_flight >= self.max_inflight:
+            return False, "overloaded"
+        for breaker in self.breakers.values():
+            if breaker.state == CircuitBreaker.OPEN:
+                return False, f"breaker_open:{breaker.name}"
+        return True, "ok"
+
+    def summary(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_inflight": self.max_inflight,
+            "avg_job_seconds": round(self.avg_job_seconds, 1),
+            "breakers": {name: breaker.state for name, breaker in self.breakers.items()},
+        }
+
+
+# シングルトンインスタンス
+admission = AdmissionController()
+
+registry.gauge("parse_admission_in_flight", "Admitted generation job weight currently running", callback=lambda: admission.in_flight)
+registry.gauge(
+    "parse_circuit_breaker_open", "Upstream circuit breaker state (0 closed, 0.5 half open, 1 open)", ["upstream"],
+    callback=lambda: {
+        (name,): {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 0.5, CircuitBreaker.OPEN: 1}[breaker.state]
+        for name, breaker in admission.breakers.items()
+    }
+)
@@ -0,0 +1,163 @@
+"""
+UserDBの非同期ファサード
+gspreadの同期HTTP呼び出しを専用スレッドプールで実行し、イベントループを止めない
+"""
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+
+from config import settings
+from services.metrics import db_call_duration, db_call_errors
+from services.sheets_scheduler import sheets_scheduler
+from services.tracing import tracer
+
+
+class CallStats:
+    """メソッドごとのレイテンシ統計（直近N件）"""
+
+    def __init__(self, window: int = 200):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.recent.append(elapsed)
+
+    def summary(self) -> dict:
+        ordered = sorted(self.recent)
+
+        def percentile(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 4)
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avg": round(self.total_time / self.count, 4) if self.count else 0.0,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "max": round(self.max_time, 4),
+        }
+
+
+class AsyncUserDB:
+    def __init__(self, db, max_workers: Optional[int] = None, timeout: Optional[float] = None):
+        self.db = db
+        self.timeout = timeout if timeout is not None else settings.SHEETS_CALL_TIMEOUT
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.SHEETS_MAX_WORKERS,
+            thread_name_prefix="sheets"
+        )
+        self.stats = {}
+        self.in_flight = 0
+
+    @property
+    def db_path(self) -> str:
+        return getattr(self.db, "db_path", "Google Sheets")
+
+    async def _run(self, name: str, func, *args, default=None, **kwargs):
+        """スレッドプールで同期メソッドを実行（タイムアウト・計測付き）"""
+        stats = self.stats.setdefault(name, CallStats())
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.in_flight += 1
+        with tracer.span(f"db.{name}") as span:
+            try:
+                # タイムアウト後にスレッドがクォータ待ち・再試行を続けないよう、同じ期限をスケジューラにも渡す
+                deadline = time.monotonic() + self.timeout if self.timeout else None
+                future = loop.run_in_executor(self.executor, partial(sheets_scheduler.run_until, deadline, func, *args, **kwargs))
+                return await asyncio.wait_for(future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                # 実行中のAPI呼び出しは継続する（書き込みは遅れて反映される）が、期限後の再試行はしない
+                stats.timeouts += 1
+                db_call_errors.inc(name, "timeout")
+                span.fail(f"timeout after {self.timeout}s")
+                print(f"[Sheets] {name} timed out after {self.timeout}s", flush=True)
+                return default
+            except Exception as e:
+                stats.errors += 1
+                db_call_errors.inc(name, "error")
+                span.fail(str(e))
+                print(f"[Sheets] {name} error: {e}", flush=True)
+                return default
+            finally:
+                self.in_flight -= 1
+                elapsed = time.perf_counter() - start
+                stats.record(elapsed)
+                db_call_duration.observe(elapsed, name)
+
+    async def create_user(self, user_id: str) -> bool:
+        return await self._run("create_user", self.db.create_user, user_id, default=False)
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        return await self._run("get_user", self.db.get_user, user_id, default=None)
+
+    async def get_monthly_usage(self, user_id: str) -> int:
+        return await self._run("get_monthly_usage", self.db.get_monthly_usage, user_id, default=0)
+
+    async def get_remaining_count(self, user_id: str) -> int:
+        # Sheetsへのアクセスは無いため直接呼ぶ
+        return self.db.get_remaining_count(user_id)
+
+    async def increment_usage(self, user_id: str) -> bool:
+        return await self._run("increment_usage", self.db.increment_usage, user_id, default=False)
+
+    async def set_premium(self, user_id: str, expires_at) -> bool:
+        return await self._run("set_premium", self.db.set_premium, user_id, expires_at, default=False)
+
+    async def cancel_premium(self, user_id: str) -> bool:
+        return await self._run("cancel_premium", self.db.cancel_premium, user_id, default=False)
+
+    async def save_to_gallery(self, user_id: str, parse_type: str, custom_prompt: str, image_url: str, original_image_id: str = "") -> bool:
+        return await self._run(
+            "save_to_gallery",
+            self.db.save_to_gallery,
+            user_id=user_id,
+            parse_type=parse_type,
+            custom_prompt=custom_prompt,
+            image_url=image_url,
+            original_image_id=original_image_id,
+            default=False
+        )
+
+    async def ping(self) -> Optional[bool]:
+        """Sheetsへの接続の維持（Sheetsに直接読み書きしないバックエンドでは None）"""
+        if not hasattr(self.db, "ping"):
+            return None
+        return await self._run("ping", self.db.ping, default=False)
+
+    def queue_depth(self) -> int:
+        """スレッドプールの実行待ち件数"""
+        return self.executor._work_queue.qsize()
+
+    def pending_writes(self) -> int:
+        """Sheets未反映の書き込み件数"""
+        return self.db.pending_writes() if hasattr(self.db, "pending_writes") else 0
+
+    def metrics(self) -> dict:
+        """レイテンシ統計"""
+        result = {
+            "in_flight": self.in_flight,
+            "max_workers": self.executor._max_workers,
+            "calls": {name: stats.summary() for name, stats in self.stats.items()},
+        }
+        if hasattr(self.db, "metrics"):
+            result.update(self.db.metrics())
+        return result
+
+    def shutdown(self):
+        """スレッドプール停止（実行中の書き込みは完了を待つ）後、バッファをフラッシュ"""
+        self.executor.shutdown(wait=True)
+        if hasattr(self.db, "close"):
+            self.db.close()
@@ -0,0 +1,63 @@
+"""
+複数画像（LINEの imageSet）の一括生成用スケジューラ
+元画像ごとのグループに分けて生成を投入し、同時実行数の上限内で
+実行中の件数が少ないグループから順に枠を割り当てる（1枚目の写真だけが先に進まないようにする）
+"""
+import asyncio
+from collections import Counter, OrderedDict, deque
+from typing import Awaitable, Callable, Hashable
+
+
+class FairScheduler:
+    def __init__(self, concurrency: int):
+        """
+        Args:
+            concurrency: 同時に実行する処理の上限
+        """
+        self.concurrency = max(1, concurrency)
+        self.pending = OrderedDict()  # {グループ: deque[(fn, future)]}（追加順）
+        self.running = Counter()
+        self.active = 0
+
+    def submit(self, group: Hashable, fn: Callable[[], Awaitable]) -> asyncio.Future:
+        """
+        処理を投入する（イベントループ上から呼ぶ）
+
+        Returns:
+            fn() の結果が入る Future
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(group, deque()).append((fn, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        while self.active < self.concurrency and self.pending:
+            # 実行中が最も少ないグループ（同数なら先に追加されたグループ）
+            group = min(self.pending, key=lambda g: self.running[g])
+            fn, future = self.pending[group].popleft()
+            if not self.pending[group]:
+                del self.pending[group]
+            if future.cancelled():
+                continue
+            self.active += 1
+            self.running[group] += 1
+            task = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t, g=group, f=future: self._done(g, f, t))
+            # 呼び出し元が結果を待たなくなったら（ジョブの取り消し）実行中の処理も取り消す
+            future.add_done_callback(lambda f, t=task: t.cancel() if f.cancelled() else None)
+
+    def _done(self, group: Hashable, future: asyncio.Future, task: asyncio.Task):
+        self.active -= 1
+        self.running[group] -= 1
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        self._dispatch()
+
+    def queued(self) -> int:
+        return sum(len(items) for items in self.pending.values())
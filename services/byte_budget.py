@@ -0,0 +1,78 @@
+"""
+画像処理のメモリ予算（バイト数のセマフォ）
+元画像の取得 → 前処理 → アップロードの間に使うメモリを見積もって予約し、
+全体で IMAGE_MEMORY_BUDGET_MB を超える分は先着順で待たせる（ピークメモリを設定値で抑える）
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+from config import settings
+from services.metrics import registry
+from services.tracing import tracer
+
+
+class ByteBudget:
+    def __init__(self, capacity: int):
+        """
+        Args:
+            capacity: 同時に予約できるバイト数
+        """
+        self.capacity = capacity
+        self.in_use = 0
+        self.waiters = deque()  # [(バイト数, Future)]（先着順）
+
+    @property
+    def waiting_bytes(self) -> int:
+        return sum(nbytes for nbytes, _ in self.waiters)
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        """
+        nbytes を予約してブロックを実行（空くまで待つ）
+        予算を超える1件は、他に予約がなくなってから単独で実行する
+        """
+        nbytes = max(0, min(nbytes, self.capacity))
+        if not self.waiters and self.in_use + nbytes <= self.capacity:
+            self.in_use += nbytes
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = (nbytes, future)
+            self.waiters.append(entry)
+            try:
+                with tracer.span("image.budget_wait", reserve_bytes=nbytes):
+                    await future
+            except asyncio.CancelledError:
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+                    self._wake()
+                elif future.done() and not future.cancelled():
+                    # 予約が割り当てられた直後に取り消された
+                    self._release(nbytes)
+                raise
+        try:
+            yield
+        finally:
+            self._release(nbytes)
+
+    def _release(self, nbytes: int):
+        self.in_use -= nbytes
+        self._wake()
+
+    def _wake(self):
+        """先頭から予算に収まる分だけ待機を解除（追い越しはしない）"""
+        while self.waiters and self.in_use + self.waiters[0][0] <= self.capacity:
+            nbytes, future = self.waiters.popleft()
+            if future.done():
+                continue
+            self.in_use += nbytes
+            future.set_result(None)
+
+
+# シングルトンインスタンス
+image_budget = ByteBudget(settings.IMAGE_MEMORY_BUDGET_MB * 1024 * 1024)
+
+registry.gauge(
+    "parse_image_budget_bytes", "Bytes reserved for image download/preprocess/upload (in_use) and waiting for the budget",
+    ["state"], callback=lambda: {("in_use",): image_budget.in_use, ("waiting",): image_budget.waiting_bytes}
+)
@@ -0,0 +1,86 @@
+"""
+外部API（KIE.AI / webhook.site / LINEコンテンツ / 結果画像）用の共有HTTPクライアント
+リクエストごとにクライアントを作らず、接続（TLSハンドシェイク）をプールで再利用する
+（LINE Messaging API は SDK のクライアントを main.line_api_client() で共有する）
+"""
+import time
+from typing import Optional
+
+import httpx
+
+from config import settings
+from services.metrics import upstream_duration
+
+_client: Optional[httpx.AsyncClient] = None
+
+# ホストごとの最終リクエスト時刻（monotonic）。ウォームアップのアイドル判定に使う
+last_used = {}
+
+
+def endpoint_name(url: httpx.URL) -> str:
+    """メトリクス用のエンドポイント名（IDを含むパスをまとめる）"""
+    path = url.path
+    if path.endswith("/file-base64-upload"):
+        return "kie_upload"
+    if path.endswith("/jobs/createTask"):
+        return "kie_create_task"
+    if path.endswith("/token"):
+        return "webhook_token"
+    if path.endswith("/requests"):
+        return "webhook_poll"
+    if path.endswith("/content"):
+        return "line_content"
+    return "other"
+
+
+async def _on_request(request: httpx.Request):
+    request.extensions["started"] = time.perf_counter()
+    last_used[request.url.host] = time.monotonic()
+
+
+async def _on_response(response: httpx.Response):
+    started = response.request.extensions.get("started")
+    if started is not None:
+        upstream_duration.observe(time.perf_counter() - started, endpoint_name(response.request.url))
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """共有クライアントを取得（初回に作成）。タイムアウトは呼び出しごとに指定する"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [_on_request], "response": [_on_response]},
+        )
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def pool_stats() -> dict:
+    """接続プールの使用状況（httpcoreの内部状態から取得）"""
+    stats = {"max": settings.HTTP_MAX_CONNECTIONS, "connections": 0, "active": 0, "idle": 0, "queued": 0}
+    if _client is None:
+        return stats
+    pool = getattr(_client._transport, "_pool", None)
+    if pool is None:
+        return stats
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    stats.update(
+        connections=len(connections),
+        idle=idle,
+        active=len(connections) - idle,
+        queued=sum(1 for request in list(getattr(pool, "_requests", [])) if request.is_queued()),
+    )
+    return stats
@@ -0,0 +1,110 @@
+"""
+ホームページ画像の配信（レスポンシブ対応）
+scripts/optimize_images.py が生成したマニフェストを読み込み、
+Acceptヘッダーと要求幅に応じて最適なバリアント（AVIF/WebP/元形式）を選択する
+"""
+import json
+import os
+from typing import Optional
+
+# 生成先（homepage/images 配下）
+OPTIMIZED_DIR = "optimized"
+MANIFEST_NAME = "manifest.json"
+
+# 生成するレスポンシブ幅
+RESPONSIVE_WIDTHS = [480, 960, 1600]
+
+# 優先順（ブラウザが対応していれば上から採用）
+FORMAT_PRIORITY = [
+    ("avif", "image/avif"),
+    ("webp", "image/webp"),
+]
+
+MEDIA_TYPES = {
+    ".avif": "image/avif",
+    ".webp": "image/webp",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+}
+
+
+class ImageAssets:
+    def __init__(self, root_dir: str = "homepage"):
+        self.root_dir = root_dir
+        self.manifest_path = os.path.join(root_dir, "images", OPTIMIZED_DIR, MANIFEST_NAME)
+        self._manifest = {}
+        self._manifest_mtime = None
+
+    def _load_manifest(self) -> dict:
+        """マニフェスト読み込み（更新されていれば再読み込み）"""
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except OSError:
+            self._manifest = {}
+            self._manifest_mtime = None
+            return self._manifest
+
+        if mtime != self._manifest_mtime:
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+                self._manifest_mtime = mtime
+            except Exception as e:
+                print(f"Image manifest load error: {e}", flush=True)
+                self._manifest = {}
+        return self._manifest
+
+    def select(self, image_path: str, accept: str = "", width: Optional[int] = None) -> Optional[str]:
+        """
+        配信するファイルパスを選択
+
+        Args:
+            image_path: "images/..." 形式の相対パス
+            accept: リクエストのAcceptヘッダー
+            width: 要求幅（srcsetの ?w= パラメータ）
+
+        Returns:
+            配信するファイルの絶対パス、存在しなければNone
+        """
+        original = os.path.normpath(os.path.join(self.root_dir, image_path))
+        # ディレクトリトラバーサル対策
+        if not original.startswith(os.path.normpath(self.root_dir) + os.sep):
+            return None
+
+        entry = self._load_manifest().get(image_path)
+        if entry:
+            formats = [fmt for fmt, mime in FORMAT_PRIORITY if mime in accept]
+            formats.append("fallback")
+            for fmt in formats:
+                variant = self._pick_width(entry.get("variants", {}).get(fmt, []), width)
+                if variant:
+                    path = os.path.join(self.root_dir, variant["src"])
+                    if os.path.isfile(path):
+                        return path
+
+        if os.path.isfile(original):
+            return original
+        return None
+
+    @staticmethod
+    def media_type(path: str) -> Optional[str]:
+        """拡張子からContent-Typeを決定（avifは標準のmimetypesに無い環境がある）"""
+        return MEDIA_TYPES.get(os.path.splitext(path)[1].lower())
+
+    @staticmethod
+    def _pick_width(variants: list, width: Optional[int]) -> Optional[dict]:
+        """要求幅以上で最小のバリアントを選ぶ（指定なしは最大幅）"""
+        if not variants:
+            return None
+        ordered = sorted(variants, key=lambda v: v["width"])
+        if not width:
+            return ordered[-1]
+        for variant in ordered:
+            if variant["width"] >= width:
+                return variant
+        return ordered[-1]
+
+
+# シングルトンインスタンス
+image_assets = ImageAssets()
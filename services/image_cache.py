@@ -0,0 +1,125 @@
+"""
+生成結果画像のミラー（LINEプレビュー用サムネイル生成）
+KIE.AIの一時URLから1回だけ取得してローカルに保存し、
+小さいJPEGプレビューと合わせて自前のURL（/results/...）で配信する
+"""
+import asyncio
+import hashlib
+import io
+import os
+import re
+import time
+from typing import Optional
+
+from PIL import Image
+
+from config import settings
+from services.http_client import get_http_client
+
+# ファイル名の形式（パストラバーサル対策）
+FILENAME_PATTERN = re.compile(r"^[0-9a-f]{32}(_preview)?\.(png|jpg|webp)$")
+
+CONTENT_TYPE_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+}
+
+
+class ResultImageCache:
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir or settings.RESULT_CACHE_DIR or os.path.join(settings.DATA_DIR, "results")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        # LINEはHTTPSの公開URLが必要なため、公開URLが設定されている場合のみ有効
+        return bool(settings.PUBLIC_BASE_URL)
+
+    def path_for(self, filename: str) -> Optional[str]:
+        """配信用: ファイル名を検証してパスを返す"""
+        if not FILENAME_PATTERN.match(filename):
+            return None
+        path = os.path.join(self.cache_dir, filename)
+        return path if os.path.isfile(path) else None
+
+    async def mirror(self, url: str) -> Optional[tuple[str, str]]:
+        """
+        結果画像を取得・保存してプレビューを生成
+
+        Args:
+            url: KIE.AIの結果画像URL
+
+        Returns:
+            (オリジナルURL, プレビューURL)、無効・失敗時はNone
+        """
+        if not self.enabled:
+            return None
+
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        base_url = settings.PUBLIC_BASE_URL.rstrip("/")
+        preview_name = f"{key}_preview.jpg"
+
+        try:
+            # 同じURLは取得済みならそのまま使う
+            for ext in CONTENT_TYPE_EXTENSIONS.values():
+                if os.path.exists(os.path.join(self.cache_dir, f"{key}.{ext}")) and \
+                        os.path.exists(os.path.join(self.cache_dir, preview_name)):
+                    original_url = url if ext == "webp" else f"{base_url}/results/{key}.{ext}"
+                    return original_url, f"{base_url}/results/{preview_name}"
+
+            res = await get_http_client().get(url, timeout=30.0, follow_redirects=True)
+            res.raise_for_status()
+            content = res.content
+
+            content_type = res.headers.get("content-type", "").split(";")[0].strip()
+            ext = CONTENT_TYPE_EXTENSIONS.get(content_type, "png")
+            original_name = f"{key}.{ext}"
+
+            # 保存とプレビュー生成はスレッドで実行（イベントループを止めない）
+            await asyncio.to_thread(self._store, content, original_name, preview_name)
+            if ext == "webp":
+                # LINEの画像メッセージはJPEG/PNGのみ対応のため、オリジナルは元URLを使う
+                return url, f"{base_url}/results/{preview_name}"
+            return f"{base_url}/results/{original_name}", f"{base_url}/results/{preview_name}"
+        except Exception as e:
+            print(f"Result mirror error: {e}", flush=True)
+            return None
+
+    def _store(self, content: bytes, original_name: str, preview_name: str):
+        """オリジナルを保存し、プレビューJPEGを生成（一時ファイル経由で書き込み）"""
+        self._write_atomic(original_name, content)
+
+        with Image.open(io.BytesIO(content)) as image:
+            image.thumbnail((settings.RESULT_PREVIEW_SIZE, settings.RESULT_PREVIEW_SIZE), Image.Resampling.LANCZOS)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            buffered = io.BytesIO()
+            image.save(buffered, format="JPEG", quality=80, optimize=True)
+        self._write_atomic(preview_name, buffered.getvalue())
+
+    def _write_atomic(self, filename: str, data: bytes):
+        path = os.path.join(self.cache_dir, filename)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def prune(self, max_age_days: Optional[int] = None) -> int:
+        """古いキャッシュを削除"""
+        max_age = (max_age_days or settings.RESULT_CACHE_MAX_AGE_DAYS) * 86400
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+# シングルトンインスタンス
+result_cache = ResultImageCache()
@@ -0,0 +1,138 @@
+"""
+ジョブ全体の期限と取り消し
+1つの生成ジョブ（取得 → アップロード → createTask → ポーリング → 送信）に全体の期限を持たせ、
+期限切れ、または同じユーザーが新しいジョブを始めた時点で、ジョブ内の処理をまとめて取り消す
+同じユーザーが同じ入力で要求し直した場合（連打）は取り消さず、実行中のジョブに合流する
+各ステージのタイムアウトは remaining_timeout() で残り時間以内に切り詰める
+"""
+import asyncio
+import contextvars
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable, Optional
+
+from services.singleflight import coalesced_calls
+
+_current = contextvars.ContextVar("job_context", default=None)
+
+
+class JobCancelled(Exception):
+    """ジョブが期限切れ（deadline）または新しいジョブに置き換えられた（superseded）"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class JobContext:
+    def __init__(self, user_id: str, seconds: float):
+        self.user_id = user_id
+        self.deadline = time.monotonic() + seconds
+        self.task = asyncio.current_task()
+        self.cancel_reason = None
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def cancel(self, reason: str):
+        """ジョブを実行中のタスクを取り消す（ジョブ内の子タスクも取り消される）"""
+        if self.cancel_reason is None and self.task and not self.task.done():
+            self.cancel_reason = reason
+            self.task.cancel()
+
+
+class JobRegistry:
+    def __init__(self):
+        self.active = {}  # {user_id: JobContext}
+        self.running = {}  # {user_id: (入力のキー, ジョブのタスク)}
+
+    def current(self, user_id: str) -> Optional[JobContext]:
+        return self.active.get(user_id)
+
+    def joinable(self, user_id: str, key: Hashable) -> Optional[asyncio.Task]:
+        """同じ入力で実行中のジョブのタスク（取り消し中のものには合流しない）"""
+        entry = self.running.get(user_id)
+        if entry is None:
+            return None
+        running_key, task = entry
+        if running_key != key or task.done() or task.cancelling():
+            return None
+        return task
+
+    async def run(self, user_id: str, key: Hashable, fn: Callable[[], Awaitable]) -> tuple:
+        """
+        ジョブを専用のタスクで実行して終了を待つ
+        同じ入力のジョブが実行中なら新たに始めず、その結果を待つ。入力の違うジョブは scope() で置き換えるが、
+        取り消されるのはジョブのタスクだけで、呼び出し元（同じWebhookの他のイベントの処理）は続く
+
+        Args:
+            key: 入力のキー（写真・タイプ・指示など。等しければ同じジョブとみなす）
+            fn: ジョブを実行するコルーチン関数（中で scope() に入る）
+
+        Returns:
+            (結果, 実行中のジョブに合流したか)
+        """
+        task = self.joinable(user_id, key)
+        if task is not None:
+            print(f"[Job] Joining running job of user {user_id}", flush=True)
+            coalesced_calls.inc("job")
+            # 合流した側が取り消されても元のジョブは続ける
+            return await asyncio.shield(task), True
+
+        task = asyncio.get_running_loop().create_task(fn())
+        self.running[user_id] = (key, task)
+        task.add_done_callback(lambda t: self.running.pop(user_id) if self.running.get(user_id, (None, None))[1] is t else None)
+        try:
+            return await task, False
+        except asyncio.CancelledError:
+            # ジョブのタスクだけが取り消された場合は呼び出し元の処理を続ける
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                return None, False
+            raise
+
+    @asynccontextmanager
+    async def scope(self, user_id: str, seconds: float):
+        """
+        ジョブの実行範囲（同じユーザーの実行中のジョブは置き換えとして取り消す）
+
+        Raises:
+            JobCancelled: 期限切れ・置き換え時（範囲内の処理は取り消し済み）
+        """
+        previous = self.active.get(user_id)
+        if previous is not None:
+            print(f"[Job] Superseding running job of user {user_id}", flush=True)
+            previous.cancel("superseded")
+
+        ctx = JobContext(user_id, seconds)
+        self.active[user_id] = ctx
+        token = _current.set(ctx)
+        deadline = asyncio.timeout(seconds)
+        try:
+            async with deadline:
+                yield ctx
+        except TimeoutError:
+            if not deadline.expired():
+                raise
+            raise JobCancelled("deadline")
+        except asyncio.CancelledError:
+            if ctx.cancel_reason is None:
+                raise
+            # 自分で取り消した場合は取り消しを打ち消して通常の例外として伝える
+            ctx.task.uncancel()
+            raise JobCancelled(ctx.cancel_reason)
+        finally:
+            _current.reset(token)
+            if self.active.get(user_id) is ctx:
+                del self.active[user_id]
+
+
+def remaining_timeout(default: float) -> float:
+    """ステージのタイムアウト（実行中のジョブがあればその残り時間以内に切り詰める）"""
+    ctx = _current.get()
+    if ctx is None:
+        return default
+    return max(0.5, min(default, ctx.remaining()))
+
+
+# シングルトンインスタンス
+job_registry = JobRegistry()
@@ -3,28 +3,76 @@ KIE.AI API連携（LINE Bot用・非同期版）
 """
 import asyncio
 import base64
+import hashlib
 import io
 import json
+import time
+from collections import OrderedDict
 from typing import Optional, List
 
-import httpx
 from PIL import Image
 
 from config import settings
+from services.admission import admission
+from services.http_client import get_http_client
+from services.job_context import remaining_timeout
+from services.metrics import model_duration, model_results
+from services.model_router import model_router
+from services.singleflight import SingleFlight
+from services.tracing import tracer
 
 # API URLs
-CREATE_TASK_URL = "https://api.kie.ai/api/v1/jobs/createTask"
-UPLOAD_URL = "https://kieai.redpandaai.co/api/file-base64-upload"
-
-
-def image_bytes_to_base64(image_bytes: bytes) -> str:
-    """画像バイトをBase64文字列に変換"""
+CREATE_TASK_URL = f"{settings.KIEAI_API_BASE}/api/v1/jobs/createTask"
+UPLOAD_URL = f"{settings.KIEAI_UPLOAD_BASE}/api/file-base64-upload"
+WEBHOOK_SITE_BASE = settings.WEBHOOK_SITE_BASE
+
+# 使用する4つの異なるモデル/エンジン（元々のもの）
+MODELS = [
+    "nano-banana-pro",
+    "gpt-image/1.5-image-to-image",
+    "seedream/4.5-edit",
+    "flux-2/flex-image-to-image",
+]
+
+# 同じ画像のアップロード・同じ画像×プロンプト×モデルの生成が実行中なら相乗りする
+upload_flight = SingleFlight("upload")
+generate_flight = SingleFlight("generate")
+# 共有する処理全体の期限（秒）。各ステージのタイムアウトの合計（前処理+アップロード / トークン+createTask+ポーリング）
+UPLOAD_FLIGHT_TIMEOUT = 60.0
+GENERATE_FLIGHT_TIMEOUT = 240.0
+# アップロード済みURL → 元画像のハッシュ（別々にアップロードされた同じ画像の生成もまとめるため）
+_source_digests = OrderedDict()
+MAX_SOURCE_DIGESTS = 256
+
+
+# アップロード前に縮小する長辺のピクセル数
+MAX_SOURCE_SIZE = 1024
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+# 前処理の見積もりに読む先頭のバイト数（画像ヘッダーからサイズを取るため）
+HEADER_PROBE_BYTES = 64 * 1024
+
+
+def _target_size(size: tuple) -> tuple:
+    """長辺 MAX_SOURCE_SIZE に収まる縮小後のサイズ"""
+    width, height = size
+    scale = min(1.0, MAX_SOURCE_SIZE / max(width, height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def encode_source_image(image_bytes: bytes) -> bytes:
+    """
+    画像を縮小・JPEG化してBase64（bytes）に変換
+    フル解像度の展開や文字列への変換によるコピーを避ける
+    """
     image = Image.open(io.BytesIO(image_bytes))
 
+    # JPEGはデコード時に1/2〜1/8に縮小して、フル解像度での展開を避ける
+    if image.format == "JPEG" and max(image.size) > MAX_SOURCE_SIZE:
+        image.draft("RGB", _target_size(image.size))
+
     # リサイズ（大きすぎる場合）
-    max_size = 1024
-    if max(image.size) > max_size:
-        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    if max(image.size) > MAX_SOURCE_SIZE:
+        image.thumbnail((MAX_SOURCE_SIZE, MAX_SOURCE_SIZE), Image.Resampling.LANCZOS)
 
     # RGBA -> RGB
     if image.mode in ("RGBA", "LA", "P"):
@@ -32,45 +80,110 @@ def image_bytes_to_base64(image_bytes: bytes) -> str:
 
     buffered = io.BytesIO()
     image.save(buffered, format="JPEG", quality=90)
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/jpeg;base64,{img_str}"
+    # getvalue() のコピーを作らずにエンコード
+    return base64.b64encode(buffered.getbuffer())
+
+
+def image_bytes_to_base64(image_bytes: bytes) -> str:
+    """画像バイトをBase64文字列（data URL）に変換"""
+    return (DATA_URL_PREFIX + encode_source_image(image_bytes)).decode("ascii")
+
+
+def estimate_preprocess_bytes(head: bytes, size: int) -> int:
+    """
+    元画像の取得からアップロードまでに使うメモリの見積もり（バイト数）
 
+    Args:
+        head: 画像の先頭（ヘッダー部分）
+        size: 画像全体のバイト数
+    """
+    # 縮小後の画像・JPEG・Base64・リクエストボディ
+    output = MAX_SOURCE_SIZE * MAX_SOURCE_SIZE * 3 + 3 * MAX_SOURCE_SIZE * MAX_SOURCE_SIZE
+    try:
+        image = Image.open(io.BytesIO(head))
+        width, height = image.size
+        bands = len(image.getbands())
+        if image.format == "JPEG":
+            # draft() で縮小されるデコードサイズ
+            target_width, target_height = _target_size(image.size)
+            scale = 1
+            while scale < 8 and width // (scale * 2) >= target_width and height // (scale * 2) >= target_height:
+                scale *= 2
+            width, height, bands = width // scale, height // scale, 3
+        decoded = width * height * bands
+        # RGB変換する場合は展開した画像がもう1枚
+        if image.mode in ("RGBA", "LA", "P"):
+            decoded += width * height * 3
+    except Exception:
+        # ヘッダーを読めない場合は圧縮率1/8として見積もる
+        decoded = size * 8
+    return size + decoded + output
+
+
+def record_upstream_result(breaker: str, upstream_error: bool):
+    """
+    失敗した呼び出しの結果をサーキットブレーカーに記録
+    5xx・接続エラーは障害として数え、それ以外（4xxなど）は応答があったので正常として扱う
+    """
+    if upstream_error:
+        admission.breakers[breaker].record_failure()
+    else:
+        admission.breakers[breaker].record_success()
 
-async def upload_image(base64_image: str) -> Optional[str]:
-    """画像をKIE.AIにアップロード"""
+
+async def upload_image(base64_image) -> Optional[str]:
+    """
+    画像をKIE.AIにアップロード
+
+    Args:
+        base64_image: data URL（str）または JPEGのBase64（bytes）
+    """
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {settings.KIEAI_API_KEY}"
     }
-    payload = {
-        "base64Data": base64_image,
-        "filename": "upload.jpg",
-        "uploadPath": "temp"
-    }
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    data = base64_image.encode("ascii") if isinstance(base64_image, str) else DATA_URL_PREFIX + base64_image
+    # JSONボディを直接bytesで組み立てる（Base64は文字列エスケープ不要）
+    body = b"".join([b'{"base64Data":"', data, b'","filename":"upload.jpg","uploadPath":"temp"}'])
+    del data
+
+    with tracer.span("kie.upload", bytes=len(body)) as span:
+        client = get_http_client()
+        upstream_error = True
         try:
-            res = await client.post(UPLOAD_URL, headers=headers, json=payload)
+            res = await client.post(UPLOAD_URL, headers=headers, content=body, timeout=remaining_timeout(30.0))
+            span.set_attribute("http.status_code", res.status_code)
+            upstream_error = res.status_code >= 500
             if res.status_code == 200:
                 data = res.json()
                 if data.get("success"):
+                    admission.breakers["kie"].record_success()
                     return data["data"]["downloadUrl"]
         except Exception as e:
             print(f"Upload error: {e}")
+        span.fail("upload failed")
+    record_upstream_result("kie", upstream_error)
     return None
 
 
 async def get_webhook_token() -> Optional[str]:
     """Webhook.siteからトークン取得"""
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    with tracer.span("webhook.token") as span:
+        client = get_http_client()
         for i in range(3):
+            span.set_attribute("attempts", i + 1)
+            upstream_error = True
             try:
-                res = await client.post("https://webhook.site/token")
+                res = await client.post(f"{WEBHOOK_SITE_BASE}/token", timeout=remaining_timeout(10.0))
+                upstream_error = res.status_code >= 500
                 if res.status_code in [200, 201]:
+                    admission.breakers["webhook"].record_success()
                     return res.json()["uuid"]
             except Exception as e:
                 print(f"Webhook token error (attempt {i+1}): {e}")
             await asyncio.sleep(1)
+        span.fail("webhook token failed")
+    record_upstream_result("webhook", upstream_error)
     return None
 
 
@@ -81,58 +194,98 @@ async def create_task(payload: dict) -> tuple[Optional[str], Optional[str]]:
         "Authorization": f"Bearer {settings.KIEAI_API_KEY}"
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    with tracer.span("kie.create_task", model=payload.get("model", "")) as span:
+        client = get_http_client()
+        upstream_error = True
         try:
-            res = await client.post(CREATE_TASK_URL, headers=headers, json=payload)
+            res = await client.post(CREATE_TASK_URL, headers=headers, json=payload, timeout=remaining_timeout(30.0))
+            span.set_attribute("http.status_code", res.status_code)
+            upstream_error = res.status_code >= 500
             if res.status_code == 200:
                 data = res.json()
                 if data.get("code") == 200:
+                    admission.breakers["kie"].record_success()
                     return data["data"]["taskId"], None
                 else:
-                    return None, data.get("msg")
+                    error = data.get("msg")
+                    # クレジット不足・入力の拒否などの業務エラーは数えず、本文のコードが5xxの場合だけ数える
+                    upstream_error = isinstance(data.get("code"), int) and data["code"] >= 500
             else:
-                return None, f"HTTP {res.status_code}"
+                error = f"HTTP {res.status_code}"
         except Exception as e:
-            return None, str(e)
+            error = str(e)
+        span.fail(str(error))
+        record_upstream_result("kie", upstream_error)
+        return None, error
 
 
 async def poll_webhook(uuid: str, timeout: int = 120) -> Optional[str]:
     """Webhookをポーリングして結果URLを取得"""
-    poll_url = f"https://webhook.site/token/{uuid}/requests"
+    result_url, _ = await poll_webhook_result(uuid, timeout)
+    return result_url
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        start_time = asyncio.get_event_loop().time()
 
-        while asyncio.get_event_loop().time() - start_time < timeout:
-            try:
-                res = await client.get(poll_url)
-                if res.status_code == 200:
-                    data_list = res.json().get("data", [])
-                    for req in data_list:
-                        content = req.get("content")
-                        if content:
-                            try:
-                                body = json.loads(content)
-                                data_body = body.get("data", {})
-                                state = data_body.get("state")
-
-                                if state == "success":
-                                    if "resultUrls" in data_body and data_body["resultUrls"]:
-                                        return data_body["resultUrls"][0]
-                                    elif "resultJson" in data_body:
-                                        rj = json.loads(data_body["resultJson"])
-                                        if "resultUrls" in rj:
-                                            return rj["resultUrls"][0]
-                                elif state == "fail":
-                                    return None
-                            except:
-                                pass
-            except Exception as e:
-                print(f"Polling error: {e}")
+async def poll_webhook_result(uuid: str, timeout: int = 120) -> tuple[Optional[str], str]:
+    """
+    Webhookをポーリングして結果を取得
+
+    Returns:
+        (結果URL, "success" / "fail" / "timeout" / "deadline"（ジョブの期限で待ち時間を切り詰めて打ち切った）)
+    """
+    with tracer.span("webhook.poll") as span:
+        return await _poll_webhook(uuid, timeout, span)
+
+
+async def _poll_webhook(uuid: str, timeout: int, span) -> tuple[Optional[str], str]:
+    poll_url = f"{WEBHOOK_SITE_BASE}/token/{uuid}/requests"
+
+    client = get_http_client()
+    start_time = asyncio.get_event_loop().time()
+    polls = 0
+    # ジョブ全体の残り時間を超えて待たない
+    limit = remaining_timeout(timeout)
+    clipped = limit < timeout
+    timeout = limit
+
+    while asyncio.get_event_loop().time() - start_time < timeout:
+        polls += 1
+        span.set_attribute("polls", polls)
+        # 結果を見つけたポーリングの送信時刻（実際の生成完了はこれより前。負荷の記録に使う）
+        span.set_attribute("result_seen_after", round(asyncio.get_event_loop().time() - start_time, 3))
+        try:
+            res = await client.get(poll_url, timeout=remaining_timeout(10.0))
+            if res.status_code == 200:
+                data_list = res.json().get("data", [])
+                for req in data_list:
+                    content = req.get("content")
+                    if content:
+                        try:
+                            body = json.loads(content)
+                            data_body = body.get("data", {})
+                            state = data_body.get("state")
+
+                            if state == "success":
+                                if "resultUrls" in data_body and data_body["resultUrls"]:
+                                    return data_body["resultUrls"][0], "success"
+                                elif "resultJson" in data_body:
+                                    rj = json.loads(data_body["resultJson"])
+                                    if "resultUrls" in rj:
+                                        return rj["resultUrls"][0], "success"
+                            elif state == "fail":
+                                span.fail("task failed")
+                                return None, "fail"
+                        except:
+                            pass
+        except Exception as e:
+            print(f"Polling error: {e}")
 
-            await asyncio.sleep(3)
+        await asyncio.sleep(3)
 
-    return None
+    if clipped:
+        span.fail(f"deadline after {timeout:.0f}s")
+        return None, "deadline"
+    span.fail(f"timeout after {timeout:.0f}s")
+    return None, "timeout"
 
 
 def build_task_payload(model: str, image_url: str, prompt: str, callback_url: str) -> dict:
@@ -200,7 +353,7 @@ def build_task_payload(model: str, image_url: str, prompt: str, callback_url: st
         }
 
 
-async def generate_parse_single(image_url: str, prompt: str, model: str) -> Optional[str]:
+async def generate_parse_single(image_url: str, prompt: str, model: str, parse_type: str = "") -> Optional[str]:
     """
     単一の画像生成タスクを実行
 
@@ -208,18 +361,35 @@ async def generate_parse_single(image_url: str, prompt: str, model: str) -> Opti
         image_url: アップロード済み画像URL
         prompt: 生成プロンプト
         model: 使用するモデル
+        parse_type: モデル選択の統計用
 
     Returns:
         生成された画像のURL、失敗時はNone
     """
+    start = time.monotonic()
+    # 取り消された場合（CancelledError）は何も記録しない
+    result_url, outcome = await _generate_single(image_url, prompt, model)
+    elapsed = time.monotonic() - start
+    if outcome == "deadline":
+        # ジョブの期限で打ち切った分はモデルの遅さではないので、所要時間・ルーティングの実績には入れない
+        model_results.inc(model, outcome)
+        return result_url
+    model_duration.observe(elapsed, model, outcome)
+    model_results.inc(model, outcome)
+    model_router.record(model, parse_type, elapsed, outcome)
+    return result_url
+
+
+async def _generate_single(image_url: str, prompt: str, model: str) -> tuple[Optional[str], str]:
+    """単一生成の本体（結果URLと "success" / "fail" / "timeout" / "deadline" を返す）"""
     try:
         # Webhookトークン取得
         wh_uuid = await get_webhook_token()
         if not wh_uuid:
             print(f"Webhook token failed for {model}")
-            return None
+            return None, "fail"
 
-        callback_url = f"https://webhook.site/{wh_uuid}"
+        callback_url = f"{WEBHOOK_SITE_BASE}/{wh_uuid}"
 
         # モデルごとに適切なペイロードを構築
         task_payload = build_task_payload(model, image_url, prompt, callback_url)
@@ -227,15 +397,14 @@ async def generate_parse_single(image_url: str, prompt: str, model: str) -> Opti
         task_id, error = await create_task(task_payload)
         if not task_id:
             print(f"Task creation failed for {model}: {error}")
-            return None
+            return None, "fail"
 
         # 結果をポーリング
-        result_url = await poll_webhook(wh_uuid, timeout=180)
-        return result_url
+        return await poll_webhook_result(wh_uuid, timeout=180)
 
     except Exception as e:
         print(f"Generation error for {model}: {e}")
-        return None
+        return None, "fail"
 
 
 async def generate_parse(image_bytes: bytes, prompt: str) -> Optional[str]:
@@ -251,7 +420,8 @@ async def generate_parse(image_bytes: bytes, prompt: str) -> Optional[str]:
     """
     try:
         # 1. 画像をBase64に変換
-        base64_image = image_bytes_to_base64(image_bytes)
+        with tracer.span("preprocess", input_bytes=len(image_bytes)):
+            base64_image = image_bytes_to_base64(image_bytes)
 
         # 2. 画像をアップロード
         image_url = await upload_image(base64_image)
@@ -267,98 +437,161 @@ async def generate_parse(image_bytes: bytes, prompt: str) -> Optional[str]:
         return None
 
 
-async def generate_parse_multi(image_bytes: bytes, prompt: str, count: int = 4, callback=None) -> list[Optional[str]]:
+async def prepare_source(image_bytes: bytes) -> Optional[str]:
     """
-    画像からパースを複数枚同時生成（1枚ごとにコールバック）
+    元画像を前処理してKIE.AIにアップロード（生成の入力URLを作る）
+    同じ画像のアップロードが実行中ならその結果を使う
 
     Args:
         image_bytes: 画像のバイトデータ
+
+    Returns:
+        アップロード済み画像URL、失敗時はNone
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        image_url, shared = await upload_flight.do(digest, lambda: _prepare_source(image_bytes), timeout=UPLOAD_FLIGHT_TIMEOUT)
+    except TimeoutError:
+        print(f"[KIE] Image upload timed out ({digest[:12]})", flush=True)
+        return None
+    if shared:
+        print(f"[KIE] Joined in-flight upload of the same image ({digest[:12]})", flush=True)
+    if image_url:
+        _source_digests[image_url] = digest
+        _source_digests.move_to_end(image_url)
+        while len(_source_digests) > MAX_SOURCE_DIGESTS:
+            _source_digests.popitem(last=False)
+    return image_url
+
+
+async def _prepare_source(image_bytes: bytes) -> Optional[str]:
+    """前処理とアップロードの本体"""
+    # 1. 画像をBase64に変換（PILのデコード・縮小・エンコードはスレッドで実行し、イベントループを止めない）
+    with tracer.span("preprocess", input_bytes=len(image_bytes)):
+        encoded = await asyncio.to_thread(encode_source_image, image_bytes)
+    print(f"[KIE] Image converted to base64", flush=True)
+
+    # 2. 画像をアップロード（1回だけ）
+    image_url = await upload_image(encoded)
+    if not image_url:
+        print("[KIE] Image upload failed", flush=True)
+        return None
+
+    print(f"[KIE] Image uploaded: {image_url[:50]}...", flush=True)
+    return image_url
+
+
+async def generate_one(image_url: str, prompt: str, model: str, parse_type: str = "", slot: int = 0) -> Optional[str]:
+    """
+    アップロード済み画像から1枚生成（同じ画像×プロンプト×モデルの生成が実行中なら相乗りする）
+
+    Args:
+        slot: 同じモデルが1ジョブに複数枠ある場合の何番目か（枠ごとに別の生成として扱う）
+    """
+    key = (_source_digests.get(image_url, image_url), prompt, model, slot)
+    with tracer.span("generate", model=model, slot=slot) as span:
+        try:
+            result, shared = await generate_flight.do(
+                key, lambda: generate_parse_single(image_url, prompt, model, parse_type), timeout=GENERATE_FLIGHT_TIMEOUT
+            )
+        except TimeoutError:
+            print(f"[KIE] Generation ({model}) timed out", flush=True)
+            result, shared = None, False
+        if shared:
+            span.set_attribute("coalesced", True)
+            print(f"[KIE] Generation ({model}) joined an identical in-flight generation", flush=True)
+        if not result:
+            span.fail("generation failed")
+    return result
+
+
+async def generate_from_url(image_url: str, prompt: str, models: List[str], parse_type: str = "", callback=None) -> list[Optional[str]]:
+    """
+    アップロード済み画像から指定モデルで同時生成（1枚ごとにコールバック）
+
+    Args:
+        image_url: アップロード済み画像URL
         prompt: 生成プロンプト
-        count: 生成枚数（デフォルト4枚）
+        models: 使用するモデル（1モデル1枚）
+        parse_type: モデル選択の統計用（exterior / interior / floor_plan）
         callback: 1枚完成するごとに呼ばれる非同期関数 callback(index, url)
 
     Returns:
-        生成された画像のURLリスト
+        生成された画像のURLリスト（models と同じ順）
     """
     import sys
 
-    # 使用する4つの異なるモデル/エンジン（元々のもの）
-    MODELS = [
-        "nano-banana-pro",
-        "gpt-image/1.5-image-to-image",
-        "seedream/4.5-edit",
-        "flux-2/flex-image-to-image",
-    ]
+    urls = [None] * len(models)
 
-    try:
-        print(f"[KIE] Starting multi-generation with {count} models", flush=True)
+    async def generate_with_callback(index: int, model: str):
+        """1枚生成してコールバックを呼ぶ"""
+        print(f"[KIE] Starting generation {index} with model: {model}", flush=True)
         sys.stdout.flush()
 
-        # 1. 画像をBase64に変換
-        base64_image = image_bytes_to_base64(image_bytes)
-        print(f"[KIE] Image converted to base64", flush=True)
+        result = await generate_one(image_url, prompt, model, parse_type, models[:index].count(model))
+        urls[index] = result
+
+        if result:
+            print(f"[KIE] Generation {index} ({model}) completed: {result[:50]}...", flush=True)
+        else:
+            print(f"[KIE] Generation {index} ({model}) failed", flush=True)
         sys.stdout.flush()
 
-        # 2. 画像をアップロード（1回だけ）
-        image_url = await upload_image(base64_image)
-        if not image_url:
-            print("[KIE] Image upload failed", flush=True)
-            sys.stdout.flush()
-            return [None] * count
+        # コールバックがあれば即座に呼ぶ
+        if callback and result:
+            try:
+                print(f"[KIE] Calling callback for generation {index}", flush=True)
+                sys.stdout.flush()
+                await callback(index, result)
+                print(f"[KIE] Callback {index} completed", flush=True)
+                sys.stdout.flush()
+            except Exception as e:
+                print(f"[KIE] Callback error for {index}: {e}", flush=True)
+                sys.stdout.flush()
 
-        print(f"[KIE] Image uploaded: {image_url[:50]}...", flush=True)
-        sys.stdout.flush()
+        return result
 
-        # 3. 4つのモデルで同時生成（1枚ごとにコールバック）
-        urls = [None] * count
+    # 全タスクを並列実行（ジョブが取り消されたら残りのタスクもまとめて取り消される）
+    print(f"[KIE] Launching {len(models)} parallel tasks", flush=True)
+    sys.stdout.flush()
 
-        async def generate_with_callback(index: int, model: str):
-            """1枚生成してコールバックを呼ぶ"""
-            print(f"[KIE] Starting generation {index} with model: {model}", flush=True)
-            sys.stdout.flush()
+    async with asyncio.TaskGroup() as group:
+        for i, model in enumerate(models):
+            group.create_task(generate_with_callback(i, model))
 
-            result = await generate_parse_single(image_url, prompt, model)
-            urls[index] = result
+    print(f"[KIE] All tasks completed. Results: {['success' if url else 'failed' for url in urls]}", flush=True)
+    sys.stdout.flush()
 
-            if result:
-                print(f"[KIE] Generation {index} ({model}) completed: {result[:50]}...", flush=True)
-            else:
-                print(f"[KIE] Generation {index} ({model}) failed", flush=True)
-            sys.stdout.flush()
-
-            # コールバックがあれば即座に呼ぶ
-            if callback and result:
-                try:
-                    print(f"[KIE] Calling callback for generation {index}", flush=True)
-                    sys.stdout.flush()
-                    await callback(index, result)
-                    print(f"[KIE] Callback {index} completed", flush=True)
-                    sys.stdout.flush()
-                except Exception as e:
-                    print(f"[KIE] Callback error for {index}: {e}", flush=True)
-                    sys.stdout.flush()
-
-            return result
-
-        # 全タスクを並列実行
-        tasks = []
-        for i in range(min(count, len(MODELS))):
-            model = MODELS[i]
-            tasks.append(generate_with_callback(i, model))
-
-        print(f"[KIE] Launching {len(tasks)} parallel tasks", flush=True)
-        sys.stdout.flush()
+    return urls
 
-        results = await asyncio.gather(*tasks, return_exceptions=True)
 
-        print(f"[KIE] All tasks completed. Results: {[type(r).__name__ if isinstance(r, Exception) else ('success' if r else 'failed') for r in results]}", flush=True)
-        sys.stdout.flush()
+async def generate_parse_multi(image_bytes: bytes, prompt: str, count: int = 4, callback=None, parse_type: str = "") -> list[Optional[str]]:
+    """
+    画像からパースを複数枚同時生成（1枚ごとにコールバック）
 
-        return urls
+    Args:
+        image_bytes: 画像のバイトデータ
+        prompt: 生成プロンプト
+        count: 生成枚数（デフォルト4枚）
+        callback: 1枚完成するごとに呼ばれる非同期関数 callback(index, url)
+        parse_type: モデル選択の統計用
+
+    Returns:
+        生成された画像のURLリスト
+    """
+    try:
+        print(f"[KIE] Starting multi-generation with {count} models", flush=True)
+
+        image_url = await prepare_source(image_bytes)
+        if not image_url:
+            return [None] * count
+
+        # parse_type の実績から選んだモデルで同時生成（1枚ごとにコールバック）
+        models = model_router.plan(parse_type, MODELS, count)
+        return await generate_from_url(image_url, prompt, models, parse_type, callback)
 
     except Exception as e:
         print(f"[KIE] Multi-generation error: {e}", flush=True)
-        sys.stdout.flush()
         import traceback
         traceback.print_exc()
         return [None] * count
@@ -0,0 +1,134 @@
+"""
+イベントループの遅延（lag）監視とブロッキング呼び出しの検出
+ループ上のタスクが一定間隔で起きて寝過ごした時間を計測し、
+別スレッドのウォッチドッグがハートビートの途絶を検知した時点で
+ループスレッドのスタックを取得する（どの同期呼び出しがループを止めているかが分かる）
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from config import settings
+from services.metrics import registry
+
+# ループが止まっている間に取得するスタックの最大フレーム数
+MAX_STACK_FRAMES = 30
+
+
+class LoopMonitor:
+    def __init__(self, interval: Optional[float] = None, threshold: Optional[float] = None, history: int = 50):
+        self.interval = interval or settings.LOOP_MONITOR_INTERVAL
+        self.threshold = threshold or settings.LOOP_BLOCK_THRESHOLD
+        self.samples = deque(maxlen=1000)
+        self.stalls = deque(maxlen=history)
+        self.max_lag = 0.0
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat = time.monotonic()
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._current_stall = None
+        self.lag_histogram = registry.histogram(
+            "parse_event_loop_lag_seconds", "Event loop scheduling delay",
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+        )
+        self.stall_counter = registry.counter("parse_event_loop_stalls_total", "Event loop blocked longer than the threshold")
+
+    def start(self):
+        """イベントループ上から呼ぶ"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = self.loop.create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        print(f"Loop monitor started (interval={self.interval}s, threshold={self.threshold}s)", flush=True)
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _sample(self):
+        """一定間隔で起き、予定より遅れた時間をlagとして記録"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.heartbeat = now
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.lag_histogram.observe(lag)
+
+    def _watch(self):
+        """ウォッチドッグ: ハートビートが途絶えたらループスレッドのスタックを取得"""
+        check_interval = max(0.01, min(self.interval, self.threshold) / 2)
+        while not self._stopped.wait(check_interval):
+            blocked = time.monotonic() - self.heartbeat - self.interval
+            if blocked > self.threshold:
+                if self._current_stall is None:
+                    self._current_stall = self._capture(blocked)
+                else:
+                    self._current_stall["blocked_seconds"] = round(blocked, 3)
+            elif self._current_stall is not None:
+                # ループが復帰: 停止時間を確定してログ出力
+                stall = self._current_stall
+                self._current_stall = None
+                self.stall_counter.inc()
+                print(
+                    f"[LoopMonitor] Event loop blocked for {stall['blocked_seconds']}s in {stall['task']}:\n"
+                    + "".join(stall["stack"][-8:]),
+                    flush=True
+                )
+
+    def _capture(self, blocked: float) -> dict:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = traceback.format_stack(frame, limit=MAX_STACK_FRAMES) if frame else []
+        # ループを止めているタスク（読み取りのみ）
+        task = asyncio.tasks._current_tasks.get(self.loop) if self.loop else None
+        stall = {
+            "time": time.time(),
+            "blocked_seconds": round(blocked, 3),
+            "task": task.get_name() if task else "(callback)",
+            "coroutine": getattr(task.get_coro(), "__qualname__", "") if task else "",
+            "stack": stack,
+        }
+        self.stalls.append(stall)
+        return stall
+
+    def summary(self) -> dict:
+        """lagのパーセンタイル（直近のサンプル）"""
+        ordered = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 4)
+
+        return {
+            "enabled": self._task is not None and not self._task.done(),
+            "samples": len(ordered),
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": round(self.max_lag, 4),
+            "stalls": len(self.stalls),
+        }
+
+    def recent_stalls(self) -> list:
+        return list(reversed(self.stalls))
+
+
+# シングルトンインスタンス
+loop_monitor = LoopMonitor()
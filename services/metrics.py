@@ -0,0 +1,202 @@
+"""
+Prometheus形式のメトリクス
+カウンタ・ゲージ・ヒストグラムを最小限の実装で持ち、/metrics でテキスト形式に書き出す
+記録側は辞書の加算のみ（ホットパスへの影響を無視できる程度）
+キューの長さ等の状態値はスクレイプ時にコールバックで取得する
+"""
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional, Sequence
+
+# モデルの生成時間は数十秒〜数分のため、それに合わせたバケット
+MODEL_DURATION_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240)
+# 外部API・DB呼び出し用
+CALL_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.label_names:
+            items = [((), 0)]
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), callback: Optional[Callable] = None):
+        """
+        Args:
+            callback: スクレイプ時に値を返す関数。ラベル付きの場合は {(ラベル値, ...): 値} を返す
+        """
+        super().__init__(name, documentation, labels)
+        self.values = {}
+        self.callback = callback
+
+    def set(self, value: float, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    @contextmanager
+    def track(self, *label_values):
+        """ブロック実行中だけ1増やす（実行中の件数用）"""
+        self.inc(*label_values)
+        try:
+            yield
+        finally:
+            self.dec(*label_values)
+
+    def render(self) -> list:
+        if self.callback:
+            try:
+                result = self.callback()
+            except Exception as e:
+                print(f"Metrics callback error ({self.name}): {e}", flush=True)
+                return []
+            items = sorted(result.items()) if isinstance(result, dict) else [((), result)]
+        else:
+            with self.lock:
+                items = sorted(self.values.items())
+            if not items and not self.label_names:
+                items = [((), 0)]
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = CALL_DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル値 -> [バケットごとの件数..., 合計, 件数]
+        self.values = {}
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        with self.lock:
+            items = sorted((labels, list(series)) for labels, series in self.values.items())
+        lines = self.header()
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(round(series[-2], 6))}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = (), callback: Optional[Callable] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = CALL_DURATION_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# シングルトンインスタンス
+registry = Registry()
+
+# --- 生成 ---
+model_duration = registry.histogram(
+    "parse_model_duration_seconds", "Time from webhook token to result per model",
+    ["model", "outcome"], MODEL_DURATION_BUCKETS
+)
+model_results = registry.counter(
+    "parse_model_results_total", "Generation results per model (success / fail / timeout / deadline)",
+    ["model", "outcome"]
+)
+jobs_in_flight = registry.gauge("parse_jobs_in_flight", "Generation jobs currently running")
+jobs_total = registry.counter("parse_jobs_total", "Finished generation jobs by outcome", ["outcome"])
+
+# --- 外部API ---
+line_api_errors = registry.counter("parse_line_api_errors_total", "LINE API errors by endpoint and status", ["endpoint", "status"])
+upstream_duration = registry.histogram("parse_upstream_duration_seconds", "Upstream HTTP latency until response headers (KIE.AI / webhook.site / LINE content)", ["endpoint"])
+
+# --- DB / Sheets ---
+db_call_duration = registry.histogram("parse_db_call_duration_seconds", "UserDB call latency including thread pool wait", ["method"])
+db_call_errors = registry.counter("parse_db_call_errors_total", "UserDB call errors and timeouts", ["method", "kind"])
+sheets_api_duration = registry.histogram("parse_sheets_api_duration_seconds", "Google Sheets API request latency", ["kind"])
+sheets_api_retries = registry.counter("parse_sheets_api_retries_total", "Google Sheets API retries", ["kind"])
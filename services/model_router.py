@@ -0,0 +1,194 @@
+"""
+モデル選択（parse_type ごとの適応ルーティング）
+(model, parse_type) ごとに直近の生成時間と成功率を記録し、
+N枚そろうまでの期待時間が短くなるようにモデルを選ぶ
+- 期待時間 = 成功時の生成時間の中央値 ÷ 成功率
+- 成功率が低すぎるモデルは、最も期待時間の短いモデルで置き換える
+- 一定確率で実績の少ないモデルも試す（探索）ため、統計は更新され続ける
+統計は DATA_DIR/model_stats.json に保存し、再起動後も引き継ぐ
+"""
+import json
+import os
+import random
+import statistics
+import threading
+from collections import deque
+from typing import Optional
+
+from config import settings
+
+# 直近何件の結果を使うか
+WINDOW = 50
+# 統計を信用する最小件数（これ未満はデフォルト順で選ぶ）
+MIN_SAMPLES = 3
+# 何件記録するごとにファイルへ保存するか
+SAVE_EVERY = 10
+
+
+class ModelStats:
+    def __init__(self, results: Optional[list] = None):
+        self.results = deque(results or [], maxlen=WINDOW)  # (秒, 成功したか)
+
+    def record(self, seconds: float, success: bool):
+        self.results.append((seconds, success))
+
+    @property
+    def samples(self) -> int:
+        return len(self.results)
+
+    @property
+    def success_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(1 for _, success in self.results if success) / len(self.results)
+
+    @property
+    def median_success_seconds(self) -> Optional[float]:
+        durations = [seconds for seconds, success in self.results if success]
+        return statistics.median(durations) if durations else None
+
+    def expected_seconds(self) -> Optional[float]:
+        """1枚成功するまでの期待時間（失敗したら別モデルでやり直す前提の近似）"""
+        median = self.median_success_seconds
+        if median is None:
+            return None
+        return median / max(self.success_rate, 0.1)
+
+    def summary(self) -> dict:
+        median = self.median_success_seconds
+        expected = self.expected_seconds()
+        return {
+            "samples": self.samples,
+            "success_rate": round(self.success_rate, 3),
+            "median_success_seconds": round(median, 1) if median is not None else None,
+            "expected_seconds": round(expected, 1) if expected is not None else None,
+        }
+
+
+class ModelRouter:
+    def __init__(self, stats_path: Optional[str] = None, exploration: Optional[float] = None,
+                 min_success_rate: Optional[float] = None):
+        """
+        Args:
+            stats_path: 統計の保存先（JSON）
+            exploration: 実績の少ないモデル・除外中のモデルを試す確率
+            min_success_rate: これ未満の成功率のモデルは他のモデルで置き換える
+        """
+        self.stats_path = stats_path or os.path.join(settings.DATA_DIR, "model_stats.json")
+        self.exploration = settings.ROUTER_EXPLORATION if exploration is None else exploration
+        self.min_success_rate = settings.ROUTER_MIN_SUCCESS_RATE if min_success_rate is None else min_success_rate
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self._load()
+
+    def _load(self):
+        """前回プロセスの統計を復元"""
+        if not os.path.exists(self.stats_path):
+            return
+        try:
+            with open(self.stats_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for entry in data.get("stats", []):
+                results = [(float(seconds), bool(success)) for seconds, success in entry["results"]]
+                self.stats[(entry["model"], entry["parse_type"])] = ModelStats(results)
+            print(f"[ModelRouter] Loaded stats for {len(self.stats)} model/type pairs", flush=True)
+        except Exception as e:
+            print(f"[ModelRouter] Stats load error: {e}", flush=True)
+
+    def save(self) -> bool:
+        """統計をファイルに保存（一時ファイル経由で置き換え）"""
+        with self.lock:
+            data = {"stats": [
+                {"model": model, "parse_type": parse_type, "results": [[round(s, 2), ok] for s, ok in stats.results]}
+                for (model, parse_type), stats in self.stats.items()
+            ]}
+            self.unsaved = 0
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.stats_path)), exist_ok=True)
+            tmp_path = f"{self.stats_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.stats_path)
+            return True
+        except Exception as e:
+            print(f"[ModelRouter] Stats save error: {e}", flush=True)
+            return False
+
+    def record(self, model: str, parse_type: str, seconds: float, outcome: str):
+        """生成結果を記録（outcome: success / fail / timeout）"""
+        with self.lock:
+            stats = self.stats.setdefault((model, parse_type), ModelStats())
+            stats.record(seconds, outcome == "success")
+            self.unsaved += 1
+            should_save = self.unsaved >= SAVE_EVERY
+        if should_save:
+            self.save()
+
+    def _ranked(self, parse_type: str, candidates: list) -> tuple:
+        """
+        候補を期待時間の短い順に並べる
+
+        Returns:
+            (実績のあるモデル, 実績の少ないモデル, 成功率が低いモデル)
+            実績の少ないモデルはデフォルト順（QUICK_DEFAULT_MODEL → candidates の順）
+        """
+        known, unknown, unhealthy = [], [], []
+        with self.lock:
+            for model in candidates:
+                stats = self.stats.get((model, parse_type))
+                if not stats or stats.samples < MIN_SAMPLES:
+                    unknown.append(model)
+                elif stats.success_rate < self.min_success_rate or stats.expected_seconds() is None:
+                    unhealthy.append(model)
+                else:
+                    known.append((stats.expected_seconds(), model))
+        known.sort()
+        if settings.QUICK_DEFAULT_MODEL in unknown:
+            unknown.remove(settings.QUICK_DEFAULT_MODEL)
+            unknown.insert(0, settings.QUICK_DEFAULT_MODEL)
+        return [model for _, model in known], unknown, unhealthy
+
+    def plan(self, parse_type: str, candidates: list, count: int) -> list:
+        """
+        count枚そろうまでの期待時間が短くなるようにモデルを選ぶ
+
+        Args:
+            parse_type: exterior / interior / floor_plan
+            candidates: 候補モデル
+            count: 生成枚数（1モデル1枚）
+
+        Returns:
+            count個のモデル（期待時間の短い順）
+            成功率が低いモデルの枠は最速のモデルで埋める（同じモデルが複数回入ることがある）
+        """
+        known, unknown, unhealthy = self._ranked(parse_type, candidates)
+        usable = known + unknown
+        if not usable:
+            # 全モデルの成功率が低い場合はそのまま使う
+            usable, unhealthy = unhealthy, []
+
+        # 足りない枠は期待時間の短い順に繰り返して埋める
+        chosen = [usable[i % len(usable)] for i in range(count)]
+
+        # 探索: 一定確率で最後の枠を未選択のモデル（実績の少ないもの・除外中のもの）に置き換える
+        untried = [model for model in unknown + unhealthy if model not in chosen]
+        if untried and chosen and random.random() < self.exploration:
+            chosen[-1] = random.choice(untried)
+        return chosen
+
+    def ranking(self, parse_type: str, candidates: list) -> dict:
+        known, unknown, unhealthy = self._ranked(parse_type, candidates)
+        return {"ranked": known, "few_samples": unknown, "excluded": unhealthy}
+
+    def fastest(self, parse_type: str, candidates: list) -> str:
+        """parse_type で最も早く1枚届くと期待されるモデル（探索を含む）"""
+        return self.plan(parse_type, candidates, 1)[0]
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {f"{model}|{parse_type}": stats.summary() for (model, parse_type), stats in self.stats.items()}
+
+
+# シングルトンインスタンス
+model_router = ModelRouter()
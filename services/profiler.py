@@ -0,0 +1,269 @@
+"""
+本番インスタンス用のオンデマンドプロファイラ
+- CPU: 全スレッドのスタックを一定間隔でサンプリング（ループスレッドは実行中のasyncioタスク名付き）
+  同時にループ上で各タスクのawait中のコルーチンチェーンもサンプリングし、どこで待っているかを集計する
+- メモリ: tracemalloc のスナップショットを取り、前回との差分と大きなメモリブロックの確保元を出す
+レポートは collapsed stack 形式（speedscope / flamegraph.pl でそのまま開ける）またはテキスト
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+# 1回のプロファイルの上限（秒）
+MAX_PROFILE_SECONDS = 60
+# 待機中とみなすトップフレームの関数名（idle=false のとき除外）
+IDLE_FUNCTIONS = {"select", "poll", "wait", "_wait_for_tstate_lock", "get", "accept", "_worker", "sleep"}
+# 大きなメモリブロックとみなすサイズ（画像バイト列・Base64文字列の検出用）
+LARGE_BLOCK_BYTES = 256 * 1024
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _frame_label(code) -> str:
+    """collapsed stack 用の関数ラベル"""
+    filename = code.co_filename
+    if filename.startswith(PROJECT_ROOT):
+        filename = os.path.relpath(filename, PROJECT_ROOT)
+    else:
+        filename = "/".join(filename.split(os.sep)[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _thread_stack(frame) -> list:
+    """フレームを根元から順に並べたラベルのリスト"""
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _coroutine_chain(coro) -> list:
+    """タスクのコルーチンから await 先を辿ったラベルのリスト"""
+    chain = []
+    seen = 0
+    while coro is not None and seen < 64:
+        code = getattr(coro, "cr_code", None) or getattr(coro, "gi_code", None) or getattr(coro, "ag_code", None)
+        if code is None:
+            # Future等（awaitの末端）
+            chain.append(type(coro).__name__)
+            break
+        chain.append(_frame_label(code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+        seen += 1
+    return chain
+
+
+class ProfileReport:
+    def __init__(self, seconds: float, interval: float, include_idle: bool):
+        self.seconds = seconds
+        self.interval = interval
+        self.include_idle = include_idle
+        self.started_at = time.time()
+        self.cpu_samples = 0
+        self.cpu_stacks = Counter()
+        self.async_samples = 0
+        self.async_stacks = Counter()
+
+    def collapsed(self, kind: str = "cpu") -> str:
+        """collapsed stack 形式（"frame;frame;frame count" の行）"""
+        stacks = self.cpu_stacks if kind == "cpu" else self.async_stacks
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+    def top_functions(self, limit: int = 30) -> list:
+        """自己時間（スタックの末端）の多い関数"""
+        self_counts = Counter()
+        for stack, count in self.cpu_stacks.items():
+            self_counts[stack.rsplit(";", 1)[-1]] += count
+        total = self.cpu_samples or 1
+        return [
+            {"function": name, "samples": count, "percent": round(count * 100 / total, 1)}
+            for name, count in self_counts.most_common(limit)
+        ]
+
+    def to_dict(self, limit: int = 30) -> dict:
+        return {
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "include_idle": self.include_idle,
+            "cpu_samples": self.cpu_samples,
+            "async_samples": self.async_samples,
+            "top_functions": self.top_functions(limit),
+            "top_awaits": [
+                {"stack": stack, "samples": count}
+                for stack, count in self.async_stacks.most_common(limit)
+            ],
+        }
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.lock.locked()
+
+    async def profile(self, seconds: float, interval: float = 0.005, include_idle: bool = False) -> ProfileReport:
+        """
+        指定秒数のサンプリングプロファイルを取る（同時に1つまで）
+
+        Args:
+            seconds: 計測時間（MAX_PROFILE_SECONDS まで）
+            interval: スレッドスタックのサンプリング間隔（秒）
+            include_idle: 待機中のスレッドのサンプルも含める（wall-clock）
+        """
+        seconds = max(0.1, min(seconds, MAX_PROFILE_SECONDS))
+        interval = max(0.001, interval)
+        async with self.lock:
+            report = ProfileReport(seconds, interval, include_idle)
+            loop = asyncio.get_running_loop()
+            stopped = threading.Event()
+            sampler = threading.Thread(
+                target=self._sample_threads,
+                args=(report, loop, threading.get_ident(), stopped),
+                name="profiler",
+                daemon=True
+            )
+            sampler.start()
+            try:
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    self._sample_tasks(report)
+                    await asyncio.sleep(0.05)
+            finally:
+                stopped.set()
+                await asyncio.to_thread(sampler.join)
+            return report
+
+    def _sample_threads(self, report: ProfileReport, loop, loop_thread_id: int, stopped: threading.Event):
+        """別スレッド: 全スレッドのスタックをサンプリング"""
+        names = {}
+        own_id = threading.get_ident()
+        while not stopped.wait(report.interval):
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if not report.include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                stack = _thread_stack(frame)
+                if thread_id == loop_thread_id:
+                    task = asyncio.tasks._current_tasks.get(loop)
+                    root = f"loop[{task.get_name() if task else 'idle'}]"
+                    if task is None and not report.include_idle:
+                        # ループがselectで待機中（実行中のタスクなし）
+                        continue
+                else:
+                    root = f"thread[{names.get(thread_id, thread_id)}]"
+                report.cpu_stacks[";".join([root] + stack)] += 1
+                report.cpu_samples += 1
+
+    def _sample_tasks(self, report: ProfileReport):
+        """ループ上: 各タスクがどのコルーチンでawait中かを記録"""
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is current or task.done():
+                continue
+            chain = _coroutine_chain(task.get_coro())
+            report.async_stacks[";".join(chain)] += 1
+            report.async_samples += 1
+
+
+class HeapTracker:
+    """tracemalloc のスナップショットと差分"""
+
+    def __init__(self):
+        self.previous = None
+        self.previous_at = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 10) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.previous = tracemalloc.take_snapshot()
+        self.previous_at = time.time()
+        return self.status()
+
+    def stop(self) -> dict:
+        tracemalloc.stop()
+        self.previous = None
+        self.previous_at = None
+        return self.status()
+
+    def status(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "frames": tracemalloc.get_traceback_limit() if tracemalloc.is_tracing() else 0,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "baseline_at": self.previous_at,
+        }
+
+    def report(self, limit: int = 25, group_by: str = "lineno", min_block: int = LARGE_BLOCK_BYTES) -> Optional[str]:
+        """
+        スナップショットを取り、前回との差分・現在の上位・大きなブロックをテキストで返す
+        （呼び出し後はこのスナップショットが次回の比較基準になる）
+        """
+        if not tracemalloc.is_tracing():
+            return None
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        now = time.time()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"# tracemalloc report at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))}",
+            f"# traced: {current / 1024 / 1024:.1f} MiB  peak: {peak / 1024 / 1024:.1f} MiB",
+            "",
+        ]
+
+        if self.previous is not None:
+            lines.append(f"## Top {limit} differences since {time.strftime('%H:%M:%S', time.localtime(self.previous_at))} (by {group_by})")
+            for stat in snapshot.compare_to(self.previous, group_by)[:limit]:
+                lines.append(f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+7d} blocks  {stat.traceback.format(limit=1)[0].strip()}")
+            lines.append("")
+
+        lines.append(f"## Top {limit} allocations (by {group_by})")
+        for stat in snapshot.statistics(group_by)[:limit]:
+            lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:7d} blocks  {stat.traceback.format(limit=1)[0].strip()}")
+        lines.append("")
+
+        # 大きなブロック（画像バイト列・Base64文字列など）を確保元ごとに
+        large = [trace for trace in snapshot.traces if trace.size >= min_block]
+        lines.append(f"## Blocks >= {min_block // 1024} KiB: {len(large)} ({sum(t.size for t in large) / 1024 / 1024:.1f} MiB)")
+        by_origin = Counter()
+        sizes = Counter()
+        tracebacks = {}
+        for trace in large:
+            key = tuple(str(frame) for frame in trace.traceback)
+            by_origin[key] += 1
+            sizes[key] += trace.size
+            tracebacks[key] = trace.traceback
+        for key, size in sizes.most_common(limit):
+            lines.append(f"{size / 1024 / 1024:8.2f} MiB in {by_origin[key]} blocks, allocated at:")
+            lines.extend(f'    File "{frame.filename}", line {frame.lineno}' for frame in reversed(list(tracebacks[key])))
+        lines.append("")
+
+        self.previous = snapshot
+        self.previous_at = now
+        return "\n".join(lines)
+
+
+# シングルトンインスタンス
+profiler = SamplingProfiler()
+heap_tracker = HeapTracker()
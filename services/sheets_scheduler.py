@@ -0,0 +1,152 @@
+"""
+Google Sheets APIリクエストスケジューラ
+読み取り・書き込みの分間クォータをトークンバケットで平準化し、
+429 / 5xx はジッター付き指数バックオフで再試行する
+呼び出し元の期限（run_until）を過ぎる待ち・再試行はせず、待つのをやめた呼び出しでスレッドを塞がない
+"""
+import random
+import threading
+import time
+from typing import Optional
+
+import gspread
+import requests
+
+from config import settings
+from services.metrics import sheets_api_duration, sheets_api_retries
+
+
+class TokenBucket:
+    """分間クォータ用のトークンバケット（スレッドセーフ・ブロッキング）"""
+
+    def __init__(self, per_minute: int, burst: Optional[int] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1, per_minute // 6)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline: Optional[float] = None) -> float:
+        """
+        トークンを1つ取得（足りなければ待つ）。待った秒数を返す
+
+        Raises:
+            TimeoutError: 待つと deadline（time.monotonic）を過ぎる場合
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait >= deadline:
+                raise TimeoutError("Sheets quota wait exceeds the caller's deadline")
+            time.sleep(wait)
+            waited += wait
+
+
+def is_retryable(error: Exception) -> bool:
+    """再試行すべきエラーか（429・5xx・通信エラー）"""
+    if isinstance(error, gspread.exceptions.APIError):
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", 0)
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class SheetsScheduler:
+    def __init__(self):
+        self.buckets = {
+            "read": TokenBucket(settings.SHEETS_READ_QUOTA_PER_MIN),
+            "write": TokenBucket(settings.SHEETS_WRITE_QUOTA_PER_MIN),
+        }
+        self.max_retries = settings.SHEETS_MAX_RETRIES
+        self._local = threading.local()  # スレッドごとの呼び出し元の期限
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            kind: {"calls": 0, "retries": 0, "failures": 0, "throttled_seconds": 0.0, "latency_seconds": 0.0}
+            for kind in self.buckets
+        }
+
+    def call(self, kind: str, func, *args, **kwargs):
+        """
+        クォータを守ってgspreadの呼び出しを実行
+
+        Args:
+            kind: "read" または "write"
+            func: gspreadのメソッド
+        """
+        attempt = 0
+        deadline = getattr(self._local, "deadline", None)
+        while True:
+            try:
+                waited = self.buckets[kind].acquire(deadline)
+            except TimeoutError:
+                with self.stats_lock:
+                    self.stats[kind]["failures"] += 1
+                raise
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+                self._record(kind, waited, time.monotonic() - start)
+                return result
+            except Exception as e:
+                self._record(kind, waited, time.monotonic() - start)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    with self.stats_lock:
+                        self.stats[kind]["failures"] += 1
+                    raise
+                # フルジッター付き指数バックオフ（同時再試行でバーストを増幅しない）
+                backoff = random.uniform(0, min(settings.SHEETS_MAX_BACKOFF, settings.SHEETS_BASE_BACKOFF * (2 ** attempt)))
+                if deadline is not None and time.monotonic() + backoff >= deadline:
+                    # 呼び出し元はもう待っていないので再試行しない
+                    with self.stats_lock:
+                        self.stats[kind]["failures"] += 1
+                    print(f"[Sheets] {kind} giving up (caller deadline): {e}", flush=True)
+                    raise
+                attempt += 1
+                with self.stats_lock:
+                    self.stats[kind]["retries"] += 1
+                sheets_api_retries.inc(kind)
+                print(f"[Sheets] {kind} retry {attempt}/{self.max_retries} in {backoff:.1f}s: {e}", flush=True)
+                time.sleep(backoff)
+
+    def _record(self, kind: str, waited: float, elapsed: float):
+        with self.stats_lock:
+            stats = self.stats[kind]
+            stats["calls"] += 1
+            stats["throttled_seconds"] += waited
+            stats["latency_seconds"] += elapsed
+        sheets_api_duration.observe(elapsed, kind)
+
+    def run_until(self, deadline: Optional[float], func, *args, **kwargs):
+        """
+        呼び出し元の期限（time.monotonic）を付けて func を実行する
+        func の中のSheets呼び出しは、期限を過ぎるクォータ待ち・再試行をせずに失敗する
+        """
+        self._local.deadline = deadline
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.deadline = None
+
+    def read(self, func, *args, **kwargs):
+        return self.call("read", func, *args, **kwargs)
+
+    def write(self, func, *args, **kwargs):
+        return self.call("write", func, *args, **kwargs)
+
+    def metrics(self) -> dict:
+        with self.stats_lock:
+            return {
+                kind: {key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()}
+                for kind, stats in self.stats.items()
+            }
+
+
+# シングルトンインスタンス（プロセス内の全Sheets呼び出しで共有）
+sheets_scheduler = SheetsScheduler()
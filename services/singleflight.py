@@ -0,0 +1,83 @@
+"""
+同一処理の重複実行をまとめる（single-flight）
+同じキーの処理が実行中なら新たに実行せず、実行中のタスクの結果を共有する
+（「OK」の連打や同じ画像の二重送信で有料の生成が重複しないようにする）
+
+共有する処理はどのジョブにも属さない空のコンテキストで実行する。最初に呼んだジョブの期限（remaining_timeout）や
+トレースを引き継がないので、相乗りした別のユーザーのジョブが他人の期限で打ち切られることはない。
+処理中のspanは結果を待つ各ジョブのトレースに写す
+"""
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Hashable, Optional
+
+from services.metrics import registry
+from services.tracing import JobTrace, tracer
+
+coalesced_calls = registry.counter("parse_coalesced_calls_total", "Calls that attached to an identical in-flight call", ["kind"])
+
+
+class SingleFlight:
+    def __init__(self, kind: str):
+        """
+        Args:
+            kind: メトリクスのラベル（upload / generate など）
+        """
+        self.kind = kind
+        self.calls = {}  # {キー: asyncio.Task}
+        self.waiting = {}  # {asyncio.Task: 待っている呼び出し元の数}
+        self.traces = {}  # {asyncio.Task: 処理中のspanを集めるトレース}
+        self.attached = set()  # spanを写し終えたジョブのある処理
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable], timeout: Optional[float] = None) -> tuple:
+        """
+        キーごとに fn() を1回だけ実行する
+
+        Args:
+            timeout: 共有する処理全体の期限（秒）。呼び出し元のジョブの期限は引き継がないため明示する
+
+        Returns:
+            (結果, 実行中の処理に相乗りしたか)
+
+        Raises:
+            TimeoutError: timeout までに処理が終わらなかった場合
+        """
+        task = self.calls.get(key)
+        if task is not None and task.cancelling():
+            # 取り消し中の処理には相乗りしない
+            task = None
+        shared = task is not None
+        if shared:
+            coalesced_calls.inc(self.kind)
+        else:
+            trace = JobTrace(f"{self.kind}.shared")
+            task = asyncio.get_running_loop().create_task(self._run(fn, trace, timeout), context=contextvars.Context())
+            self.calls[key] = task
+            self.traces[task] = trace
+            task.add_done_callback(lambda t: self.calls.pop(key) if self.calls.get(key) is t else None)
+        self.waiting[task] = self.waiting.get(task, 0) + 1
+        try:
+            # 呼び出し元がキャンセルされても、相乗りしている他の呼び出し元のために処理は続ける
+            return await asyncio.shield(task), shared
+        finally:
+            if task.done():
+                # 最初に結果を受け取ったジョブ以外のspanには印を付ける（負荷の記録で二重に数えないため）
+                tracer.attach(self.traces[task], **({"coalesced": True} if task in self.attached else {}))
+                self.attached.add(task)
+            self.waiting[task] -= 1
+            if not self.waiting[task]:
+                del self.waiting[task]
+                del self.traces[task]
+                self.attached.discard(task)
+                # 待っている呼び出し元がいなくなったら処理自体も取り消す
+                if not task.done():
+                    task.cancel()
+
+    @staticmethod
+    async def _run(fn: Callable[[], Awaitable], trace: JobTrace, timeout: Optional[float]):
+        with tracer.collect(trace):
+            async with asyncio.timeout(timeout):
+                return await fn()
+
+    def in_flight(self) -> int:
+        return len(self.calls)
@@ -0,0 +1,381 @@
+"""
+ユーザー管理DB（SQLite版）
+UserDBと同じインターフェースでローカルのSQLite（WALモード）に読み書きする
+Google Sheetsへは変更ログ（changelog）から非同期にレプリケーションする
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from config import settings
+from services.user_db import UserDB, partition_title
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    is_premium INTEGER NOT NULL DEFAULT 0,
+    premium_expires_at TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    used_at TEXT NOT NULL,
+    month TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_usage_user_month ON usage (user_id, month);
+CREATE TABLE IF NOT EXISTS gallery (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    parse_type TEXT NOT NULL,
+    custom_prompt TEXT NOT NULL,
+    image_url TEXT NOT NULL,
+    original_image_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_gallery_user ON gallery (user_id);
+CREATE TABLE IF NOT EXISTS changelog (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class SQLiteUserDB:
+    def __init__(self, db_path: Optional[str] = None, replicate: Optional[bool] = None):
+        self.db_path = db_path or settings.SQLITE_PATH or os.path.join(settings.DATA_DIR, "users.db")
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        print(f"SQLite database ready: {self.db_path}", flush=True)
+
+        # Sheetsへのレプリケーション（GOOGLE_SHEETS_IDが無ければ無効）
+        if replicate is None:
+            replicate = bool(settings.GOOGLE_SHEETS_ID)
+        self.replicator = SheetsReplicator(self) if replicate else None
+        if self.replicator:
+            self.replicator.start()
+
+    def _conn(self) -> sqlite3.Connection:
+        """スレッドごとの接続（WALなので読み取りは書き込みをブロックしない）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, statements: list, op: str, payload: dict):
+        """データ更新と変更ログを1トランザクションで書き込む"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute(
+                "INSERT INTO changelog (op, payload) VALUES (?, ?)",
+                (op, json.dumps(payload, ensure_ascii=False))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def create_user(self, user_id: str) -> bool:
+        """ユーザー作成（存在しなければ）"""
+        try:
+            conn = self._conn()
+            if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+                return True
+
+            created_at = datetime.now().isoformat()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)",
+                    (user_id, created_at)
+                )
+                if cursor.rowcount:
+                    conn.execute(
+                        "INSERT INTO changelog (op, payload) VALUES (?, ?)",
+                        ("create_user", json.dumps({"user_id": user_id, "created_at": created_at}))
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return True
+        except Exception as e:
+            print(f"Create user error: {e}")
+            return False
+
+    def get_user(self, user_id: str) -> Optional[dict]:
+        """ユーザー情報取得"""
+        try:
+            row = self._conn().execute(
+                "SELECT user_id, created_at, is_premium, premium_expires_at FROM users WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            if not row:
+                return None
+            return {
+                "user_id": row["user_id"],
+                "created_at": row["created_at"],
+                "is_premium": bool(row["is_premium"]),
+                "premium_expires_at": row["premium_expires_at"] or None
+            }
+        except Exception as e:
+            print(f"Get user error: {e}")
+            return None
+
+    def get_monthly_usage(self, user_id: str) -> int:
+        """今月の使用回数を取得（(user_id, month) インデックスを使用）"""
+        try:
+            current_month = datetime.now().strftime("%Y-%m")
+            row = self._conn().execute(
+                "SELECT COUNT(*) FROM usage WHERE user_id = ? AND month = ?",
+                (user_id, current_month)
+            ).fetchone()
+            return row[0]
+        except Exception as e:
+            print(f"Get monthly usage error: {e}")
+            return 0
+
+    def get_remaining_count(self, user_id: str) -> int:
+        """残り回数を取得（社内用：無制限）"""
+        return 999999
+
+    def increment_usage(self, user_id: str) -> bool:
+        """使用回数をインクリメント"""
+        try:
+            now = datetime.now()
+            row = [user_id, now.isoformat(), now.strftime("%Y-%m")]
+            self._write(
+                [("INSERT INTO usage (user_id, used_at, month) VALUES (?, ?, ?)", row)],
+                "usage", {"row": row}
+            )
+            return True
+        except Exception as e:
+            print(f"Increment usage error: {e}")
+            return False
+
+    def set_premium(self, user_id: str, expires_at: datetime) -> bool:
+        """プレミアム設定"""
+        try:
+            self.create_user(user_id)
+            self._write(
+                [("UPDATE users SET is_premium = 1, premium_expires_at = ? WHERE user_id = ?",
+                  (expires_at.isoformat(), user_id))],
+                "set_premium", {"user_id": user_id, "expires_at": expires_at.isoformat()}
+            )
+            return True
+        except Exception as e:
+            print(f"Set premium error: {e}")
+            return False
+
+    def cancel_premium(self, user_id: str) -> bool:
+        """プレミアム解除"""
+        try:
+            self._write(
+                [("UPDATE users SET is_premium = 0, premium_expires_at = '' WHERE user_id = ?", (user_id,))],
+                "cancel_premium", {"user_id": user_id}
+            )
+            return True
+        except Exception as e:
+            print(f"Cancel premium error: {e}")
+            return False
+
+    def save_to_gallery(self, user_id: str, parse_type: str, custom_prompt: str, image_url: str, original_image_id: str = "") -> bool:
+        """生成画像をギャラリーに保存"""
+        try:
+            row = [datetime.now().isoformat(), user_id, parse_type, custom_prompt, image_url, original_image_id]
+            self._write(
+                [("INSERT INTO gallery (created_at, user_id, parse_type, custom_prompt, image_url, original_image_id) "
+                  "VALUES (?, ?, ?, ?, ?, ?)", row)],
+                "gallery", {"row": row}
+            )
+            return True
+        except Exception as e:
+            print(f"Save to gallery error: {e}")
+            return False
+
+    def get_meta(self, key: str, default: str = "") -> str:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value: str):
+        self._conn().execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    def read_changelog(self, after_id: int, limit: int) -> list:
+        """レプリケーション用: 指定ID以降の変更ログ"""
+        rows = self._conn().execute(
+            "SELECT id, op, payload FROM changelog WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
+        return [(row["id"], row["op"], json.loads(row["payload"])) for row in rows]
+
+    def prune_changelog(self, upto_id: int):
+        """レプリケーション済みの変更ログを削除"""
+        self._conn().execute("DELETE FROM changelog WHERE id <= ?", (upto_id,))
+
+    def close(self):
+        """レプリケーションを停止（未送信分はできるだけ送る）"""
+        if self.replicator:
+            self.replicator.close()
+
+    def pending_writes(self) -> int:
+        """Sheets未反映の件数（レプリケーション待ちの変更ログ）"""
+        if not self.replicator:
+            return 0
+        cursor = int(self.get_meta("replicated_id", "0"))
+        return self._conn().execute("SELECT COUNT(*) FROM changelog WHERE id > ?", (cursor,)).fetchone()[0]
+
+    def metrics(self) -> dict:
+        result = {"backend": "sqlite", "db_path": self.db_path}
+        if self.replicator:
+            result["replication"] = self.replicator.metrics()
+        return result
+
+
+class SheetsReplicator:
+    """SQLiteの変更ログをGoogle Sheetsに非同期で反映する"""
+
+    BATCH_LIMIT = 500
+
+    def __init__(self, local_db: SQLiteUserDB, interval: Optional[float] = None):
+        self.local_db = local_db
+        self.interval = interval or settings.SQLITE_REPLICATION_INTERVAL
+        self.sheets_db = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self.replicated = 0
+        self.last_replicated_at = None
+        self.last_error = ""
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sheets-replicator", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> bool:
+        """Sheets接続（失敗しても次の周期で再試行）"""
+        if self.sheets_db:
+            return True
+        try:
+            self.sheets_db = UserDB()
+            if self.local_db.get_meta("bootstrapped") != "1":
+                self._bootstrap()
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"[Replicator] Sheets connection error: {e}", flush=True)
+            return False
+
+    def _bootstrap(self):
+        """初回のみ: Sheets上の既存ユーザー・使用履歴をローカルに取り込む"""
+        conn = self.local_db._conn()
+        users = self.sheets_db.users_ws.get_all_values()[1:]
+        usage = self.sheets_db.read_usage_rows()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in users:
+                if not row or not row[0]:
+                    continue
+                row = row + [""] * (4 - len(row))
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, created_at, is_premium, premium_expires_at) VALUES (?, ?, ?, ?)",
+                    (row[0], row[1], 1 if str(row[2]).lower() in ("true", "1", "on") else 0, row[3])
+                )
+            for row in usage:
+                if len(row) > 2 and row[0]:
+                    conn.execute("INSERT INTO usage (user_id, used_at, month) VALUES (?, ?, ?)", row[:3])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bootstrapped', '1')")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"[Replicator] Bootstrapped {len(users)} users, {len(usage)} usage rows from Sheets", flush=True)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.replicate_once()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[Replicator] Error: {e}", flush=True)
+            self._stopped.wait(self.interval)
+
+    def replicate_once(self) -> int:
+        """変更ログを1バッチ分Sheetsに反映"""
+        if not self._connect():
+            return 0
+
+        cursor = int(self.local_db.get_meta("replicated_id", "0"))
+        entries = self.local_db.read_changelog(cursor, self.BATCH_LIMIT)
+        if not entries:
+            return 0
+
+        buffer = self.sheets_db.write_buffer
+        done = cursor
+        applied = 0  # IDは途中が欠けることがあるので件数は別に数える
+        for entry_id, op, payload in entries:
+            if op == "usage":
+                # 元の記録時刻のままバッファへ（バッファ自体もスピルファイルで保護される）
+                buffer.append(partition_title("Usage", payload["row"][2]), payload["row"])
+            elif op == "gallery":
+                buffer.append(partition_title("Gallery", payload["row"][0][:7]), payload["row"])
+            elif op == "create_user":
+                if not self.sheets_db.create_user(payload["user_id"]):
+                    break
+            elif op == "set_premium":
+                if not self.sheets_db.set_premium(payload["user_id"], datetime.fromisoformat(payload["expires_at"])):
+                    break
+            elif op == "cancel_premium":
+                if not self.sheets_db.cancel_premium(payload["user_id"]):
+                    break
+            done = entry_id
+            applied += 1
+
+        buffer.flush()
+        if done > cursor:
+            self.local_db.set_meta("replicated_id", str(done))
+            self.local_db.prune_changelog(done)
+            self.replicated += applied
+            self.last_replicated_at = time.time()
+        return applied
+
+    def close(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            if self.sheets_db:
+                self.replicate_once()
+                self.sheets_db.close()
+        except Exception as e:
+            print(f"[Replicator] Final replication error: {e}", flush=True)
+
+    def metrics(self) -> dict:
+        return {
+            "connected": self.sheets_db is not None,
+            "backlog": self.local_db.pending_writes(),
+            "replicated": self.replicated,
+            "lag_seconds": round(time.time() - self.last_replicated_at, 1) if self.last_replicated_at else None,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,279 @@
+"""
+生成ジョブのステージ別トレース
+ジョブごとにIDを振り、ダウンロード・前処理・アップロード・createTask・ポーリング・LINE送信・DB書き込みの
+各区間（span）を記録する。直近のジョブはメモリ上のリングバッファに保持し、
+設定があればOTLP（OpenTelemetry）互換のJSON Linesとしてファイルにも書き出す
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+from config import settings
+
+# 現在のジョブ・親spanはcontextvarsで伝播させる（asyncio.gather のタスクにも引き継がれる）
+_current_job = contextvars.ContextVar("current_job", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent_id: Optional[str] = None, attributes: Optional[dict] = None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def fail(self, message: str):
+        """例外以外の失敗（戻り値None等）を記録"""
+        self.error = message
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "offset_ms": round((self.start - origin) * 1000, 1),
+            "duration_ms": round(self.duration * 1000, 1),
+            "status": "error" if self.error else ("ok" if self.end else "running"),
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """ジョブ外で呼ばれた場合のダミー"""
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def fail(self, message: str):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JobTrace:
+    def __init__(self, name: str, attributes: Optional[dict] = None):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(name, attributes=attributes)
+        self.spans = [self.root]
+        self.lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "name": self.root.name,
+            "started_at": self.root.start,
+            "duration_ms": round(self.root.duration * 1000, 1),
+            "status": "error" if self.root.error else ("ok" if self.root.end else "running"),
+            "outcome": self.root.attributes.get("outcome"),
+            "user_id": self.root.attributes.get("user_id"),
+            "spans": len(self.spans),
+        }
+
+    def stage_totals(self) -> dict:
+        """span名ごとの合計時間（ms）"""
+        totals = {}
+        for span in self.spans[1:]:
+            totals[span.name] = round(totals.get(span.name, 0.0) + span.duration * 1000, 1)
+        return totals
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return {
+            **self.summary(),
+            "attributes": self.root.attributes,
+            "error": self.root.error,
+            "stages": self.stage_totals(),
+            "timeline": [span.to_dict(self.root.start) for span in spans],
+        }
+
+    def to_otlp(self) -> dict:
+        """OTLP/JSON（ExportTraceServiceRequest）形式"""
+        def attributes(values: dict) -> list:
+            result = []
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    result.append({"key": key, "value": {"boolValue": value}})
+                elif isinstance(value, int):
+                    result.append({"key": key, "value": {"intValue": str(value)}})
+                elif isinstance(value, float):
+                    result.append({"key": key, "value": {"doubleValue": value}})
+                else:
+                    result.append({"key": key, "value": {"stringValue": str(value)}})
+            return result
+
+        spans = []
+        for span in self.spans:
+            item = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(int(span.start * 1e9)),
+                "endTimeUnixNano": str(int((span.end or time.time()) * 1e9)),
+                "attributes": attributes({**span.attributes, "job.id": self.job_id}),
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            spans.append(item)
+
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": attributes({"service.name": "ai-parse-line-bot"})},
+                "scopeSpans": [{"scope": {"name": "services.tracing"}, "spans": spans}],
+            }]
+        }
+
+
+class Tracer:
+    def __init__(self, max_jobs: Optional[int] = None, export_path: Optional[str] = None):
+        self.max_jobs = max_jobs or settings.TRACE_BUFFER_SIZE
+        self.export_path = export_path if export_path is not None else settings.TRACE_EXPORT_PATH
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.listeners = []  # ジョブ完了時に JobTrace を受け取る関数
+
+    @contextmanager
+    def job(self, name: str, **attributes):
+        """
+        ジョブのトレースを開始（このブロック内のspanがジョブに記録される）
+
+        Args:
+            name: ルートspan名
+            attributes: ジョブの属性（user_id, parse_type など）
+        """
+        trace = JobTrace(name, attributes)
+        with self.lock:
+            self.jobs[trace.job_id] = trace
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+
+        job_token = _current_job.set(trace)
+        span_token = _current_span.set(trace.root.span_id)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.root.fail(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            trace.root.end = time.time()
+            _current_span.reset(span_token)
+            _current_job.reset(job_token)
+            self._export(trace)
+            self._notify(trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """現在のジョブに区間を記録（ジョブ外では何もしない）"""
+        trace = _current_job.get()
+        if trace is None:
+            yield NOOP_SPAN
+            return
+
+        span = Span(name, parent_id=_current_span.get(), attributes=attributes)
+        token = _current_span.set(span.span_id)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end = time.time()
+            _current_span.reset(token)
+            trace.add(span)
+
+    @contextmanager
+    def collect(self, trace: JobTrace):
+        """
+        どのジョブにも属さない処理（複数のジョブで共有する処理など）のspanを trace に集める
+        集めたspanは attach() で結果を待つ各ジョブに写す
+        """
+        job_token = _current_job.set(trace)
+        span_token = _current_span.set(trace.root.span_id)
+        try:
+            yield trace
+        finally:
+            trace.root.end = time.time()
+            _current_span.reset(span_token)
+            _current_job.reset(job_token)
+
+    def attach(self, trace: JobTrace, **attributes):
+        """collect() で集めたspanを現在のジョブの現在のspanの下に写す（ジョブ外では何もしない）"""
+        current = _current_job.get()
+        if current is None:
+            return
+        parent_id = _current_span.get()
+        with trace.lock:
+            spans = trace.spans[1:]
+        for span in spans:
+            copy = Span(span.name, parent_id=parent_id if span.parent_id == trace.root.span_id else span.parent_id,
+                        attributes={**span.attributes, **attributes})
+            copy.span_id = span.span_id
+            copy.start = span.start
+            copy.end = span.end
+            copy.error = span.error
+            current.add(copy)
+
+    def current_job_id(self) -> Optional[str]:
+        trace = _current_job.get()
+        return trace.job_id if trace else None
+
+    def get(self, job_id: str) -> Optional[JobTrace]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def recent(self, limit: int = 50) -> list:
+        with self.lock:
+            traces = list(self.jobs.values())[-limit:]
+        return [trace.summary() for trace in reversed(traces)]
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, trace: JobTrace):
+        for listener in self.listeners:
+            try:
+                listener(trace)
+            except Exception as e:
+                print(f"Trace listener error: {e}", flush=True)
+
+    def _export(self, trace: JobTrace):
+        """OTLP互換のJSON Linesとして追記"""
+        if not self.export_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.export_path)), exist_ok=True)
+            line = json.dumps(trace.to_otlp(), ensure_ascii=False)
+            with self.lock:
+                with open(self.export_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            print(f"Trace export error: {e}", flush=True)
+
+
+# シングルトンインスタンス
+tracer = Tracer()
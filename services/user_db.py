@@ -4,14 +4,37 @@
 Render free tier (ephemeral storage) 対策のためスプレッドシートを使用
 """
 import os
+import re
+import threading
+import time
+from collections import Counter
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
 from typing import Optional
 from config import settings
+from services.write_buffer import WriteBehindBuffer
+from services.sheets_scheduler import sheets_scheduler
 
 import json
 
+# 月別パーティション（Usage_2026-10 など）のヘッダー
+PARTITION_HEADERS = {
+    "Usage": ["user_id", "used_at", "month"],
+    "Gallery": ["created_at", "user_id", "parse_type", "custom_prompt", "image_url", "original_image_id"],
+}
+
+# アーカイブ（月別の集計行）のヘッダー
+ARCHIVE_HEADERS = {
+    "UsageArchive": ["month", "user_id", "count"],
+    "GalleryArchive": ["month", "user_id", "parse_type", "count"],
+}
+
+
+def partition_title(base: str, month: str) -> str:
+    """月別パーティションのシート名"""
+    return f"{base}_{month}"
+
 class UserDB:
     def __init__(self):
         self.sheet_id = settings.GOOGLE_SHEETS_ID
@@ -34,11 +57,30 @@ class UserDB:
             self.client = gspread.authorize(self.creds)
             
             # スプレッドシートを開く
-            self.sheet = self.client.open_by_key(self.sheet_id)
+            self.scheduler = sheets_scheduler
+            self.sheet = self.scheduler.read(self.client.open_by_key, self.sheet_id)
             print(f"Connected to Google Sheet: {self.sheet.title}", flush=True)
             
             # ワークシート初期化
             self._init_worksheets()
+
+            # user_id -> 行番号 のインデックス（users_ws.find の全件検索を避ける）
+            self._user_rows = {}
+            self._user_index_loaded_at = 0.0
+            self._user_index_lock = threading.Lock()
+            self._create_user_lock = threading.Lock()
+            self._load_user_index()
+
+            # Usage/Galleryへの追記はバッファ経由でまとめて書き込む
+            self.write_buffer = WriteBehindBuffer(self._append_rows, after_flush=self._sync_monthly_summary)
+
+            # (user_id, month) -> 使用回数 の集計（起動時に1回だけ構築）
+            self._monthly_usage = Counter()
+            self._monthly_usage_lock = threading.Lock()
+            self._monthly_summary_dirty = False
+            self._rebuild_usage_counters()
+
+            self.write_buffer.start()
             
         except Exception as e:
             print(f"Google Sheets connection error: {e}", flush=True)
@@ -48,40 +90,299 @@ class UserDB:
         """ワークシートの取得または作成"""
         # Usersシート
         try:
-            self.users_ws = self.sheet.worksheet("Users")
-        except gspread.WorksheetNotFound:
-            self.users_ws = self.sheet.add_worksheet(title="Users", rows=1000, cols=4)
-            self.users_ws.append_row(["user_id", "created_at", "is_premium", "premium_expires_at"])
-            
-        # Usageシート
-        try:
-            self.usage_ws = self.sheet.worksheet("Usage")
+            self.users_ws = self.scheduler.read(self.sheet.worksheet, "Users")
         except gspread.WorksheetNotFound:
-            self.usage_ws = self.sheet.add_worksheet(title="Usage", rows=1000, cols=3)
-            self.usage_ws.append_row(["user_id", "used_at", "month"])
+            self.users_ws = self.scheduler.write(self.sheet.add_worksheet, title="Users", rows=1000, cols=4)
+            self.scheduler.write(self.users_ws.append_row, ["user_id", "created_at", "is_premium", "premium_expires_at"])
+
+        # Usage/Galleryは月別パーティション（Usage_2026-10 など）に書き込み、
+        # 初めて書き込む時に作成する
+        self._worksheets = {ws.title: ws for ws in self.scheduler.read(self.sheet.worksheets)}
+        self._worksheets_lock = threading.Lock()
+
+    def _resolve_worksheet(self, title: str, create: bool = True):
+        """ワークシート名からWorksheetを取得（パーティション・アーカイブは無ければ作成）"""
+        with self._worksheets_lock:
+            if title in self._worksheets:
+                return self._worksheets[title]
+
+            base = title.split("_", 1)[0]
+            headers = ARCHIVE_HEADERS.get(title) or PARTITION_HEADERS.get(base)
+            try:
+                ws = self.scheduler.read(self.sheet.worksheet, title)
+            except gspread.WorksheetNotFound:
+                if not create or not headers:
+                    raise
+                ws = self.scheduler.write(self.sheet.add_worksheet, title=title, rows=1000, cols=len(headers))
+                self.scheduler.write(ws.append_row, headers)
+                print(f"Created worksheet: {title}", flush=True)
+            self._worksheets[title] = ws
+            return ws
+
+    def _append_rows(self, title: str, rows: list):
+        """ワークシートに複数行を1回のAPI呼び出しで追記（クォータ制御・再試行付き）"""
+        ws = self._resolve_worksheet(title)
+        self.scheduler.write(ws.append_rows, rows)
+
+    def _partition_titles(self, base: str) -> list:
+        """既存の月別パーティション名（古い順）"""
+        with self._worksheets_lock:
+            return sorted(title for title in self._worksheets if title.startswith(f"{base}_"))
+
+    def read_usage_rows(self, month: Optional[str] = None) -> list:
+        """使用履歴の行を取得（月指定時はそのパーティションのみ読む）"""
+        if month:
+            titles = [partition_title("Usage", month)]
+        else:
+            titles = self._partition_titles("Usage")
+        # 移行前の単一Usageシートが残っていれば対象に含める
+        if "Usage" in self._worksheets:
+            titles.append("Usage")
+
+        rows = []
+        for title in titles:
+            try:
+                ws = self._resolve_worksheet(title, create=False)
+            except gspread.WorksheetNotFound:
+                continue
+            for row in self.scheduler.read(ws.get_all_values)[1:]:
+                if len(row) > 2 and row[0] and (not month or row[2] == month):
+                    rows.append(row[:3])
+        return rows
+
+    def ping(self) -> bool:
+        """
+        Sheets APIへの接続を保つ軽いリクエスト（ウォームアップ用）
+        クォータを消費しないようAPIのルートへHEADを送る（アクセストークンの更新も兼ねる）
+        """
+        # 認証済みセッションは gspread 6 では client.http_client.session、5.x では client.session
+        session = getattr(self.client, "http_client", self.client).session
+        session.head("https://sheets.googleapis.com/", timeout=10)
+        return True
+
+    def _load_user_index(self):
+        """Usersシートの1列目を一括取得してインデックスを再構築"""
+        user_ids = self.scheduler.read(self.users_ws.col_values, 1)
+        # 1行目はヘッダー
+        index = {user_id: row for row, user_id in enumerate(user_ids, start=1) if row > 1 and user_id}
+        with self._user_index_lock:
+            self._user_rows = index
+            self._user_index_loaded_at = time.monotonic()
+
+    def _find_user_row(self, user_id: str) -> Optional[int]:
+        """ユーザーの行番号を取得（定期的・見つからない場合にインデックスを再読み込み）"""
+        age = time.monotonic() - self._user_index_loaded_at
+        if age > settings.USER_INDEX_TTL:
+            self._load_user_index()
+        elif user_id not in self._user_rows and age > settings.USER_INDEX_MISS_REFRESH:
+            # 他インスタンスで追加された可能性があるので再読み込み（頻度は制限）
+            self._load_user_index()
+        return self._user_rows.get(user_id)
+
+    def _read_user_row(self, user_id: str) -> tuple:
+        """
+        ユーザーの行番号と行の値を取得（行の1列目が user_id と一致することを確かめる）
+
+        Returns:
+            (行番号, 行の値)。見つからなければ (None, [])
+        """
+        row = self._find_user_row(user_id)
+        if not row:
+            return None, []
+        row_values = self.scheduler.read(self.users_ws.row_values, row)
+        if not row_values or row_values[0] != user_id:
+            # 手動での行削除などでずれた場合はインデックスを作り直す
+            self._load_user_index()
+            row = self._user_rows.get(user_id)
+            if not row:
+                return None, []
+            row_values = self.scheduler.read(self.users_ws.row_values, row)
+            if not row_values or row_values[0] != user_id:
+                return None, []
+        return row, row_values
+
+    def _remember_user_row(self, user_id: str, response: Optional[dict]):
+        """append_row のレスポンス（updatedRange）から追加行を記録"""
+        updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+        match = re.search(r"![A-Z]+(\d+)", updated_range)
+        with self._user_index_lock:
+            if match:
+                self._user_rows[user_id] = int(match.group(1))
+            else:
+                # 行番号が分からない場合は次回アクセス時に再読み込み
+                self._user_index_loaded_at = 0.0
 
-        # Galleryシート（生成画像の保存用）
+    def migrate_legacy_sheets(self) -> dict:
+        """移行前の単一Usage/Galleryシートの行を月別パーティションに移してシートを削除"""
+        moved = {}
+        for base, month_of in (("Usage", lambda row: row[2]), ("Gallery", lambda row: row[0][:7])):
+            if base not in self._worksheets:
+                continue
+            legacy_ws = self._worksheets[base]
+            by_month = {}
+            for row in self.scheduler.read(legacy_ws.get_all_values)[1:]:
+                if len(row) >= len(PARTITION_HEADERS[base]) and row[0]:
+                    by_month.setdefault(month_of(row), []).append(row)
+            for month, rows in sorted(by_month.items()):
+                self._append_rows(partition_title(base, month), rows)
+            self.scheduler.write(self.sheet.del_worksheet, legacy_ws)
+            with self._worksheets_lock:
+                self._worksheets.pop(base, None)
+            moved[base] = {month: len(rows) for month, rows in by_month.items()}
+        return moved
+
+    def archive_month(self, month: str, keep_partitions: bool = False) -> dict:
+        """
+        指定月のパーティションを集計行に圧縮してアーカイブする
+        集計行の追記（Usage・Gallery）とパーティションの削除はそれぞれ済んでいるか確かめてから行うので、
+        途中で失敗しても再実行で残りの手順から続けられる
+
+        Args:
+            month: 対象月（YYYY-MM）
+            keep_partitions: Trueなら集計後もパーティションを削除しない
+
+        Returns:
+            アーカイブした集計行数（済んでいた手順は含まない）
+        """
+        result = {}
+
+        usage_archive = self._resolve_worksheet("UsageArchive")
+        if month in self.scheduler.read(usage_archive.col_values, 1):
+            print(f"Usage already archived: {month}", flush=True)
+        else:
+            usage_counts = Counter(row[0] for row in self.read_usage_rows(month))
+            self._append_rows("UsageArchive", [[month, user_id, count] for user_id, count in sorted(usage_counts.items())] or [[month, "", 0]])
+            result["usage"] = len(usage_counts)
+
+        gallery_archive = self._resolve_worksheet("GalleryArchive")
+        if month in self.scheduler.read(gallery_archive.col_values, 1):
+            print(f"Gallery already archived: {month}", flush=True)
+        else:
+            gallery_counts = Counter()
+            try:
+                gallery_ws = self._resolve_worksheet(partition_title("Gallery", month), create=False)
+                for row in self.scheduler.read(gallery_ws.get_all_values)[1:]:
+                    if len(row) > 2 and row[1]:
+                        gallery_counts[(row[1], row[2])] += 1
+            except gspread.WorksheetNotFound:
+                pass
+            self._append_rows(
+                "GalleryArchive",
+                [[month, user_id, parse_type, count] for (user_id, parse_type), count in sorted(gallery_counts.items())]
+                or [[month, "", "", 0]]
+            )
+            result["gallery"] = len(gallery_counts)
+
+        # 両方の集計行が書き込まれてからパーティションを削除（削除済みのものは飛ばす）
+        if not keep_partitions:
+            for title in (partition_title("Usage", month), partition_title("Gallery", month)):
+                ws = self._worksheets.get(title)
+                if ws:
+                    self.scheduler.write(self.sheet.del_worksheet, ws)
+                    with self._worksheets_lock:
+                        self._worksheets.pop(title, None)
+                    result.setdefault("deleted", []).append(title)
+        return result
+
+    def archivable_months(self, keep_months: int) -> list:
+        """
+        今月を含む直近 keep_months ヶ月（暦の月）より古いパーティションの月
+        例: 今月が 2026-10 で keep_months=3 なら 2026-07 以前
+        """
+        months = sorted({title.split("_", 1)[1] for title in self._partition_titles("Usage") + self._partition_titles("Gallery")})
+        now = datetime.now()
+        # 今月は常に残す
+        index = now.year * 12 + (now.month - 1) - max(keep_months - 1, 0)
+        cutoff = f"{index // 12:04d}-{index % 12 + 1:02d}"
+        return [m for m in months if m < cutoff]
+
+    def _rebuild_usage_counters(self):
+        """
+        使用回数の集計を構築（＋未反映のバッファ行）
+
+        通常は今月のUsageパーティションだけを読む。MonthlySummaryを書き出す場合は過去の月も必要なので、
+        アーカイブ済みの月はUsageArchiveの集計行から、未アーカイブの月はパーティションから集計する
+        """
+        current_month = datetime.now().strftime("%Y-%m")
+        counters = Counter()
+        if settings.MONTHLY_SUMMARY_SHEET:
+            archived = set()
+            if "UsageArchive" in self._worksheets:
+                # [month, user_id, count]（利用の無かった月は user_id が空の行）
+                for row in self.scheduler.read(self._worksheets["UsageArchive"].get_all_values)[1:]:
+                    if len(row) > 2 and row[0]:
+                        archived.add(row[0])
+                        if row[1]:
+                            counters[(row[1], row[0])] += int(row[2] or 0)
+            # パーティションを残してアーカイブした月は二重に数えない
+            usage_rows = [row for row in self.read_usage_rows() if row[2] not in archived]
+        else:
+            usage_rows = self.read_usage_rows(current_month)
+        # [user_id, used_at, month]
+        for row in usage_rows:
+            counters[(row[0], row[2])] += 1
+        for row in self.write_buffer.pending_rows(partition_title("Usage", current_month)):
+            counters[(row[0], row[2])] += 1
+
+        with self._monthly_usage_lock:
+            self._monthly_usage = counters
+            self._monthly_summary_dirty = True
+        print(f"Usage counters built: {len(counters)} (user, month) pairs", flush=True)
+
+    def _sync_monthly_summary(self):
+        """集計をMonthlySummaryシートに書き出す（有効時・変更があった場合のみ）"""
+        if not settings.MONTHLY_SUMMARY_SHEET or not self._monthly_summary_dirty:
+            return
+        with self._monthly_usage_lock:
+            rows = sorted([month, user_id, count] for (user_id, month), count in self._monthly_usage.items())
+            self._monthly_summary_dirty = False
         try:
-            self.gallery_ws = self.sheet.worksheet("Gallery")
-        except gspread.WorksheetNotFound:
-            self.gallery_ws = self.sheet.add_worksheet(title="Gallery", rows=1000, cols=6)
-            self.gallery_ws.append_row(["created_at", "user_id", "parse_type", "custom_prompt", "image_url", "original_image_id"])
+            try:
+                summary_ws = self.scheduler.read(self.sheet.worksheet, "MonthlySummary")
+            except gspread.WorksheetNotFound:
+                summary_ws = self.scheduler.write(self.sheet.add_worksheet, title="MonthlySummary", rows=len(rows) + 1, cols=3)
+            values = [["month", "user_id", "count"]] + rows
+            # 行数を合わせてから書き込む（以前の書き出しの余った行を残さない）
+            if summary_ws.row_count != len(values):
+                self.scheduler.write(summary_ws.resize, rows=len(values))
+            self.scheduler.write(summary_ws.update, range_name="A1", values=values)
+        except Exception as e:
+            print(f"Monthly summary sync error: {e}", flush=True)
+            self._monthly_summary_dirty = True
+
+    def pending_writes(self) -> int:
+        """Sheets未反映の行数"""
+        return self.write_buffer.pending_count()
+
+    def metrics(self) -> dict:
+        return {
+            "backend": "sheets",
+            "write_buffer": self.write_buffer.metrics(),
+            "scheduler": self.scheduler.metrics(),
+        }
+
+    def close(self):
+        """書き込みバッファをフラッシュ"""
+        self.write_buffer.close()
+        self._sync_monthly_summary()
 
     def create_user(self, user_id: str) -> bool:
         """ユーザー作成（存在しなければ）"""
         try:
-            # 既存チェック
-            cell = self.users_ws.find(user_id)
-            if cell:
-                return True
-                
-            # 新規作成
-            self.users_ws.append_row([
-                user_id,
-                datetime.now().isoformat(),
-                0, # is_premium (False)
-                "" # premium_expires_at
-            ])
+            # 同時の友だち追加で二重登録しないようロック
+            with self._create_user_lock:
+                # 既存チェック
+                if self._find_user_row(user_id):
+                    return True
+
+                # 新規作成
+                response = self.scheduler.write(self.users_ws.append_row, [
+                    user_id,
+                    datetime.now().isoformat(),
+                    0, # is_premium (False)
+                    "" # premium_expires_at
+                ])
+                self._remember_user_row(user_id, response)
             return True
         except Exception as e:
             print(f"Create user error: {e}")
@@ -90,11 +391,9 @@ class UserDB:
     def get_user(self, user_id: str) -> Optional[dict]:
         """ユーザー情報取得"""
         try:
-            cell = self.users_ws.find(user_id)
-            if not cell:
+            row, row_values = self._read_user_row(user_id)
+            if not row:
                 return None
-                
-            row_values = self.users_ws.row_values(cell.row)
             
             # データ整形
             # [user_id, created_at, is_premium, premium_expires_at]
@@ -122,17 +421,9 @@ class UserDB:
         try:
             current_month = datetime.now().strftime("%Y-%m")
             
-            # 全データを取得してPython側でフィルタリング（データ量増えると遅くなるが、今回は簡易実装）
-            # 最適化するなら query 機能を使うか、月別シートにする
-            records = self.usage_ws.get_all_records()
-            
-            count = 0
-            for record in records:
-                # gspreadのget_all_recordsはヘッダーをキーにする
-                if str(record.get("user_id")) == user_id and str(record.get("month")) == current_month:
-                    count += 1
-                    
-            return count
+            # 起動時に構築し increment_usage で更新しているメモリ上の集計を参照
+            with self._monthly_usage_lock:
+                return self._monthly_usage.get((user_id, current_month), 0)
         except Exception as e:
             print(f"Get monthly usage error: {e}")
             return 0 # エラー時は0を返して動作を止めない（またはログ出す）
@@ -146,11 +437,14 @@ class UserDB:
         """使用回数をインクリメント"""
         try:
             current_month = datetime.now().strftime("%Y-%m")
-            self.usage_ws.append_row([
+            self.write_buffer.append(partition_title("Usage", current_month), [
                 user_id,
                 datetime.now().isoformat(),
                 current_month
             ])
+            with self._monthly_usage_lock:
+                self._monthly_usage[(user_id, current_month)] += 1
+                self._monthly_summary_dirty = True
             return True
         except Exception as e:
             print(f"Increment usage error: {e}")
@@ -159,14 +453,17 @@ class UserDB:
     def set_premium(self, user_id: str, expires_at: datetime) -> bool:
         """プレミアム設定"""
         try:
-            cell = self.users_ws.find(user_id)
-            if not cell:
+            # 別のユーザーの行を書き換えないよう、行の user_id を確かめてから更新
+            row, _ = self._read_user_row(user_id)
+            if not row:
                 self.create_user(user_id)
-                cell = self.users_ws.find(user_id)
+                row, _ = self._read_user_row(user_id)
+                if not row:
+                    print(f"Set premium error: user row not found: {user_id}")
+                    return False
                 
-            # is_premium (col 3), expires_at (col 4) を更新
-            self.users_ws.update_cell(cell.row, 3, 1) # 1 = True
-            self.users_ws.update_cell(cell.row, 4, expires_at.isoformat())
+            # is_premium (col 3), expires_at (col 4) を1回のAPI呼び出しで更新
+            self.scheduler.write(self.users_ws.update, range_name=f"C{row}:D{row}", values=[[1, expires_at.isoformat()]]) # 1 = True
             return True
         except Exception as e:
             print(f"Set premium error: {e}")
@@ -175,11 +472,10 @@ class UserDB:
     def cancel_premium(self, user_id: str) -> bool:
         """プレミアム解除"""
         try:
-            cell = self.users_ws.find(user_id)
-            if cell:
-                # is_premium -> 0, expires -> ""
-                self.users_ws.update_cell(cell.row, 3, 0)
-                self.users_ws.update_cell(cell.row, 4, "")
+            row, _ = self._read_user_row(user_id)
+            if row:
+                # is_premium -> 0, expires -> ""（1回のAPI呼び出しで更新）
+                self.scheduler.write(self.users_ws.update, range_name=f"C{row}:D{row}", values=[[0, ""]])
             return True
         except Exception as e:
             print(f"Cancel premium error: {e}")
@@ -188,8 +484,9 @@ class UserDB:
     def save_to_gallery(self, user_id: str, parse_type: str, custom_prompt: str, image_url: str, original_image_id: str = "") -> bool:
         """生成画像をギャラリーに保存"""
         try:
-            self.gallery_ws.append_row([
-                datetime.now().isoformat(),
+            now = datetime.now()
+            self.write_buffer.append(partition_title("Gallery", now.strftime("%Y-%m")), [
+                now.isoformat(),
                 user_id,
                 parse_type,
                 custom_prompt,
@@ -0,0 +1,133 @@
+"""
+外部APIホストへの事前接続（ウォームアップ）と接続の維持
+起動時に各ホストのDNS解決と接続（TLSハンドシェイク）を済ませておき、以降はしばらく使われていない
+ホストにだけ軽いリクエストを送って keep-alive 接続を保つ（静かな時間帯の後の最初のジョブが遅くならないようにする）
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlsplit
+
+from config import settings
+from services.http_client import get_http_client, last_used
+from services.metrics import registry
+
+warmup_refreshes = registry.counter("parse_warmup_refresh_total", "Keep-alive refresh requests sent to idle upstream hosts", ["upstream", "result"])
+
+
+async def head_probe(url: str):
+    """共有HTTPクライアントでHEADを送る（ステータスは問わない。接続できればよい）"""
+    await get_http_client().head(url, timeout=10.0)
+
+
+class UpstreamWarmer:
+    def __init__(self, interval: Optional[float] = None):
+        """
+        Args:
+            interval: この秒数使われていないホストに接続維持のリクエストを送る
+        """
+        self.interval = interval or settings.WARMUP_REFRESH_INTERVAL
+        self.targets = {}  # {名前: (URL, probe)}
+        self.timings = {}  # {名前: {"host", "dns", "connect", "ok"}}（起動時の計測）
+        self.failing = set()
+        self._task = None
+
+    def add(self, name: str, url: str, probe: Callable[[str], Awaitable] = head_probe):
+        """
+        Args:
+            probe: URLに軽いリクエストを送り接続を確立する関数（省略時は共有HTTPクライアントでHEAD）
+        """
+        self.targets[name] = (url, probe)
+
+    async def _resolve(self, name: str):
+        url, _ = self.targets[name]
+        parts = urlsplit(url)
+        timing = self.timings[name] = {"host": parts.hostname, "dns": None, "connect": None, "ok": False}
+        try:
+            started = time.perf_counter()
+            await asyncio.get_running_loop().getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+            timing["dns"] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            print(f"[Warmup] {name} ({parts.hostname}) DNS failed: {e}", flush=True)
+
+    async def _connect(self, name: str):
+        url, probe = self.targets[name]
+        timing = self.timings[name]
+        try:
+            started = time.perf_counter()
+            await probe(url)
+            timing["connect"] = round(time.perf_counter() - started, 3)
+            timing["ok"] = True
+            last_used[timing["host"]] = time.monotonic()
+        except Exception as e:
+            print(f"[Warmup] {name} ({timing['host']}) failed: {e}", flush=True)
+
+    async def warm_up(self) -> dict:
+        """全ホストを並行してウォームアップし、ホストごとの所要時間を記録（DNS解決 → 接続の順）"""
+        started = time.perf_counter()
+        # 接続時にクライアント作成（SSLコンテキストの読み込み）でループが止まってもDNSの計測に混ざらないよう段階を分ける
+        await asyncio.gather(*(self._resolve(name) for name in self.targets))
+        await asyncio.gather(*(self._connect(name) for name in self.targets))
+        for name, timing in self.timings.items():
+            if timing["ok"]:
+                print(f"[Warmup] {name:10s} {timing['host']}: dns={(timing['dns'] or 0) * 1000:.0f}ms "
+                      f"connect={timing['connect'] * 1000:.0f}ms", flush=True)
+        print(f"[Warmup] {sum(t['ok'] for t in self.timings.values())}/{len(self.timings)} hosts ready "
+              f"in {time.perf_counter() - started:.2f}s", flush=True)
+        return self.timings
+
+    def start(self):
+        """接続維持のタスクを開始（イベントループ上から呼ぶ）"""
+        self._task = asyncio.get_running_loop().create_task(self._refresh())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _refresh(self):
+        """一定間隔で、その間リクエストの無かったホストにだけ軽いリクエストを送る"""
+        while True:
+            await asyncio.sleep(self.interval / 2)
+            now = time.monotonic()
+            for name, (url, probe) in self.targets.items():
+                host = urlsplit(url).hostname
+                if now - last_used.get(host, 0) < self.interval:
+                    continue
+                try:
+                    await probe(url)
+                    last_used[host] = time.monotonic()
+                    warmup_refreshes.inc(name, "ok")
+                    if name in self.failing:
+                        self.failing.discard(name)
+                        print(f"[Warmup] {name} reachable again", flush=True)
+                except Exception as e:
+                    warmup_refreshes.inc(name, "error")
+                    # 失敗が続いてもログは最初の1回だけ
+                    if name not in self.failing:
+                        self.failing.add(name)
+                        print(f"[Warmup] {name} refresh failed: {e}", flush=True)
+
+    def summary(self) -> dict:
+        now = time.monotonic()
+        return {
+            name: {**self.timings.get(name, {}), "idle_seconds": round(now - last_used[host], 1) if host in last_used else None}
+            for name, host in ((name, urlsplit(url).hostname) for name, (url, _) in self.targets.items())
+        }
+
+
+# シングルトンインスタンス
+upstream_warmer = UpstreamWarmer()
+
+registry.gauge(
+    "parse_warmup_seconds", "Startup warm-up time per upstream host", ["upstream", "phase"],
+    callback=lambda: {
+        (name, phase): timing[phase]
+        for name, timing in upstream_warmer.timings.items()
+        for phase in ("dns", "connect")
+        if timing[phase] is not None
+    }
+)
@@ -0,0 +1,190 @@
+"""
+本番の負荷の記録（リプレイによる性能の回帰テスト用）
+Webhookイベントの到着、モデルごとのKIE.AIの生成時間、LINE・DB・外部APIのレイテンシ、ジョブの所要時間を
+匿名化してコンパクトなJSON Lines（.gz なら gzip）に追記する。bench/replay.py で同じタイミングを再現する
+
+レコード（1行1配列、時刻はUNIX秒）:
+    ["meta", t, {"v": 1, "db": バックエンド, "vocab": {分類: テキスト}}]   ファイルの先頭
+    ["ev", t, ユーザー, 種別, 引数]        イベント到着（image: [index, total] または null / text: 分類）
+    ["up", t, 名前, 秒, 成功]              外部API・DBの呼び出し（line.reply / kie.upload / db.* など）
+    ["model", t, モデル, 秒, 結果]         生成結果を見つけたポーリングの送信まで（ok / fail / timeout）
+    ["job", t, ユーザー, 名前, モード, 秒, 最初の画像までの秒, 結果]
+
+ユーザーIDは起動ごとの乱数をキーにしたハッシュに置き換え、テキストは既知のコマンド以外は文字数だけ残す
+（画像・メッセージID・プロンプトの内容は記録しない）
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from config import settings
+from services.tracing import tracer
+
+FORMAT_VERSION = 1
+FLUSH_RECORDS = 200
+# 書き込みに失敗し続けた場合にメモリ上に残す上限（超えた分は古いものから捨てる）
+MAX_BUFFERED_RECORDS = 20000
+
+# 記録する区間（webhook.poll はモデルの生成時間として別に記録）
+UPSTREAM_SPANS = ("line.reply", "line.push", "line.download", "kie.upload", "kie.create_task", "webhook.token")
+
+
+class WorkloadRecorder:
+    def __init__(self, path: Optional[str] = None, flush_interval: Optional[float] = None):
+        """
+        Args:
+            path: 出力先（strftime形式で日付ごとに分けられる。空なら記録しない）
+            flush_interval: バッファをファイルに書き出す間隔（秒）
+        """
+        self.path = path if path is not None else settings.WORKLOAD_RECORD_PATH
+        self.flush_interval = flush_interval or settings.WORKLOAD_RECORD_FLUSH_INTERVAL
+        self.salt = os.urandom(16)
+        self.vocabulary = {}  # {テキスト: 分類}
+        self.buffer = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        # ファイルへの書き込みは専用スレッドで行う（イベントループを止めない）
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def set_vocabulary(self, vocabulary: dict):
+        """そのまま記録してよい定型テキスト（タイプ名・コマンド）と分類名"""
+        self.vocabulary = dict(vocabulary)
+
+    def anonymize(self, user_id: str) -> str:
+        return hashlib.blake2b(user_id.encode("utf-8"), key=self.salt, digest_size=6).hexdigest()
+
+    def classify_text(self, text: str) -> str:
+        return self.vocabulary.get(text) or f"custom:{len(text)}"
+
+    def record_events(self, events: list):
+        """Webhookで受け取ったイベント（同じリクエストのものは同じ時刻）"""
+        if not self.enabled:
+            return
+        now = round(time.time(), 3)
+        for event in events:
+            user = self.anonymize(event.get("source", {}).get("userId", ""))
+            message = event.get("message", {})
+            if event.get("type") != "message":
+                self._append(["ev", now, user, event.get("type", ""), None])
+            elif message.get("type") == "image":
+                image_set = message.get("imageSet")
+                self._append(["ev", now, user, "image", [image_set.get("index"), image_set.get("total")] if image_set else None])
+            elif message.get("type") == "text":
+                self._append(["ev", now, user, "text", self.classify_text(message.get("text", ""))])
+            else:
+                self._append(["ev", now, user, message.get("type", ""), None])
+
+    def record_trace(self, trace):
+        """完了したジョブのトレースから外部APIのレイテンシ・モデルの生成時間・ジョブの所要時間を記録"""
+        if not self.enabled:
+            return
+        root = trace.root
+        spans = {span.span_id: span for span in trace.spans}
+        first_image = None
+        for span in trace.spans[1:]:
+            # 他のジョブの処理に相乗りした分は、その処理を始めたジョブの側で記録する
+            if span.end is None or span.attributes.get("coalesced"):
+                continue
+            duration = round(span.end - span.start, 3)
+            if span.name in UPSTREAM_SPANS or span.name.startswith("db."):
+                self._append(["up", round(span.start, 3), span.name, duration, int(span.error is None)])
+                if span.name == "line.push" and span.error is None:
+                    first_image = min(first_image or span.end, span.end)
+            elif span.name == "webhook.poll":
+                # 親の generate span にモデル名がある。ジョブの取り消し・期限で中断したものは生成時間が分からないので除く
+                parent = spans.get(span.parent_id)
+                if parent is None or (span.error and span.error.startswith(("CancelledError", "deadline"))):
+                    continue
+                if span.error is None:
+                    result = "ok"
+                elif span.error.startswith("timeout"):
+                    result = "timeout"
+                else:
+                    result = "fail"
+                # ポーリングの間隔で丸められないよう、結果を見つけたポーリングを送った時点を生成時間とする
+                seconds = duration if result == "timeout" else span.attributes.get("result_seen_after", duration)
+                self._append(["model", round(span.start, 3), parent.attributes.get("model", ""), seconds, result])
+
+        self._append([
+            "job", round(root.start, 3), self.anonymize(str(root.attributes.get("user_id", ""))), root.name,
+            root.attributes.get("mode", ""), round((root.end or time.time()) - root.start, 3),
+            round(first_image - root.start, 3) if first_image else None,
+            root.attributes.get("outcome", "error" if root.error else "ok"),
+        ])
+
+    def start(self):
+        """書き出し用スレッドを起動（記録が無効なら何もしない）"""
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="workload-recorder", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _append(self, record: list):
+        with self.lock:
+            self.buffer.append(record)
+            due = len(self.buffer) >= FLUSH_RECORDS
+        if due:
+            self._wakeup.set()
+
+    def flush(self) -> bool:
+        """バッファをファイルに追記（日付の変わったファイルには先頭にmetaを書く）。失敗した分はバッファに戻す"""
+        with self.file_lock:
+            with self.lock:
+                records, self.buffer = self.buffer, []
+            if not records or not self.enabled:
+                return True
+            try:
+                path = time.strftime(self.path)
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                opener = gzip.open if path.endswith(".gz") else open
+                lines = [json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in records]
+                if not os.path.exists(path):
+                    meta = {"v": FORMAT_VERSION, "db": settings.DATABASE_BACKEND,
+                            "vocab": {label: text for text, label in self.vocabulary.items()}}
+                    lines.insert(0, json.dumps(["meta", round(time.time(), 3), meta], ensure_ascii=False, separators=(",", ":")) + "\n")
+                with opener(path, "at", encoding="utf-8") as f:
+                    f.write("".join(lines))
+                return True
+            except Exception as e:
+                print(f"Workload record error: {e}", flush=True)
+                with self.lock:
+                    # 次回の書き出しで再送（先頭に戻す）
+                    self.buffer = records + self.buffer
+                    excess = len(self.buffer) - MAX_BUFFERED_RECORDS
+                    if excess > 0:
+                        del self.buffer[:excess]
+                        self.dropped += excess
+                        print(f"Workload recorder buffer full: dropped {excess} oldest records", flush=True)
+                return False
+
+    def close(self):
+        """書き出し用スレッドを停止して残りを書き込む"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if not self.flush():
+            print(f"Workload recorder: {len(self.buffer)} records could not be written", flush=True)
+
+
+# シングルトンインスタンス
+workload_recorder = WorkloadRecorder()
+tracer.add_listener(workload_recorder.record_trace)
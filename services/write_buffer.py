@@ -0,0 +1,175 @@
+"""
+Sheets書き込みバッファ（write-behind）
+append_row を1行ずつ呼ぶ代わりに行を溜めて append_rows でまとめて書き込む
+未反映の行はスピルファイルに保存し、クラッシュ後の再起動時に再送する
+"""
+import json
+import os
+import threading
+from typing import Callable, Optional
+
+from config import settings
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        write_rows: Callable[[str, list], None],
+        spill_path: Optional[str] = None,
+        max_rows: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        after_flush: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Args:
+            write_rows: write_rows(ワークシート名, 行リスト) で一括追記する関数
+            spill_path: 未反映行の保存先（JSON Lines）
+            max_rows: この行数に達したら即フラッシュ
+            flush_interval: 定期フラッシュの間隔（秒）
+            after_flush: 定期フラッシュの後に呼ぶ関数（集計シートの同期など）
+        """
+        self.write_rows = write_rows
+        self.spill_path = spill_path or os.path.join(settings.DATA_DIR, "sheets_spill.jsonl")
+        self.max_rows = max_rows or settings.SHEETS_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.SHEETS_FLUSH_INTERVAL
+        self.after_flush = after_flush
+
+        self._pending = {}  # {worksheet名: [row, ...]}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.flush_calls = 0
+        self.flushed_rows = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.spill_path)), exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        """前回プロセスの未反映行をスピルファイルから復元"""
+        if not os.path.exists(self.spill_path):
+            return
+        recovered = 0
+        try:
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中でクラッシュした最終行は捨てる
+                        continue
+                    self._pending.setdefault(entry["ws"], []).append(entry["row"])
+                    recovered += 1
+        except Exception as e:
+            print(f"[WriteBuffer] Spill recovery error: {e}", flush=True)
+        if recovered:
+            print(f"[WriteBuffer] Recovered {recovered} unflushed rows from {self.spill_path}", flush=True)
+
+    def start(self):
+        """定期フラッシュ用スレッドを起動"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="sheets-write-buffer", daemon=True)
+        self._thread.start()
+        if self.pending_count():
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            self.flush()
+            if self.after_flush:
+                try:
+                    self.after_flush()
+                except Exception as e:
+                    print(f"[WriteBuffer] after_flush error: {e}", flush=True)
+
+    def append(self, worksheet: str, row: list):
+        """行をバッファに追加（スピルファイルにも即記録）"""
+        with self._lock:
+            self._pending.setdefault(worksheet, []).append(row)
+            try:
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"ws": worksheet, "row": row}, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"[WriteBuffer] Spill write error: {e}", flush=True)
+            total = sum(len(rows) for rows in self._pending.values())
+
+        if total >= self.max_rows:
+            self._wakeup.set()
+
+    def pending_rows(self, worksheet: str) -> list:
+        """未反映の行（読み取り時の補正用）"""
+        with self._lock:
+            return list(self._pending.get(worksheet, []))
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return sum(len(rows) for rows in self._pending.values())
+
+    def flush(self) -> bool:
+        """溜まっている行をワークシートごとに append_rows で書き込む"""
+        with self._flush_lock:
+            with self._lock:
+                batches = self._pending
+                self._pending = {}
+
+            if not batches:
+                return True
+
+            ok = True
+            failed = {}
+            for worksheet, rows in batches.items():
+                try:
+                    self.write_rows(worksheet, rows)
+                    self.flush_calls += 1
+                    self.flushed_rows += len(rows)
+                except Exception as e:
+                    print(f"[WriteBuffer] Flush error for {worksheet} ({len(rows)} rows): {e}", flush=True)
+                    failed[worksheet] = rows
+                    ok = False
+
+            with self._lock:
+                # 失敗した行は先頭に戻して次回再送
+                for worksheet, rows in failed.items():
+                    self._pending[worksheet] = rows + self._pending.get(worksheet, [])
+                self._rewrite_spill()
+
+            return ok
+
+    def _rewrite_spill(self):
+        """スピルファイルを未反映行だけに書き直す（_lock保持中に呼ぶ）"""
+        try:
+            tmp_path = self.spill_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for worksheet, rows in self._pending.items():
+                    for row in rows:
+                        f.write(json.dumps({"ws": worksheet, "row": row}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.spill_path)
+        except Exception as e:
+            print(f"[WriteBuffer] Spill rewrite error: {e}", flush=True)
+
+    def close(self):
+        """フラッシュスレッドを停止して残りを書き込む"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if not self.flush():
+            print(f"[WriteBuffer] {self.pending_count()} rows left in {self.spill_path}", flush=True)
+
+    def metrics(self) -> dict:
+        return {
+            "pending_rows": self.pending_count(),
+            "flush_calls": self.flush_calls,
+            "flushed_rows": self.flushed_rows,
+        }
@@ -0,0 +1,170 @@
+"""
+services/admission.py のテスト（サーキットブレーカーの状態遷移と受付の判定）
+"""
+import types
+
+import pytest
+
+from services import admission as admission_module
+from services.admission import AdmissionController, CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.monotonic を進められる時計に置き換える"""
+    fake = types.SimpleNamespace(now=1000.0)
+    fake.monotonic = lambda: fake.now
+    monkeypatch.setattr(admission_module, "time", fake)
+    return fake
+
+
+def test_breaker_opens_at_threshold(clock):
+    breaker = CircuitBreaker("kie", failure_threshold=3, cooldown=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 60
+
+    clock.now += 45
+    assert breaker.retry_after() == 15
+
+
+def test_success_resets_consecutive_failures(clock):
+    breaker = CircuitBreaker("kie", failure_threshold=3, cooldown=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_admits_a_single_probe(clock):
+    breaker = CircuitBreaker("kie", failure_threshold=1, cooldown=60)
+    breaker.record_failure()
+    clock.now += 60
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    assert breaker.allow()
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.retry_after() == 50
+
+    # 試行のジョブが外部APIまで届かなかった場合はクールダウン後に次の1件を通す
+    clock.now += 50
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_probe_failure_reopens_and_success_closes(clock):
+    breaker = CircuitBreaker("kie", failure_threshold=1, cooldown=60)
+    breaker.record_failure()
+    clock.now += 60
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_after() == 60
+
+    clock.now += 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_check_reasons(clock):
+    controller = AdmissionController(max_inflight=2)
+    assert controller.check() is None
+
+    reservation, _ = controller.reserve(2)
+    with controller.admitted(reservation):
+        rejection = controller.check()
+        assert rejection.reason == "overloaded"
+        assert rejection.wait_seconds > 0
+    assert controller.in_flight == 0
+    assert controller.check(weight=2) is None
+
+    breaker = controller.breakers["kie"]
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    rejection = controller.check()
+    assert rejection.reason == "upstream"
+    assert rejection.wait_minutes == 1
+    assert controller.ready() == (False, "breaker_open:kie")
+
+    controller.shutting_down = True
+    assert controller.check().reason == "shutting_down"
+
+
+def test_reserve_counts_before_the_job_starts(clock):
+    controller = AdmissionController(max_inflight=2)
+    first, _ = controller.reserve()
+    second, _ = controller.reserve()
+    # ジョブのタスクが始まる前に届いた要求も実行枠に数える
+    reservation, rejection = controller.reserve()
+    assert reservation is None
+    assert rejection.reason == "overloaded"
+
+    # 実行中のジョブに合流した場合は始めずに返す（何度返してもよい）
+    first.release()
+    first.release()
+    assert controller.in_flight == 1
+    with controller.admitted(second):
+        pass
+    assert controller.in_flight == 0
+
+
+def test_reserve_claims_probe_only_when_capacity_is_free(clock):
+    controller = AdmissionController(max_inflight=1)
+    breaker = controller.breakers["webhook"]
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    clock.now += breaker.cooldown
+
+    running, _ = controller.reserve()
+    assert controller.reserve()[1].reason == "overloaded"
+    running.release()
+    # 満杯で断った分と、ジョブを始めずに返した分は試行に数えない
+    assert breaker.would_allow()
+
+    probe, _ = controller.reserve()
+    with controller.admitted(probe):
+        assert not breaker.would_allow()
+    # 試行したジョブの結果が記録されるまで次の試行は通さない
+    assert controller.reserve()[1].reason == "upstream"
+
+
+def test_record_upstream_result_counts_only_upstream_errors(clock, monkeypatch):
+    from services import kie_api
+
+    controller = AdmissionController()
+    monkeypatch.setattr(kie_api, "admission", controller)
+    breaker = controller.breakers["kie"]
+
+    for _ in range(breaker.failure_threshold * 2):
+        kie_api.record_upstream_result("kie", upstream_error=False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    for _ in range(breaker.failure_threshold):
+        kie_api.record_upstream_result("kie", upstream_error=True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_blocked_breaker_does_not_consume_another_breakers_probe(clock):
+    controller = AdmissionController(max_inflight=5)
+    kie, webhook = controller.breakers["kie"], controller.breakers["webhook"]
+    for breaker in (kie, webhook):
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+    clock.now += kie.cooldown
+    # webhook の試行が実行中
+    assert webhook.allow()
+
+    assert controller.check().reason == "upstream"
+    assert kie.probe_started_at is None
+    assert kie.would_allow()
@@ -0,0 +1,100 @@
+"""
+services/byte_budget.py のテスト（予約の順番待ち・取り消し時の解放）
+"""
+import asyncio
+
+from services.byte_budget import ByteBudget
+
+
+async def _hold(budget: ByteBudget, nbytes: int, started: list, release: asyncio.Event):
+    async with budget.reserve(nbytes):
+        started.append(nbytes)
+        await release.wait()
+
+
+def test_reserve_waits_in_order_until_released():
+    async def main():
+        budget = ByteBudget(100)
+        release = asyncio.Event()
+        started = []
+        first = asyncio.create_task(_hold(budget, 60, started, release))
+        await asyncio.sleep(0)
+        # 2件目は予算を超えるので待つ。3件目は収まるが追い越さない
+        second = asyncio.create_task(_hold(budget, 50, started, release))
+        third = asyncio.create_task(_hold(budget, 10, started, release))
+        await asyncio.sleep(0)
+        assert started == [60]
+        assert budget.waiting_bytes == 60
+
+        release.set()
+        await asyncio.gather(first, second, third)
+        assert started == [60, 50, 10]
+        assert budget.in_use == 0
+        assert not budget.waiters
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_is_removed_and_wakes_the_next():
+    async def main():
+        budget = ByteBudget(100)
+        release = asyncio.Event()
+        started = []
+        holder = asyncio.create_task(_hold(budget, 60, started, release))
+        await asyncio.sleep(0)
+        large = asyncio.create_task(_hold(budget, 80, started, release))
+        small = asyncio.create_task(_hold(budget, 30, started, release))
+        await asyncio.sleep(0)
+        assert started == [60]
+
+        # 先頭の待機が取り消されると、後ろの収まる予約が進む
+        large.cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert large.cancelled()
+        assert started == [60, 30]
+        assert budget.in_use == 90
+        assert budget.waiting_bytes == 0
+
+        release.set()
+        await asyncio.gather(holder, small)
+        assert budget.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_cancel_right_after_grant_releases_the_reservation():
+    async def main():
+        budget = ByteBudget(100)
+        release = asyncio.Event()
+        started = []
+        # 予算を使い切った状態（他の予約が実行中）
+        budget.in_use = 100
+        waiter = asyncio.create_task(_hold(budget, 40, started, release))
+        await asyncio.sleep(0)
+        assert budget.waiting_bytes == 40
+
+        # 予約が割り当てられた直後、待機中のタスクが再開する前に取り消す
+        budget._release(100)
+        assert budget.in_use == 40
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert waiter.cancelled()
+        assert started == []
+        assert budget.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_oversized_reservation_runs_alone():
+    async def main():
+        budget = ByteBudget(100)
+        started = []
+        release = asyncio.Event()
+        release.set()
+        # 予算を超える予約は予算いっぱいに切り詰めて単独で実行する
+        await _hold(budget, 500, started, release)
+        assert started == [500]
+        assert budget.in_use == 0
+
+    asyncio.run(main())
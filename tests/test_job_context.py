@@ -0,0 +1,77 @@
+"""
+services/job_context.py のテスト（ジョブの期限・置き換え・同じ入力の再要求の合流）
+"""
+import asyncio
+
+import pytest
+
+from services.job_context import JobCancelled, JobRegistry
+
+
+def test_identical_request_joins_running_job():
+    async def main():
+        registry = JobRegistry()
+        runs = []
+        release = asyncio.Event()
+
+        async def job():
+            async with registry.scope("U1", 10):
+                runs.append(1)
+                await release.wait()
+                return "done"
+
+        first = asyncio.create_task(registry.run("U1", ("img", "exterior", "OK"), job))
+        await asyncio.sleep(0)
+        assert registry.joinable("U1", ("img", "exterior", "OK")) is not None
+        second = asyncio.create_task(registry.run("U1", ("img", "exterior", "OK"), job))
+        await asyncio.sleep(0)
+
+        release.set()
+        assert await first == ("done", False)
+        assert await second == ("done", True)
+        assert runs == [1]
+        assert registry.joinable("U1", ("img", "exterior", "OK")) is None
+
+    asyncio.run(main())
+
+
+def test_different_request_supersedes_only_the_job_task():
+    async def main():
+        registry = JobRegistry()
+        reasons = []
+
+        async def job(name: str):
+            try:
+                async with registry.scope("U1", 10):
+                    await asyncio.sleep(0 if name == "second" else 10)
+                    return name
+            except JobCancelled as e:
+                reasons.append(e.reason)
+                return None
+
+        async def handler(key, name):
+            # 同じWebhookの後続イベントの処理に相当（ジョブが置き換えられても続く）
+            result = await registry.run("U1", key, lambda: job(name))
+            return result, "handler continued"
+
+        first = asyncio.create_task(handler("a", "first"))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(handler("b", "second"))
+
+        assert await first == ((None, False), "handler continued")
+        assert await second == (("second", False), "handler continued")
+        assert reasons == ["superseded"]
+
+    asyncio.run(main())
+
+
+def test_deadline_raises_job_cancelled():
+    async def main():
+        registry = JobRegistry()
+        with pytest.raises(JobCancelled) as info:
+            async with registry.scope("U1", 0.01):
+                await asyncio.sleep(1)
+        assert info.value.reason == "deadline"
+        assert registry.current("U1") is None
+
+    asyncio.run(main())
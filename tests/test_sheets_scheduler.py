@@ -0,0 +1,36 @@
+"""
+services/sheets_scheduler.py のテスト（呼び出し元の期限を過ぎる再試行・クォータ待ちをしない）
+"""
+import time
+
+import pytest
+import requests
+
+from services import sheets_scheduler as scheduler_module
+from services.sheets_scheduler import SheetsScheduler, TokenBucket
+
+
+def test_retries_stop_at_the_callers_deadline(monkeypatch):
+    monkeypatch.setattr(scheduler_module.random, "uniform", lambda low, high: high)
+    scheduler = SheetsScheduler()
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        raise requests.exceptions.ConnectionError("reset")
+
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        scheduler.run_until(time.monotonic() + 0.5, scheduler.read, flaky)
+    assert calls == [1]
+    assert time.monotonic() - started < 0.5
+    assert scheduler.metrics()["read"]["failures"] == 1
+    # 期限は呼び出しの間だけ有効
+    assert getattr(scheduler._local, "deadline") is None
+
+
+def test_quota_wait_past_the_deadline_fails_fast():
+    bucket = TokenBucket(per_minute=6, burst=1)
+    assert bucket.acquire() == 0.0
+    with pytest.raises(TimeoutError):
+        bucket.acquire(deadline=time.monotonic() + 1)
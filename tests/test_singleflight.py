@@ -0,0 +1,120 @@
+"""
+services/singleflight.py のテスト（同じキーの処理の相乗りと取り消し）
+"""
+import asyncio
+
+import pytest
+
+from services.singleflight import SingleFlight
+
+
+def test_identical_calls_share_one_execution():
+    async def main():
+        flight = SingleFlight("test")
+        calls = []
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        assert flight.in_flight() == 1
+
+        release.set()
+        assert await first == ("result", False)
+        assert await second == ("result", True)
+        assert calls == [1]
+        assert flight.in_flight() == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_caller_does_not_cancel_shared_work():
+    async def main():
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "result"
+
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+
+        # 相乗りしている呼び出し元が残っている間は処理を続ける
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        release.set()
+        assert await second == ("result", True)
+
+    asyncio.run(main())
+
+
+def test_work_is_cancelled_when_every_caller_is_cancelled():
+    async def main():
+        flight = SingleFlight("test")
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(flight.do("key", work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        await asyncio.sleep(0)
+        assert flight.in_flight() == 0
+
+        # 取り消し後の同じキーは新しく実行する
+        async def again():
+            return "again"
+
+        assert await flight.do("key", again) == ("again", False)
+
+    asyncio.run(main())
+
+
+def test_shared_work_does_not_inherit_the_callers_job_deadline():
+    from services.job_context import job_registry, remaining_timeout
+
+    async def main():
+        flight = SingleFlight("test")
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return remaining_timeout(100)
+
+        async def leader():
+            async with job_registry.scope("U1", 0.01):
+                return await flight.do("key", work)
+
+        first = asyncio.create_task(leader())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flight.do("key", work))
+
+        # 最初の呼び出し元が期限切れになっても、相乗りした側には元の期限の影響がない
+        assert await second == (100, True)
+        assert (await asyncio.gather(first, return_exceptions=True))[0].reason == "deadline"
+
+    asyncio.run(main())
+
+
+def test_shared_work_timeout():
+    async def main():
+        flight = SingleFlight("test")
+        with pytest.raises(TimeoutError):
+            await flight.do("key", lambda: asyncio.sleep(1), timeout=0.01)
+        assert flight.in_flight() == 0
+
+    asyncio.run(main())